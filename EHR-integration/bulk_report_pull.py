@@ -0,0 +1,317 @@
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Suppress the InsecureRequestWarning
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import json
+from datetime import datetime
+import pandas as pd
+import logging
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CHUNK_SIZE = 1024 * 1024
+
+def read_api_config(config_file: str = '../api_tokens.json') -> tuple:
+    '''
+    Read api tokens and endpoint url from api_config.json
+    Input: config_file: path to api_config.json
+    Output: api_key_local: API token for local
+            api_key_r4: API token for R4.
+            cu_local_endpoint: local api endpoint
+            r4_api_endpoint: R4 api endpoint
+    '''
+    logging.info("Reading api tokens and endpoint url...")
+    with open(config_file,'r') as f:
+        api_conf = json.load(f)
+
+    api_key_local = api_conf['api_key_local'] # API token for local
+    api_key_r4 = api_conf['api_key_r4'] # API token for R4.
+    cu_local_endpoint = api_conf['local_endpoint'] # local api endpoint
+    r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
+    return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
+
+def read_mrn_list(mrn_file : str) -> list:
+    '''
+    Read the requested MRNs
+    Input: mrn_file: a csv file with a mrn column, or a text file with one MRN per line
+    Output: mrn_list: a list of distinct MRNs, in file order
+    '''
+    with open(mrn_file, 'r') as f:
+        first_line = f.readline().strip().lower()
+    if first_line.split(',')[0] == 'mrn' or ',' in first_line:
+        mrn_list = pd.read_csv(mrn_file, dtype=str)['mrn'].dropna().str.strip().tolist()
+    else:
+        with open(mrn_file, 'r') as f:
+            mrn_list = [line.strip() for line in f]
+    return list(dict.fromkeys([mrn for mrn in mrn_list if mrn != '']))
+
+def resolve_mrns(api_key_local : str, cu_local_endpoint : str, mrn_list : list, file_field : str) -> pd.DataFrame:
+    '''
+    Resolve all requested MRNs with a single narrow export of the local REDCap
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           mrn_list: a list of MRNs
+           file_field: the report file field
+    Output: resolved_df: one row per MRN with cuimc_id, record_id, file_name and status
+            (found, not_found or ambiguous if the MRN belongs to more than one cuimc_id)
+    '''
+    logging.info(f"Resolving {len(mrn_list)} MRNs...")
+    data = {
+        'token': api_key_local,
+        'content': 'record',
+        'action': 'export',
+        'format': 'json',
+        'type': 'flat',
+        'csvDelimiter': '',
+        'fields[0]': 'cuimc_id',
+        'fields[1]': 'mrn',
+        'fields[2]': 'record_id',
+        'fields[3]': file_field,
+        'rawOrLabel': 'raw',
+        'rawOrLabelHeaders': 'raw',
+        'exportCheckboxLabel': 'false',
+        'exportSurveyFields': 'false',
+        'exportDataAccessGroups': 'false',
+        'returnFormat': 'json'
+    }
+    r = requests.post(cu_local_endpoint, data=data, verify=False)
+    if r.status_code != 200:
+        raise Exception('Error occured in exporting data from ' + cu_local_endpoint + '. HTTP Status: ' + str(r.status_code))
+    local_df = pd.DataFrame(r.json(), columns=['cuimc_id', 'mrn', 'record_id', file_field]).fillna('')
+    local_df = local_df.astype(str).apply(lambda x: x.str.strip())
+    # merge the rows of a record, e.g. repeating instruments, keeping the non-empty values
+    local_df = local_df.where(local_df != '').groupby('cuimc_id', sort=False).first().fillna('').reset_index()
+    local_df = local_df[local_df['mrn'].isin(mrn_list)].rename(columns={file_field: 'file_name'})
+    n_ids = local_df.groupby('mrn')['cuimc_id'].nunique()
+    resolved_df = pd.DataFrame({'mrn': mrn_list}).merge(local_df.drop_duplicates('mrn'), how='left', on='mrn').fillna('')
+    resolved_df['status'] = 'found'
+    resolved_df.loc[resolved_df['cuimc_id'] == '', 'status'] = 'not_found'
+    resolved_df.loc[resolved_df['mrn'].map(n_ids).fillna(0) > 1, 'status'] = 'ambiguous'
+    logging.info(f"{(resolved_df['status'] == 'found').sum()} MRNs found, {(resolved_df['status'] == 'not_found').sum()} not found, {(resolved_df['status'] == 'ambiguous').sum()} ambiguous.")
+    return resolved_df
+
+def open_report_cache(cache_dir : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the report cache index
+    Reports are stored under cache_dir/blobs by content hash, the index maps
+    (cuimc_id, field) to the cached file name and hash.
+    Input: cache_dir: root folder of the cache
+    Output: conn: sqlite3 connection to the cache index
+    '''
+    os.makedirs(os.path.join(cache_dir, 'tmp'), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'report_cache.db'))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_cache (
+            cuimc_id TEXT NOT NULL,
+            field_name TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            source TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (cuimc_id, field_name)
+        )''')
+    conn.commit()
+    return conn
+
+def cached_report(conn : sqlite3.Connection, cache_dir : str, cuimc_id : str, field : str, file_name : str, r4_ttl : int = 86400) -> str:
+    '''
+    Path of the cached report if it is still current
+    REDCap does not expose the hash of a stored file, the file name in the export is used to detect a new upload.
+    Reports pulled from R4 (no local file) have no file name in the local export, they are kept for r4_ttl seconds.
+    Input: conn: sqlite3 connection to the cache index
+           cache_dir: root folder of the cache
+           cuimc_id: the local record id
+           field: the report file field
+           file_name: the file name in the local export, '' if no local file
+           r4_ttl: maximum age in seconds of a report pulled from R4
+    Output: path: path of the cached blob, None if not cached or outdated
+    '''
+    row = conn.execute('SELECT file_name, sha256, source, fetched_at FROM report_cache WHERE cuimc_id = ? AND field_name = ?', (cuimc_id, field)).fetchone()
+    if row is None:
+        return None
+    if file_name != '' and (row[2] != 'local' or row[0] != file_name):
+        return None
+    if file_name == '' and (row[2] != 'r4' or (datetime.now() - datetime.strptime(row[3], "%Y-%m-%d %H:%M:%S")).total_seconds() > r4_ttl):
+        return None
+    path = os.path.join(cache_dir, 'blobs', row[1][:2], row[1])
+    return path if os.path.exists(path) else None
+
+def download_report(session : requests.Session, api_key : str, api_endpoint : str, record : str, field : str, cache_dir : str) -> tuple:
+    '''
+    Stream a report into the cache, hashing it while it is written
+    Input: session: requests session shared by the download workers
+           api_key: API token of the REDCap to download from
+           api_endpoint: api endpoint of the REDCap to download from
+           record: the record id in that REDCap
+           field: the file field
+           cache_dir: root folder of the cache
+    Output: (sha256, file_name): hash of the content and the file name sent by REDCap
+    FileNotFoundError is raised if the record has no file in the field
+    '''
+    data = {
+        'token': api_key,
+        'content': 'file',
+        'action': 'export',
+        'record': record,
+        'field': field,
+        'event': '',
+        'returnFormat': 'json'
+    }
+    sha256 = hashlib.sha256()
+    tmp_path = os.path.join(cache_dir, 'tmp', record + '.' + field + '.' + str(time.time_ns()))
+    with session.post(api_endpoint, data=data, stream=True, verify=False, timeout=300) as r:
+        if r.status_code != 200:
+            # REDCap answers 400 "There is no file to download for this record" for an empty file field
+            if r.status_code == 404 or (r.status_code == 400 and b'no file' in r.content.lower()):
+                raise FileNotFoundError('no report in ' + api_endpoint + ' for record ' + record)
+            raise Exception('HTTP Status: ' + str(r.status_code) + '. ' + str(r.content))
+        file_name = ''
+        content_type = r.headers.get('Content-Type', '')
+        if 'name=' in content_type:
+            file_name = content_type.split('name=')[1].strip('"; ')
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    digest = sha256.hexdigest()
+    path = os.path.join(cache_dir, 'blobs', digest[:2], digest)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return digest, file_name
+
+def fetch_report(session : requests.Session, api_key_local : str, cu_local_endpoint : str, api_key_r4 : str, r4_api_endpoint : str, row : dict, file_field : str, r4_file_field : str, cache_dir : str) -> tuple:
+    '''
+    Download a report from the local REDCap, or from R4 if there is no local file
+    Output: (sha256, file_name, source)
+    '''
+    if row['file_name'] != '':
+        digest, file_name = download_report(session, api_key_local, cu_local_endpoint, row['cuimc_id'], file_field, cache_dir)
+        return digest, row['file_name'], 'local'
+    if row['record_id'] == '':
+        raise FileNotFoundError('no local report and no R4 record_id')
+    digest, file_name = download_report(session, api_key_r4, r4_api_endpoint, row['record_id'], r4_file_field, cache_dir)
+    return digest, file_name, 'r4'
+
+def pull_reports(api_key_local : str, cu_local_endpoint : str, api_key_r4 : str, r4_api_endpoint : str, resolved_df : pd.DataFrame, file_field : str = 'gira_pdf', r4_file_field : str = None, cache_dir : str = 'report_cache', output_dir : str = 'reports', max_workers : int = 8, refresh : bool = False, r4_ttl : int = 86400) -> pd.DataFrame:
+    '''
+    Retrieve the reports of the resolved MRNs, serving unchanged reports from the cache
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           api_key_r4: API token for R4
+           r4_api_endpoint: R4 api endpoint
+           resolved_df: output of resolve_mrns
+           file_field: the report file field in local
+           r4_file_field: the report file field in R4, same as file_field if not provided
+           cache_dir: root folder of the cache
+           output_dir: folder to copy the reports to, as <mrn>_<cuimc_id>.<file_field>.pdf
+           max_workers: maximum number of concurrent downloads
+           refresh: whether to ignore the cache
+           r4_ttl: maximum age in seconds of a cached report pulled from R4
+    Output: summary_df: resolved_df with status (cached, local, r4, no_report, failed, ...) and path
+    '''
+    if r4_file_field is None:
+        r4_file_field = file_field
+    os.makedirs(output_dir, exist_ok=True)
+    conn = open_report_cache(cache_dir)
+    summary_df = resolved_df.copy()
+    summary_df['path'] = ''
+    hashes = {}
+    to_fetch = []
+    for i, row in summary_df[summary_df['status'] == 'found'].iterrows():
+        path = None if refresh else cached_report(conn, cache_dir, row['cuimc_id'], file_field, row['file_name'], r4_ttl=r4_ttl)
+        if path is not None:
+            hashes[i] = path
+            summary_df.loc[i, 'status'] = 'cached'
+        else:
+            to_fetch.append(i)
+    logging.info(f"{len(hashes)} reports served from cache, downloading {len(to_fetch)} reports with {max_workers} workers...")
+
+    start = time.time()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_report, session, api_key_local, cu_local_endpoint, api_key_r4, r4_api_endpoint, summary_df.loc[i].to_dict(), file_field, r4_file_field, cache_dir): i for i in to_fetch}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                digest, file_name, source = future.result()
+                # cache index is only written from this thread
+                conn.execute('INSERT OR REPLACE INTO report_cache (cuimc_id, field_name, file_name, sha256, source, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                             (summary_df.loc[i, 'cuimc_id'], file_field, file_name, digest, source, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit()
+                hashes[i] = os.path.join(cache_dir, 'blobs', digest[:2], digest)
+                summary_df.loc[i, 'status'] = source
+            except FileNotFoundError:
+                summary_df.loc[i, 'status'] = 'no_report'
+            except Exception as e:
+                summary_df.loc[i, 'status'] = 'failed'
+                logging.error('Error occured in downloading the report of MRN {}. {}'.format(summary_df.loc[i, 'mrn'], str(e)))
+    session.close()
+    conn.close()
+
+    for i, blob in hashes.items():
+        path = os.path.join(output_dir, '{mrn}_{cuimc_id}.{file_field}.pdf'.format(mrn = summary_df.loc[i, 'mrn'], cuimc_id = summary_df.loc[i, 'cuimc_id'], file_field = file_field))
+        shutil.copyfile(blob, path)
+        summary_df.loc[i, 'path'] = path
+    logging.info(f"Reports retrieved in {time.time() - start:.1f}s: " + ', '.join([f"{k} {v}" for k, v in summary_df['status'].value_counts().items()]))
+    return summary_df
+
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--log', type=str, required=False, help="file to write log",)
+        parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
+        parser.add_argument('--mrn_file', type=str, required=True, help='csv file with a mrn column, or one MRN per line')
+        parser.add_argument('--file_field', type=str, required=False, default='gira_pdf', help='report file field in local REDCap')
+        parser.add_argument('--r4_file_field', type=str, required=False, help='report file field in R4, default to file_field')
+        parser.add_argument('--cache_dir', type=str, required=False, default='report_cache', help='folder of the local report cache')
+        parser.add_argument('--output_dir', type=str, required=False, default='reports', help='folder to write the reports to')
+        parser.add_argument('--max_workers', type=int, required=False, default=8, help='maximum number of concurrent downloads')
+        parser.add_argument('--refresh', action='store_true', help='download again even if cached')
+        parser.add_argument('--r4_cache_ttl', type=int, required=False, default=86400, help='maximum age in seconds of a cached report pulled from R4')
+        args = parser.parse_args()
+
+        # if token file is not provided, use the default token file
+        if args.token is None:
+            token_file = '../api_tokens.json'
+        else:
+            token_file = args.token
+
+        # if log file is not provided, use the default log file
+        if args.log is None:
+            log_file = './bulk_report_pull.log'
+        else:
+            log_file = args.log
+
+        # set up logging.
+        logging.basicConfig(filename=log_file, format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+        logging.info('Start pulling reports...')
+        api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
+        mrn_list = read_mrn_list(args.mrn_file)
+        resolved_df = resolve_mrns(api_key_local, cu_local_endpoint, mrn_list, args.file_field)
+        summary_df = pull_reports(api_key_local, cu_local_endpoint, api_key_r4, r4_api_endpoint, resolved_df, file_field=args.file_field, r4_file_field=args.r4_file_field,
+                                  cache_dir=args.cache_dir, output_dir=args.output_dir, max_workers=args.max_workers, refresh=args.refresh, r4_ttl=args.r4_cache_ttl)
+        summary_df.to_csv(os.path.join(args.output_dir, 'summary.csv'), index=False)
+        logging.info('Finished pulling reports.')
+
+    except Exception as e:
+        logging.error('Error: {}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,283 @@
+import requests
+import json
+from datetime import datetime
+import logging
+import argparse
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# fields loaded from the local REDCap, the first one is the record id
+LOOKUP_FIELDS = ['cuimc_id', 'mrn', 'cuimc_empi', 'record_id', 'participant_lab_id', 'first_local', 'last_local', 'dob']
+# fields with a hash index, i.e. that can be used as a lookup key
+KEY_FIELDS = ['cuimc_id', 'mrn', 'cuimc_empi', 'record_id', 'participant_lab_id']
+
+def read_api_config(config_file: str = '../api_tokens.json') -> tuple:
+    '''
+    Read api tokens and endpoint url from api_config.json
+    Input: config_file: path to api_config.json
+    Output: api_key_local: API token for local
+            api_key_r4: API token for R4.
+            cu_local_endpoint: local api endpoint
+            r4_api_endpoint: R4 api endpoint
+    '''
+    logging.info("Reading api tokens and endpoint url...")
+    with open(config_file,'r') as f:
+        api_conf = json.load(f)
+
+    api_key_local = api_conf['api_key_local'] # API token for local
+    api_key_r4 = api_conf['api_key_r4'] # API token for R4.
+    cu_local_endpoint = api_conf['local_endpoint'] # local api endpoint
+    r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
+    return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
+
+def export_lookup_fields(api_key_local : str, cu_local_endpoint : str, date_range_begin : str = None) -> list:
+    '''
+    Export the lookup fields of the local records
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           date_range_begin: only export records created or modified after this time (YYYY-MM-DD HH:MM:SS)
+    Output: records: a list of records
+    '''
+    data = {
+        'token': api_key_local,
+        'content': 'record',
+        'action': 'export',
+        'format': 'json',
+        'type': 'flat',
+        'csvDelimiter': '',
+        'rawOrLabel': 'raw',
+        'rawOrLabelHeaders': 'raw',
+        'exportCheckboxLabel': 'false',
+        'exportSurveyFields': 'false',
+        'exportDataAccessGroups': 'false',
+        'returnFormat': 'json'
+    }
+    for i, field in enumerate(LOOKUP_FIELDS):
+        data['fields[' + str(i) + ']'] = field
+    if date_range_begin is not None:
+        data['dateRangeBegin'] = date_range_begin
+    flag = 1
+    while(flag > 0 and flag < 5):
+        try:
+            r = requests.post(cu_local_endpoint, data=data, timeout=300)
+            if r.status_code == 200:
+                return r.json()
+            logging.error('Error occured in exporting data from ' + cu_local_endpoint)
+            logging.error('HTTP Status: ' + str(r.status_code))
+            logging.error(r.content)
+        except Exception as e:
+            logging.error('Error occured in exporting data. ' + str(e))
+        flag = flag + 1
+        time.sleep(flag)
+    raise Exception('Error occured in exporting data from ' + cu_local_endpoint)
+
+def new_index() -> dict:
+    '''
+    An empty lookup index
+    Output: index: entries by cuimc_id, one hash index per key field, and a (first, last, dob) index
+    '''
+    index = {'entries': {}, 'name_dob': {}, 'lock': threading.Lock(), 'last_refresh': None, 'last_full_refresh': None}
+    for field in KEY_FIELDS:
+        index[field] = {}
+    return index
+
+def merge_rows(records : list) -> dict:
+    '''
+    Merge the rows of each record (e.g. repeating instruments) into a single entry
+    Input: records: a list of exported rows
+    Output: entries: a dict of cuimc_id to entry, keeping the first non-empty value of each field
+    '''
+    entries = {}
+    for record in records:
+        cuimc_id = str(record.get('cuimc_id', '')).strip()
+        if cuimc_id == '':
+            continue
+        entry = entries.setdefault(cuimc_id, dict([(field, '') for field in LOOKUP_FIELDS]))
+        for field in LOOKUP_FIELDS:
+            value = str(record.get(field, '')).strip()
+            if entry[field] == '' and value != '':
+                entry[field] = value
+    return entries
+
+def name_dob_key(first_name : str, last_name : str, dob : str) -> tuple:
+    return first_name.strip().lower(), last_name.strip().lower(), dob.strip()
+
+def remove_entry(index : dict, cuimc_id : str):
+    '''
+    Remove a record from all hash indexes, the caller holds the lock
+    '''
+    entry = index['entries'].pop(cuimc_id, None)
+    if entry is None:
+        return
+    keys = [(index[field], entry[field]) for field in KEY_FIELDS]
+    keys.append((index['name_dob'], name_dob_key(entry['first_local'], entry['last_local'], entry['dob'])))
+    for key_index, key in keys:
+        ids = key_index.get(key)
+        if ids is not None:
+            ids.discard(cuimc_id)
+            if len(ids) == 0:
+                del key_index[key]
+
+def add_entry(index : dict, cuimc_id : str, entry : dict):
+    '''
+    Add a record to all hash indexes, the caller holds the lock
+    '''
+    index['entries'][cuimc_id] = entry
+    for field in KEY_FIELDS:
+        if entry[field] != '':
+            index[field].setdefault(entry[field], set()).add(cuimc_id)
+    if entry['first_local'] != '' and entry['last_local'] != '' and entry['dob'] != '':
+        index['name_dob'].setdefault(name_dob_key(entry['first_local'], entry['last_local'], entry['dob']), set()).add(cuimc_id)
+
+def update_index(index : dict, records : list, full : bool = False):
+    '''
+    Apply exported records to the index
+    Input: index: the lookup index
+           records: exported rows of new or changed records, or of all records if full
+           full: whether records is the whole population, records not in it are dropped
+    '''
+    entries = merge_rows(records)
+    with index['lock']:
+        if full:
+            for cuimc_id in [cuimc_id for cuimc_id in index['entries'] if cuimc_id not in entries]:
+                remove_entry(index, cuimc_id)
+        for cuimc_id, entry in entries.items():
+            remove_entry(index, cuimc_id)
+            add_entry(index, cuimc_id, entry)
+    logging.info(f"Lookup index updated with {len(entries)} records{' (full)' if full else ''}, {len(index['entries'])} records in total.")
+
+def refresh_index(index : dict, api_key_local : str, cu_local_endpoint : str, full_refresh_interval : int = 86400):
+    '''
+    Refresh the index from the local REDCap
+    Records created or modified since the last refresh are exported with dateRangeBegin.
+    Deleted records are not reported that way, so everything is reloaded every full_refresh_interval seconds.
+    Input: index: the lookup index
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           full_refresh_interval: seconds between two full reloads
+    '''
+    # take the time before the export so that changes made during the export are picked up next time
+    now = datetime.now()
+    full = index['last_full_refresh'] is None or (now - index['last_full_refresh']).total_seconds() >= full_refresh_interval
+    date_range_begin = None if full else index['last_refresh'].strftime('%Y-%m-%d %H:%M:%S')
+    records = export_lookup_fields(api_key_local, cu_local_endpoint, date_range_begin=date_range_begin)
+    update_index(index, records, full=full)
+    index['last_refresh'] = now
+    if full:
+        index['last_full_refresh'] = now
+
+def refresh_loop(index : dict, api_key_local : str, cu_local_endpoint : str, refresh_interval : int = 300, full_refresh_interval : int = 86400):
+    '''
+    Refresh the index every refresh_interval seconds, errors are logged and retried on the next round
+    '''
+    while True:
+        time.sleep(refresh_interval)
+        try:
+            refresh_index(index, api_key_local, cu_local_endpoint, full_refresh_interval=full_refresh_interval)
+        except Exception as e:
+            logging.error('Error occured in refreshing the lookup index. ' + str(e))
+
+def lookup(index : dict, query : dict) -> list:
+    '''
+    Find participants by any key field, or by first name, last name and dob
+    If a key field and names are both given, the names and dob are used to verify the matches.
+    Input: index: the lookup index
+           query: a dict with one of KEY_FIELDS, and/or first_name, last_name and dob (YYYY-MM-DD)
+    Output: matches: a list of entries
+    '''
+    has_names = all([query.get(field, '') != '' for field in ['first_name', 'last_name', 'dob']])
+    name_key = name_dob_key(query.get('first_name', ''), query.get('last_name', ''), query.get('dob', '')) if has_names else None
+    with index['lock']:
+        ids = None
+        for field in KEY_FIELDS:
+            if query.get(field, '') != '':
+                ids = index[field].get(str(query[field]).strip(), set())
+                break
+        if name_key is not None:
+            name_ids = index['name_dob'].get(name_key, set())
+            ids = name_ids if ids is None else ids & name_ids
+        if ids is None:
+            return []
+        return [dict(index['entries'][cuimc_id]) for cuimc_id in sorted(ids, key=lambda x: (len(x), x))]
+
+class LookupHandler(BaseHTTPRequestHandler):
+    '''
+    GET /lookup?mrn=...[&first_name=...&last_name=...&dob=...] returns {"matches": [...]}
+    GET /health returns the index size and refresh times
+    '''
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        index = self.server.index
+        if url.path == '/health':
+            self.send_json(200, {'records': len(index['entries']),
+                                 'last_refresh': str(index['last_refresh']),
+                                 'last_full_refresh': str(index['last_full_refresh'])})
+        elif url.path == '/lookup':
+            query = dict([(k, v[0]) for k, v in urllib.parse.parse_qs(url.query).items()])
+            start = time.perf_counter()
+            matches = lookup(index, query)
+            logging.debug(f"Lookup answered in {(time.perf_counter() - start) * 1e6:.0f} microseconds.")
+            self.send_json(200, {'matches': matches})
+        else:
+            self.send_json(404, {'error': 'unknown path'})
+
+def start_service(index : dict, host : str = '127.0.0.1', port : int = 8765) -> ThreadingHTTPServer:
+    '''
+    Start the lookup API in a background thread
+    Input: index: the lookup index
+           host: address to listen on, local only by default
+           port: port to listen on, 0 for any free port
+    Output: server: the running server
+    '''
+    server = ThreadingHTTPServer((host, port), LookupHandler)
+    server.index = index
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Lookup service listening on {host}:{server.server_address[1]}")
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', type=str, required=False, help="file to write log",)
+    parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, required=False, default=8765, help='port to listen on')
+    parser.add_argument('--refresh_interval', type=int, required=False, default=300, help='seconds between two incremental refreshes')
+    parser.add_argument('--full_refresh_interval', type=int, required=False, default=86400, help='seconds between two full reloads')
+    args = parser.parse_args()
+
+    # if token file is not provided, use the default token file
+    if args.token is None:
+        token_file = '../api_tokens.json'
+    else:
+        token_file = args.token
+
+    # if log file is not provided, use the default log file
+    if args.log is None:
+        log_file = './lookup_service.log'
+    else:
+        log_file = args.log
+
+    # set up logging.
+    logging.basicConfig(filename=log_file, format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    logging.info('Start lookup service...')
+    api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
+    index = new_index()
+    refresh_index(index, api_key_local, cu_local_endpoint, full_refresh_interval=args.full_refresh_interval)
+    server = start_service(index, host=args.host, port=args.port)
+    refresh_loop(index, api_key_local, cu_local_endpoint, refresh_interval=args.refresh_interval, full_refresh_interval=args.full_refresh_interval)
@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+import tracemalloc
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'redcap_api_utils'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+from duplicate_marker_local import find_duplicates, de_duplicates, de_duplicates_grouped
+from test_duplicate_marker_local import make_local_data
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, required=False, default=1000000, help='number of synthetic local records')
+    parser.add_argument('--seed', type=int, required=False, default=1, help='random seed')
+    args = parser.parse_args()
+
+    duplicates_df = find_duplicates(make_local_data(args.rows, args.seed))
+    print(f"{args.rows} records, {duplicates_df.shape[0]} rows in duplicate clusters")
+    results = []
+    for de_duplicates_function in [de_duplicates, de_duplicates_grouped]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        results.append(de_duplicates_function(duplicates_df))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{de_duplicates_function.__name__}: {elapsed:.1f}s, peak {peak / 1e6:.0f}MB")
+    identical = all([x.to_csv(index=False) == y.to_csv(index=False) for x, y in zip(*results)])
+    print('identical outputs: ' + str(identical))
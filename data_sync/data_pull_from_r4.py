@@ -13,8 +13,15 @@ import logging
 import argparse
 import os
 import smtplib
+import fcntl
 from email.message import EmailMessage
 import sys
+from schema_drift import apply_schema_drift, cached_metadata, load_metadata, export_field_names
+from payload_validation import validate_payload, payload_records, export_repeating_forms, write_quarantine_report
+
+# R4 fields the sync reads itself, exported even if they are ignored
+R4_SYNC_FIELDS = ['record_id', 'first_name', 'last_name', 'date_of_birth', 'age', 'first_name_child', 'last_name_child', 'date_of_birth_child',
+                  'participant_lab_id', 'last_update_timestamp', 'survey_queue_link']
 
 def send_email(msg,host,port):
     logging.info("Sending email...")
@@ -32,11 +39,12 @@ def send_email(msg,host,port):
         logging.error(f'Error sending email: {sys.exc_info()[0]}')
     return is_success
 
-def read_redcap_fields_from_record(api_key: str, api_endpoint : str) -> list:
+def read_redcap_fields_from_record(api_key: str, api_endpoint : str, session : requests.Session = None) -> list:
     '''
     Read REDCap fields from REDCap using API
     Input: api_key: API token
            api_endpoint: api endpoint url
+           session: shared http session, a new connection is used if None
     Output: field_name_list: a list of field names
     '''
 
@@ -58,7 +66,8 @@ def read_redcap_fields_from_record(api_key: str, api_endpoint : str) -> list:
             'exportDataAccessGroups': 'false',
             'returnFormat': 'json'
         }
-    r = requests.post(api_endpoint,data=data, verify=False)
+    post = requests.post if session is None else session.post
+    r = post(api_endpoint,data=data, verify=False)
     record = r.json()[0]
     field_name_list = record.keys()
     return field_name_list
@@ -98,13 +107,16 @@ def read_api_config(config_file: str = './api_tokens.json') -> tuple:
     r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
     return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
 
-def export_data_from_redcap(api_key : str, api_endpoint : str, id_only : bool = False, record_id = None, filter_logic = None) -> list:
+def export_data_from_redcap(api_key : str, api_endpoint : str, id_only : bool = False, record_id = None, filter_logic = None, session : requests.Session = None,
+                            fields : list = None) -> list:
     '''
     Export data from REDCap using API
     Input: api_key: API token
            api_endpoint: api endpoint url
            id_only: whether to export only id fields
            record_id: the record id of the participant if provided
+           session: shared http session, a new connection is used if None
+           fields: the fields to export if not id_only, all fields if None
     Output: data: a json object containing all the data from REDCap
     '''
     logging.info(f"Exporting data from {api_endpoint}...")
@@ -157,14 +169,18 @@ def export_data_from_redcap(api_key : str, api_endpoint : str, id_only : bool =
             'returnFormat': 'json'
         }
     
+    if not id_only and fields is not None:
+        for i, field in enumerate(fields):
+            data[f'fields[{i}]'] = field
     if record_id is not None:
         data['records[0]'] = str(record_id)
     if filter_logic is not None:
         data['filterLogic'] = filter_logic
+    post = requests.post if session is None else session.post
     flag = 1
     while(flag > 0 and flag < 5):   
         try:
-            r = requests.post(api_endpoint,data=data, verify=False)
+            r = post(api_endpoint,data=data, verify=False)
             if r.status_code == 200:
                 logging.debug('HTTP Status: ' + str(r.status_code))
                 data = r.json()
@@ -258,11 +274,39 @@ def indexing_r4_data(r4_data: list) -> pd.DataFrame:
     logging.info("R4 dataset length: " + str(r4_data_df.shape[0]))
     return r4_data_df
 
-def match_r4_local_data(r4_data_df : pd.DataFrame, local_data_df : pd.DataFrame) -> pd.DataFrame:
+def reserve_cuimc_ids(count : int, cuimc_id_floor : int, reservation_file : str) -> int:
+    '''
+    Reserve count contiguous cuimc_ids, starting at cuimc_id_floor or after the last reserved id
+    The last reserved id is kept in reservation_file under an exclusive lock, the same file and format as
+    redcap_api_utils/local_batch_upload.py, so that the syncs and the batch uploads never assign the same cuimc_id.
+    Input: count: number of cuimc_ids
+           cuimc_id_floor: the next cuimc_id in the local export
+           reservation_file: path to the reservation file
+    Output: cuimc_id_start: the first reserved cuimc_id
+    '''
+    with open(reservation_file,'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            last_reserved = f.read().strip()
+            last_reserved = int(last_reserved) if last_reserved != '' else 0
+            cuimc_id_start = max(int(cuimc_id_floor), last_reserved + 1)
+            f.seek(0)
+            f.truncate()
+            f.write(str(cuimc_id_start + count - 1))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    logging.info('Reserved cuimc_id ' + str(cuimc_id_start) + ' - ' + str(cuimc_id_start + count - 1))
+    return cuimc_id_start
+
+def match_r4_local_data(r4_data_df : pd.DataFrame, local_data_df : pd.DataFrame, reservation_file : str = None) -> pd.DataFrame:
     '''
     Match R4 and local data
     Input: r4_data_df: a pandas dataframe containing R4 data
            local_data_df: a pandas dataframe containing local data
+           reservation_file: cuimc_id reservation file shared by the processes that create cuimc_ids, see reserve_cuimc_ids
     Output: current_mapping: a pandas dataframe containing matched data
     '''
     logging.info("Matching R4 and local dataset...")
@@ -288,7 +332,9 @@ def match_r4_local_data(r4_data_df : pd.DataFrame, local_data_df : pd.DataFrame)
     # Step 5 auto generate cuimc id
     r4_data_unmapped_df = r4_data_df[~r4_data_df['record_id'].isin(current_mapping['record_id'])][['record_id']].drop_duplicates()
     newly_created_cuimc_id_start = local_data_df['cuimc_id'].max() + 1
-    newly_created_cuimc_id_end = local_data_df['cuimc_id'].max()+1+len(r4_data_unmapped_df)
+    if reservation_file is not None and len(r4_data_unmapped_df) > 0:
+        newly_created_cuimc_id_start = reserve_cuimc_ids(len(r4_data_unmapped_df), newly_created_cuimc_id_start, reservation_file)
+    newly_created_cuimc_id_end = newly_created_cuimc_id_start + len(r4_data_unmapped_df)
     if len(r4_data_unmapped_df) > 0:
         logging.info(f"Newly created cuimc id range: {newly_created_cuimc_id_start} - {newly_created_cuimc_id_end}")
     else:
@@ -305,12 +351,13 @@ def match_r4_local_data(r4_data_df : pd.DataFrame, local_data_df : pd.DataFrame)
     logging.info("Number of records in current mapping: " + str(current_mapping.shape[0]))
     return current_mapping
 
-def push_data_to_local(api_key_local: str, cu_local_endpoint: str, batch : list) -> int:
+def push_data_to_local(api_key_local: str, cu_local_endpoint: str, batch : list, session : requests.Session = None) -> int:
     '''
     Push data to local REDCap
     Input: api_key_local: API key for local REDCap
            cu_local_endpoint: API endpoint for local REDCap
            batch: a batch list of records to push to local REDCap
+           session: shared http session, a new connection is used if None
     Output: 1 if success, 0 if failure
     '''
     logging.info('Push to local REDCap...')
@@ -326,10 +373,11 @@ def push_data_to_local(api_key_local: str, cu_local_endpoint: str, batch : list)
         'returnContent': 'count',
         'returnFormat': 'json'
     }
+    post = requests.post if session is None else session.post
     flag = 1
     while(flag > 0 and flag < 3):
         
-        r = requests.post(cu_local_endpoint,data=data, verify=False)
+        r = post(cu_local_endpoint,data=data, verify=False)
         if r.status_code == 200:
             logging.debug('HTTP Status: ' + str(r.status_code))
             if 'ERROR' in str(r.content):
@@ -383,13 +431,15 @@ def get_r4_links(api_key: str, api_endpoint : str, current_mapping: pd.DataFrame
     current_mapping = current_mapping.drop('survey_queue_link', axis=1)
     return current_mapping
 
-def prepare_local_list(current_mapping : pd.DataFrame, r4_data : list, ignore_fields : list, local_fields: list, current_time : str) -> list:
+def prepare_local_list(current_mapping : pd.DataFrame, r4_data : list, ignore_fields : list, local_fields: list, current_time : str, api_key_r4 : str = None, r4_api_endpoint : str = None) -> list:
     '''
     Prepare the list to push to local REDCap
     Input: current_mapping: the current mapping between R4 and local REDCap
            r4_data: the data pulled from R4
            ignore_fields: the fields to ignore
            current_time: current time
+           api_key_r4: API key for R4
+           r4_api_endpoint: API endpoint for R4
     Output: the list to push to local REDCap
     '''
     logging.info("Preparing Pushing list...")
@@ -399,7 +449,8 @@ def prepare_local_list(current_mapping : pd.DataFrame, r4_data : list, ignore_fi
     r4_data_df = pd.DataFrame(r4_data)
     logging.debug("DEBUG r4_data_df: ")
     logging.debug(r4_data_df[r4_data_df['record_id']=='18697'][['record_id','redcap_repeat_instrument','redcap_repeat_instance']])
-    r4_data_df = r4_data_df.drop(ignore_fields, axis=1)
+    # the drift stage can ignore fields that are not in this export, e.g. fields of forms without data
+    r4_data_df = r4_data_df.drop(ignore_fields, axis=1, errors='ignore')
     r4_data_df = r4_data_df.merge(current_mapping_df, on='record_id', how='left')
     r4_data_df['cuimc_id'] = pd.to_numeric(r4_data_df['cuimc_id'].astype(str).str.strip(), errors='coerce').fillna(0).astype(int)
     logging.debug("DEBUG r4_data_df after merged: ")
@@ -418,6 +469,158 @@ def prepare_local_list(current_mapping : pd.DataFrame, r4_data : list, ignore_fi
     # push_to_local_list = r4_data_df.to_dict(orient='records')
     return r4_data_df
             
+def r4_export_fields(meta_r4_json : list, ignore_fields : list) -> list:
+    '''
+    Fields to export from R4, leaving out the fields whose export columns are all ignored
+    Input: meta_r4_json: R4 data dictionary
+           ignore_fields: effective ignore fields, output of apply_schema_drift
+    Output: fields: a list of R4 field names, None to export all fields if the data dictionary lacks a field the sync reads
+    '''
+    field_names = set([i['field_name'] for i in meta_r4_json])
+    if any([i not in field_names for i in R4_SYNC_FIELDS]):
+        return None
+    ignore_fields = set(ignore_fields)
+    fields = [field for column, field in export_field_names(meta_r4_json).items() if column not in ignore_fields or field in R4_SYNC_FIELDS]
+    return list(dict.fromkeys(fields))
+
+def export_r4_data(api_key_r4 : str, r4_api_endpoint : str, local_data_list : list, r4_id : str = None, session : requests.Session = None,
+                   fields : list = None) -> list:
+    '''
+    Export the R4 data, in slices of 500 R4 record ids to keep the R4 server within its memory
+    Input: api_key_r4: API key for R4
+           r4_api_endpoint: API endpoint for R4
+           local_data_list: id exports of the local projects fed by this export, the slices cover their R4 record ids
+           r4_id: the R4 record id of a single participant sync
+           session: shared http session, a new connection is used if None
+           fields: output of r4_export_fields, all fields if None
+    Output: r4_data: a list of R4 records
+    '''
+    if r4_id is not None:
+        return export_data_from_redcap(api_key_r4,r4_api_endpoint, id_only=False, record_id=r4_id, session=session, fields=fields)
+
+    # 2025-01-13 CT: R4 giving server out of memory exception. Splitting up data export into 2 batches
+    # Get IDs from local REDCap before exporting R4 data so that we can determine the midpoint record_id to split up R4 data export
+    record_ids = list(set([int(r['record_id']) for local_data in local_data_list for r in local_data if r['record_id'] != '']))
+    record_ids.sort()
+    if len(record_ids) == 0:
+        raise Exception("No R4 record ids in the local projects, nothing to export from R4")
+    record_id_splits = record_ids[::500]
+
+    r4_data = list()
+    for i in range(len(record_id_splits)):
+        if i < len(record_id_splits) - 1:
+            filter_logic=f'[record_id] >= {record_id_splits[i]} and [record_id] < {record_id_splits[i+1]}'
+        else:
+            filter_logic=f'[record_id] >= {record_id_splits[-1]}'
+        logging.info(f'Exporting R4 data for participants: {filter_logic}')
+        new_data = export_data_from_redcap(api_key_r4,r4_api_endpoint, id_only=False, filter_logic=filter_logic, session=session, fields=fields)
+        if not new_data:
+            raise Exception("Error occurred during data export from R4")
+        logging.info(f'Received R4 data for {len(new_data)} records')
+        r4_data.extend(new_data)
+    logging.info(f'Received R4 data for a total of {len(r4_data)} records')
+    return r4_data
+
+def sync_project(api_key_local : str, cu_local_endpoint : str, api_key_r4 : str, r4_api_endpoint : str, ignore_fields : list,
+                 local_data : list, r4_data : list, current_time : str, report_prefix : str = './', schema_cache : str = './schema_cache.json',
+                 payload_validation : bool = True, batch_size : int = 500, push_slots = None,
+                 session : requests.Session = None, reservation_file : str = None, local_fields : list = None,
+                 meta_local_json : list = None, repeating_forms : list = None) -> dict:
+    '''
+    Sync the exported R4 data into one local project
+    Input: api_key_local: API key for local REDCap
+           cu_local_endpoint: API endpoint for local REDCap
+           api_key_r4: API key for R4
+           r4_api_endpoint: API endpoint for R4
+           ignore_fields: effective ignore fields, output of apply_schema_drift when the drift stage runs
+           local_data: id export of the local project
+           r4_data: output of export_r4_data, it is not modified and can feed several projects
+           current_time: time of the sync, written to last_r4_pull
+           report_prefix: folder and file name prefix of the quarantine report
+           schema_cache: path to the schema cache of this project
+           payload_validation: whether to validate the payload before the import
+           batch_size: number of participants per import
+           push_slots: semaphore limiting the concurrent imports to the local server, if provided
+           session: shared http session, a new connection is used if None
+           reservation_file: cuimc_id reservation file, see reserve_cuimc_ids
+           local_fields, meta_local_json, repeating_forms: local fields, data dictionary and repeating instruments
+                                                           loaded by the caller, exported here if None
+    Output: summary: numbers of participants, batches and failed batches, and the R4 record ids of the failed batches
+    '''
+    date_string = datetime.now().strftime("%Y%m%d")
+    summary = {'participants': 0, 'batches': 0, 'failed_batches': 0, 'failed_r4_ids': []}
+    if local_fields is None:
+        local_fields = read_redcap_fields_from_record(api_key_local, cu_local_endpoint, session=session)
+
+    # logging.debug("DEBUG r4_data: ")
+    # logging.debug([e for e in r4_data if e['record_id']=='18697'])
+
+    if not r4_data:
+        return summary
+    r4_data_df = indexing_r4_data(r4_data)
+    logging.debug("DEBUG r4_data_df: ")
+    logging.debug(r4_data_df[r4_data_df['record_id']=='18697'])
+    # local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, id_only=True)  # 2025-01-13 CT: retrieve local data before R4 so that we can get split R4 data export by record_id
+    local_data_df = indexing_local_data(local_data)
+    current_mapping = match_r4_local_data(r4_data_df, local_data_df, reservation_file = reservation_file)
+    logging.debug("DEBUG current_mapping: ")
+    logging.debug(current_mapping[current_mapping['record_id']=='18697'])
+    r4_data_df = prepare_local_list(current_mapping, r4_data, ignore_fields, local_fields, current_time, api_key_r4, r4_api_endpoint)
+    r4_data_df = r4_data_df.reset_index(drop=True)
+    # leave out the cells the local REDCap would reject, otherwise the whole batch fails
+    if not payload_validation:
+        bad_cells = pd.DataFrame(False, index=r4_data_df.index, columns=r4_data_df.columns)
+    else:
+        if meta_local_json is None:
+            # re-read unless the design log shows no change, the drift stage may not have run
+            meta_local_json, _ = load_metadata(api_key_local, cu_local_endpoint, cache_file = schema_cache)
+        if repeating_forms is None:
+            repeating_forms = export_repeating_forms(api_key_local, cu_local_endpoint)
+        bad_cells, quarantine_df = validate_payload(r4_data_df, meta_local_json, repeating_forms)
+        write_quarantine_report(quarantine_df, report_prefix + 'quarantine_' + date_string + '.csv')
+    logging.debug("DEBUG push_to_local_list: ")
+    ####################### Define the batch size ########################
+    # reduce the batch size if there is a memory issue
+    # for batch size 5000, put php_value memory_limit "4G" in php.ini or 020-redcap.conf
+    # There is a very strange REDCap bug. 
+    # Using a batch approach will accidently split a single participant's multiple dictionaries into different batches. 
+    # In that case, later records (no matter if they are repeated instances or not) will always overwrite the ones in the previous batch. 
+    # That's why it works for one participant but not for all.
+    # To avoid this, make sure all the records for a single participant are in the same batch.
+    #######################################################################
+    cuimc_id_list = r4_data_df['cuimc_id'].unique().tolist()
+    summary['participants'] = len(cuimc_id_list)
+    logging.info(f"Number of unique cuimc_id: {len(cuimc_id_list)}")
+    # Iterate over the list in batches
+    for i in range(0, len(cuimc_id_list), batch_size):
+        logging.info(f"Index: {i}...Pushing data to local REDCap...")
+        start = i
+        end = min(i + batch_size, len(cuimc_id_list))
+        cuimc_id_batch = cuimc_id_list[start:end]
+        r4_data_batch_df = r4_data_df[r4_data_df['cuimc_id'].isin(cuimc_id_batch)]
+        batch = payload_records(r4_data_batch_df, bad_cells)
+        logging.debug("DEBUG push_to_local_list: ")
+        # write to a test json
+        # with open('test.json', 'w') as f:
+        #     json.dump(batch, f)               
+        ### Important: 
+        # During the project setup some of R4 fields are based on survey equations, which won't sync correctly into local REDCap
+        # Therefore, we need to manually update those fields in local REDCap by removing the @CALC in those fields
+        # examples include adult_baseline_timestamp, child_baseline_timestamp,preror_adult_timestamp,preror_child_timestamp
+        if push_slots is None:
+            status = push_data_to_local(api_key_local, cu_local_endpoint, batch, session=session)
+        else:
+            with push_slots:
+                status = push_data_to_local(api_key_local, cu_local_endpoint, batch, session=session)
+        summary['batches'] = summary['batches'] + 1
+        if status == 1:
+            logging.info(f"Index: {start} to {end}...Data pull from R4 is successful")
+        else:
+            summary['failed_batches'] = summary['failed_batches'] + 1
+            summary['failed_r4_ids'].extend(current_mapping[current_mapping['cuimc_id'].isin(cuimc_id_batch)]['record_id'].astype(str).tolist())
+            logging.error(f"Index: {start} to {end}...Data pull from R4 is not successful")
+    return summary
+
 if __name__ == "__main__":
     try:
 
@@ -426,6 +629,10 @@ if __name__ == "__main__":
         parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')   
         parser.add_argument('--ignore', type=str, required=False, help="json file with ignored R4 fields")
         parser.add_argument('--r4_id', type=int, required=False, help="r4 id for a single participant sync")    
+        parser.add_argument('--schema_cache', type=str, required=False, default='./schema_cache.json', help="json cache of the R4 and local metadata")
+        parser.add_argument('--no_schema_drift', action='store_true', help="only use the ignore file, skip the schema-drift stage")
+        parser.add_argument('--no_payload_validation', action='store_true', help="push the prepared data without checking it against the local metadata")
+        parser.add_argument('--reservation_file', type=str, required=False, default='../cuimc_id_reservation.txt', help='file shared by the syncs and batch uploads to reserve new cuimc_ids')
         args = parser.parse_args()
 
         # if token file is not provided, use the default token file
@@ -462,87 +669,20 @@ if __name__ == "__main__":
 
         api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
         ignore_fields = read_ignore_fields(ignore_file = ignore_file)
-        local_fields = read_redcap_fields_from_record(api_key_local, cu_local_endpoint)
-        
-        # 2025-01-13 CT: R4 giving server out of memory exception. Splitting up data export into 2 batches
-        # Get IDs from local REDCap before exporting R4 data so that we can determine the midpoint record_id to split up R4 data export
+        r4_fields = None
+        if not args.no_schema_drift:
+            # drifted fields are left out of the R4 export
+            drift_report = os.path.join(os.path.dirname(log_file), 'schema_drift_' + date_string + '.json')
+            ignore_fields = apply_schema_drift(api_key_r4, r4_api_endpoint, api_key_local, cu_local_endpoint, ignore_fields,
+                                               cache_file = args.schema_cache, report_file = drift_report)
+            r4_fields = r4_export_fields(cached_metadata(api_key_r4, r4_api_endpoint, cache_file = args.schema_cache), ignore_fields)
         local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, id_only=True)
         if not local_data:
             raise Exception("Error occurred during data export from local REDCap")
-        
-        if r4_id is None:
-            # Export data from R4 in batches of 500 records
-            record_ids = list(set([int(r['record_id']) for r in local_data if r['record_id'] != '']))
-            record_ids.sort()
-            record_id_splits = record_ids[::500]
-            
-            r4_data = list()
-            for i in range(len(record_id_splits) - 1):
-                filter_logic=f'[record_id] >= {record_id_splits[i]} and [record_id] < {record_id_splits[i+1]}'
-                logging.info(f'Exporting R4 data for participants: {filter_logic}')
-                new_data = export_data_from_redcap(api_key_r4,r4_api_endpoint, id_only=False, record_id=r4_id, filter_logic=filter_logic)
-                if not new_data:
-                    raise Exception("Error occurred during data export from R4")
-                logging.info(f'Received R4 data for {len(new_data)} records')
-                r4_data.extend(new_data)
-            filter_logic=f'[record_id] >= {record_id_splits[-1]}'
-            logging.info(f'Exporting R4 data for participants: {filter_logic}')
-            new_data = export_data_from_redcap(api_key_r4,r4_api_endpoint, id_only=False, record_id=r4_id, filter_logic=filter_logic)
-            if not new_data:
-                raise Exception("Error occurred during data export from R4")
-            logging.info(f'Received R4 data for {len(new_data)} records')
-            r4_data.extend(new_data)
-            logging.info(f'Received R4 data for a total of {len(r4_data)} records')
-        else:    
-            r4_data = export_data_from_redcap(api_key_r4,r4_api_endpoint, id_only=False, record_id=r4_id)
-        
-        # logging.debug("DEBUG r4_data: ")
-        # logging.debug([e for e in r4_data if e['record_id']=='18697'])
-        
-        if r4_data:
-            r4_data_df = indexing_r4_data(r4_data)
-            logging.debug("DEBUG r4_data_df: ")
-            logging.debug(r4_data_df[r4_data_df['record_id']=='18697'])
-            # local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, id_only=True)  # 2025-01-13 CT: retrieve local data before R4 so that we can get split R4 data export by record_id
-            local_data_df = indexing_local_data(local_data)
-            current_mapping = match_r4_local_data(r4_data_df, local_data_df)
-            logging.debug("DEBUG current_mapping: ")
-            logging.debug(current_mapping[current_mapping['record_id']=='18697'])
-            r4_data_df = prepare_local_list(current_mapping, r4_data, ignore_fields, local_fields, dt_string)
-            logging.debug("DEBUG push_to_local_list: ")
-            ####################### Define the batch size ########################
-            # reduce the batch size if there is a memory issue
-            # for batch size 5000, put php_value memory_limit "4G" in php.ini or 020-redcap.conf
-            # There is a very strange REDCap bug. 
-            # Using a batch approach will accidently split a single participant's multiple dictionaries into different batches. 
-            # In that case, later records (no matter if they are repeated instances or not) will always overwrite the ones in the previous batch. 
-            # That's why it works for one participant but not for all.
-            # To avoid this, make sure all the records for a single participant are in the same batch.
-            #######################################################################
-            batch_size = 500
-            cuimc_id_list = r4_data_df['cuimc_id'].unique().tolist()
-            logging.info(f"Number of unique cuimc_id: {len(cuimc_id_list)}")
-            # Iterate over the list in batches
-            for i in range(0, len(cuimc_id_list), batch_size):
-                logging.info(f"Index: {i}...Pushing data to local REDCap...")
-                start = i
-                end = min(i + batch_size, len(cuimc_id_list))
-                cuimc_id_batch = cuimc_id_list[start:end]
-                r4_data_batch_df = r4_data_df[r4_data_df['cuimc_id'].isin(cuimc_id_batch)]
-                batch = r4_data_batch_df.to_dict(orient='records')
-                logging.debug("DEBUG push_to_local_list: ")
-                # write to a test json
-                # with open('test.json', 'w') as f:
-                #     json.dump(batch, f)               
-                ### Important: 
-                # During the project setup some of R4 fields are based on survey equations, which won't sync correctly into local REDCap
-                # Therefore, we need to manually update those fields in local REDCap by removing the @CALC in those fields
-                # examples include adult_baseline_timestamp, child_baseline_timestamp,preror_adult_timestamp,preror_child_timestamp
-                status = push_data_to_local(api_key_local, cu_local_endpoint, batch)
-                if status == 1:
-                    logging.info(f"Index: {start} to {end}...Data pull from R4 is successful")
-                else:
-                    logging.error(f"Index: {start} to {end}...Data pull from R4 is not successful")
+        r4_data = export_r4_data(api_key_r4, r4_api_endpoint, [local_data], r4_id=r4_id, fields=r4_fields)
+        sync_project(api_key_local, cu_local_endpoint, api_key_r4, r4_api_endpoint, ignore_fields, local_data, r4_data, dt_string,
+                     report_prefix = os.path.join(os.path.dirname(log_file), ''), schema_cache = args.schema_cache,
+                     payload_validation = not args.no_payload_validation, reservation_file = args.reservation_file)
         logging.info('End pulling data from R4...')
     except Exception as e:
         # send email if error occurs
@@ -0,0 +1,452 @@
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Suppress the InsecureRequestWarning
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from datetime import datetime
+from email.message import EmailMessage
+import warnings
+# Suppress the FutureWarning
+warnings.filterwarnings("ignore", category=FutureWarning)
+import logging
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from data_pull_from_r4 import send_email, read_api_config, read_ignore_fields, read_redcap_fields_from_record, export_data_from_redcap, export_r4_data, r4_export_fields, sync_project
+from schema_drift import apply_schema_drift, cached_metadata, load_metadata
+from payload_validation import export_repeating_forms
+
+# R4 record ids are numbers, anything else in a trigger is rejected before it reaches a filter logic
+RECORD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def open_backlog(db_path : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the SQLite backlog of triggered R4 records
+    Input: db_path: path to the backlog database
+    Output: conn: sqlite3 connection to the backlog, shared by the receiver and the sync threads
+    '''
+    logging.info("Opening DET backlog " + db_path + "...")
+    db_dir = os.path.dirname(db_path)
+    if db_dir != '':
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS det_backlog (
+            record_id TEXT PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            events INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS det_dead_letter (
+            record_id TEXT PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            events INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            failed_at REAL NOT NULL
+        )''')
+    conn.commit()
+    return conn
+
+def enqueue_record(conn : sqlite3.Connection, lock : threading.Lock, record_id : str, now : float = None):
+    '''
+    Add a triggered record, repeated triggers of a record are coalesced into one entry
+    Input: conn: sqlite3 connection to the backlog
+           lock: lock guarding the connection
+           record_id: the R4 record id
+           now: time of the trigger, time.time() if not provided
+    '''
+    if now is None:
+        now = time.time()
+    with lock:
+        conn.execute('''
+            INSERT INTO det_backlog (record_id, first_seen, last_seen, events) VALUES (?, ?, ?, 1)
+            ON CONFLICT (record_id) DO UPDATE SET last_seen = excluded.last_seen, events = events + 1''', (record_id, now, now))
+        conn.commit()
+
+def due_records(conn : sqlite3.Connection, lock : threading.Lock, debounce : float, max_wait : float, max_batch : int, max_attempts : int,
+                now : float = None) -> list:
+    '''
+    Records ready to sync: quiet for debounce seconds, or waiting for max_wait seconds while still being edited
+    Input: conn: sqlite3 connection to the backlog
+           lock: lock guarding the connection
+           debounce: seconds without a new trigger before a record is synced
+           max_wait: maximum seconds between the first trigger and the sync
+           max_batch: maximum number of records per targeted sync
+           max_attempts: records that failed max_attempts times are left out
+           now: current time, time.time() if not provided
+    Output: record_ids: a list of R4 record ids, oldest first
+    '''
+    if now is None:
+        now = time.time()
+    with lock:
+        rows = conn.execute('''
+            SELECT record_id FROM det_backlog WHERE attempts < ? AND (last_seen <= ? OR first_seen <= ?)
+            ORDER BY first_seen LIMIT ?''', (max_attempts, now - debounce, now - max_wait, max_batch)).fetchall()
+    return [row[0] for row in rows]
+
+def backlog_stats(conn : sqlite3.Connection, lock : threading.Lock) -> tuple:
+    '''
+    Number of records in the backlog and in the dead-letter table
+    '''
+    with lock:
+        backlog_size = conn.execute('SELECT COUNT(*) FROM det_backlog').fetchone()[0]
+        dead_letter_size = conn.execute('SELECT COUNT(*) FROM det_dead_letter').fetchone()[0]
+    return backlog_size, dead_letter_size
+
+def backlog_records(conn : sqlite3.Connection, lock : threading.Lock) -> list:
+    with lock:
+        return [row[0] for row in conn.execute('SELECT record_id FROM det_backlog').fetchall()]
+
+def mark_synced(conn : sqlite3.Connection, lock : threading.Lock, record_ids : list, started_at : float):
+    '''
+    Remove synced records, unless they were triggered again after the sync started
+    Input: record_ids: the synced R4 record ids
+           started_at: time the sync started
+    '''
+    with lock:
+        conn.executemany('DELETE FROM det_backlog WHERE record_id = ? AND last_seen < ?', [(record_id, started_at) for record_id in record_ids])
+        conn.commit()
+
+def mark_failed(conn : sqlite3.Connection, lock : threading.Lock, record_ids : list, max_attempts : int) -> list:
+    '''
+    Count a failed import of the records, records that failed max_attempts times move to the dead-letter table
+    Input: record_ids: the R4 record ids that failed to import
+           max_attempts: failed imports of a record before it is dead-lettered
+    Output: dead_record_ids: the records moved to the dead-letter table
+    '''
+    with lock:
+        conn.executemany('UPDATE det_backlog SET attempts = attempts + 1 WHERE record_id = ?', [(record_id,) for record_id in record_ids])
+        dead_record_ids = [row[0] for row in conn.execute('SELECT record_id FROM det_backlog WHERE attempts >= ?', (max_attempts,)).fetchall()]
+        conn.execute('''
+            INSERT OR REPLACE INTO det_dead_letter (record_id, first_seen, last_seen, events, attempts, failed_at)
+            SELECT record_id, first_seen, last_seen, events, attempts, ? FROM det_backlog WHERE attempts >= ?''', (time.time(), max_attempts))
+        conn.execute('DELETE FROM det_backlog WHERE attempts >= ?', (max_attempts,))
+        conn.commit()
+    return dead_record_ids
+
+def send_alert(body : str):
+    '''
+    Email the sync service maintainers
+    '''
+    SMTP_HOST = "nova.cpmc.columbia.edu"
+    SMTP_PORT = 587
+    FROM_ADDR = "emerge_study@cumc.columbia.edu"
+    msg = EmailMessage()
+    msg['From'] = FROM_ADDR
+    msg['To'] = 'cl3720@cumc.columbia.edu,ct2865@cumc.columbia.edu'
+    msg['Subject'] = '[Error] eMERGE Columbia Data Sync Service'
+    msg.add_alternative(body,subtype='html')
+    send_email(msg, SMTP_HOST, SMTP_PORT)
+
+def load_sync_context(config : dict, refresh : bool = False) -> dict:
+    '''
+    Ignore list, R4 export fields, local metadata and local ids shared by the targeted syncs
+    They are loaded once per context_ttl seconds instead of once per batch, the drift stage runs on each load.
+    Input: config: see sync_records
+           refresh: whether to load the context even if it is not expired
+    Output: context: a dict kept in config['context']
+    '''
+    context = config.get('context')
+    if not refresh and context is not None and time.time() - context['loaded_at'] < config['context_ttl']:
+        return context
+    logging.info('Loading the sync context...')
+    api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = config['api_config']
+    loaded_at = time.time()
+    ignore_fields = config['ignore_fields']
+    r4_fields = None
+    if config['schema_drift']:
+        ignore_fields = apply_schema_drift(api_key_r4, r4_api_endpoint, api_key_local, cu_local_endpoint, ignore_fields, cache_file = config['schema_cache'],
+                                           report_file = config['report_prefix'] + 'schema_drift_' + datetime.now().strftime("%Y%m%d") + '.json')
+        r4_fields = r4_export_fields(cached_metadata(api_key_r4, r4_api_endpoint, cache_file = config['schema_cache']), ignore_fields)
+    local_data = export_data_from_redcap(api_key_local, cu_local_endpoint, id_only=True)
+    if not local_data:
+        raise Exception("Error occurred during data export from local REDCap")
+    context = {
+        'loaded_at': loaded_at,
+        'ignore_fields': ignore_fields,
+        'r4_fields': r4_fields,
+        'local_fields': read_redcap_fields_from_record(api_key_local, cu_local_endpoint),
+        'meta_local_json': load_metadata(api_key_local, cu_local_endpoint, cache_file = config['schema_cache'])[0],
+        'repeating_forms': export_repeating_forms(api_key_local, cu_local_endpoint),
+        'local_data': local_data
+    }
+    config['context'] = context
+    return context
+
+def refresh_local_ids(config : dict, context : dict, record_ids : list):
+    '''
+    Update the cached local ids of the given R4 records before a targeted sync
+    Records already in local are exported by record_id. A record new to local is matched on names and
+    dates of birth against all local records, so the full id export is loaded again in that case.
+    Input: config: see sync_records
+           context: output of load_sync_context, updated in place
+           record_ids: a list of R4 record ids
+    '''
+    api_key_local, _, cu_local_endpoint, _ = config['api_config']
+    filter_logic = ' or '.join([f"[record_id] = '{record_id}'" for record_id in record_ids])
+    local_rows = export_data_from_redcap(api_key_local, cu_local_endpoint, id_only=True, filter_logic=filter_logic)
+    if local_rows == {}:
+        raise Exception("Error occurred during data export from local REDCap")
+    if set(record_ids) - set([r['record_id'] for r in local_rows]):
+        local_data = export_data_from_redcap(api_key_local, cu_local_endpoint, id_only=True)
+        if not local_data:
+            raise Exception("Error occurred during data export from local REDCap")
+        context['local_data'] = local_data
+        return
+    cuimc_ids = set([r['cuimc_id'] for r in local_rows])
+    context['local_data'] = [r for r in context['local_data'] if r['cuimc_id'] not in cuimc_ids] + local_rows
+
+def sync_records(config : dict, record_ids : list) -> dict:
+    '''
+    Targeted sync of the given R4 records, or of all records if record_ids is None
+    Input: config: api tokens, endpoints, ignore fields, report settings, context_ttl and reservation_file of the receiver
+           record_ids: a list of R4 record ids
+    Output: summary: output of sync_project, failed_r4_ids lists the records whose import failed
+    '''
+    api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = config['api_config']
+    dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    if record_ids is None:
+        context = load_sync_context(config, refresh=True)
+        r4_data = export_r4_data(api_key_r4, r4_api_endpoint, [context['local_data']], fields=context['r4_fields'])
+    else:
+        context = load_sync_context(config)
+        refresh_local_ids(config, context, record_ids)
+        filter_logic = ' or '.join([f"[record_id] = '{record_id}'" for record_id in record_ids])
+        r4_data = export_data_from_redcap(api_key_r4, r4_api_endpoint, id_only=False, filter_logic=filter_logic, fields=context['r4_fields'])
+        if r4_data == {}:
+            raise Exception("Error occurred during data export from R4")
+    return sync_project(api_key_local, cu_local_endpoint, api_key_r4, r4_api_endpoint, context['ignore_fields'], context['local_data'], r4_data, dt_string,
+                        report_prefix = config['report_prefix'], schema_cache = config['schema_cache'], payload_validation = True,
+                        reservation_file = config['reservation_file'], local_fields = context['local_fields'],
+                        meta_local_json = context['meta_local_json'], repeating_forms = context['repeating_forms'])
+
+def dead_letter_alert(dead_record_ids : list, max_attempts : int):
+    if len(dead_record_ids) > 0:
+        logging.error(f"R4 records failed to import {max_attempts} times and were moved to the dead-letter table: " + ','.join(dead_record_ids))
+        send_alert(f"Data Entry Trigger sync: R4 records {', '.join(dead_record_ids)} failed to import {max_attempts} times. "
+                   "They are in the det_dead_letter table and are left to the nightly full sync.")
+
+def sync_batch(conn : sqlite3.Connection, lock : threading.Lock, config : dict, record_ids : list, max_attempts : int) -> int:
+    '''
+    Targeted sync of a batch, a failed import is split in half and each half is retried
+    so that a record REDCap rejects does not hold back the rest of its batch.
+    Export errors are not counted as failed imports, the records stay in the backlog for the next round.
+    Input: conn: sqlite3 connection to the backlog
+           lock: lock guarding the connection
+           config: see sync_records
+           record_ids: the R4 record ids to sync
+           max_attempts: see mark_failed
+    Output: n: number of records synced
+    '''
+    started_at = time.time()
+    try:
+        summary = sync_records(config, record_ids)
+    except Exception as e:
+        logging.error('Error occured in syncing triggered records. ' + str(e))
+        return 0
+    failed = set(summary['failed_r4_ids'])
+    failed_record_ids = [record_id for record_id in record_ids if record_id in failed]
+    mark_synced(conn, lock, [record_id for record_id in record_ids if record_id not in failed], started_at)
+    n = len(record_ids) - len(failed_record_ids)
+    if len(failed_record_ids) == 1:
+        dead_letter_alert(mark_failed(conn, lock, failed_record_ids, max_attempts), max_attempts)
+    elif len(failed_record_ids) > 1:
+        half = len(failed_record_ids) // 2
+        logging.warning(f"Import of {len(failed_record_ids)} triggered records failed, retrying in two halves")
+        n = n + sync_batch(conn, lock, config, failed_record_ids[:half], max_attempts)
+        n = n + sync_batch(conn, lock, config, failed_record_ids[half:], max_attempts)
+    return n
+
+def process_backlog(conn : sqlite3.Connection, lock : threading.Lock, config : dict, debounce : float = 30, max_wait : float = 300,
+                    max_batch : int = 100, max_attempts : int = 3, max_backlog : int = 1000, full_sync_retry : float = 3600) -> int:
+    '''
+    Sync the due records once
+    The receiver falls back to a full sync when the backlog outgrows targeted syncs, e.g. after an R4 outage
+    or a bulk data change. Records whose import fails max_attempts times are dead-lettered with an alert.
+    Input: conn: sqlite3 connection to the backlog
+           lock: lock guarding the connection
+           config: see sync_records
+           debounce, max_wait, max_batch: see due_records
+           max_attempts: see mark_failed
+           max_backlog: backlog size before the full sync fallback
+           full_sync_retry: seconds before a failed full sync is tried again, targeted syncs go on meanwhile
+    Output: n: number of records synced, -1 for a full sync
+    '''
+    backlog_size, _ = backlog_stats(conn, lock)
+    if backlog_size == 0:
+        return 0
+    if backlog_size > max_backlog and time.time() >= config.get('next_full_sync', 0):
+        logging.warning(f"Falling back to a full sync, {backlog_size} records in the backlog")
+        record_ids = backlog_records(conn, lock)
+        started_at = time.time()
+        try:
+            summary = sync_records(config, None)
+        except Exception as e:
+            logging.error('Error occured in the full sync. ' + str(e))
+            config['next_full_sync'] = time.time() + full_sync_retry
+            return 0
+        # records of the failed batches stay in the backlog, the others are up to date
+        failed = set(summary['failed_r4_ids'])
+        mark_synced(conn, lock, [record_id for record_id in record_ids if record_id not in failed], started_at)
+        failed_record_ids = [record_id for record_id in record_ids if record_id in failed]
+        if len(failed_record_ids) > 0:
+            logging.error(f"Full sync: {summary['failed_batches']} batches failed to import, {len(failed_record_ids)} triggered records stay in the backlog")
+            config['next_full_sync'] = time.time() + full_sync_retry
+            dead_letter_alert(mark_failed(conn, lock, failed_record_ids, max_attempts), max_attempts)
+        return -1
+    record_ids = due_records(conn, lock, debounce, max_wait, max_batch, max_attempts)
+    if len(record_ids) == 0:
+        return 0
+    logging.info(f"Syncing {len(record_ids)} triggered records: " + ','.join(record_ids))
+    started_at = time.time()
+    n = sync_batch(conn, lock, config, record_ids, max_attempts)
+    logging.info(f"Synced {n} of {len(record_ids)} triggered records in {time.time() - started_at:.1f}s")
+    return n
+
+def sync_loop(conn : sqlite3.Connection, lock : threading.Lock, config : dict, poll_interval : float = 5, **kwargs):
+    '''
+    Process the backlog every poll_interval seconds, errors are logged and retried on the next round
+    '''
+    while True:
+        try:
+            process_backlog(conn, lock, config, **kwargs)
+        except Exception as e:
+            logging.error('Error occured in processing the DET backlog. ' + str(e))
+        time.sleep(poll_interval)
+
+class DETHandler(BaseHTTPRequestHandler):
+    '''
+    REDCap Data Entry Trigger POSTs (project_id, record, instrument, ...) are queued and answered right away
+    '''
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self.reply(400)
+        if length < 0:
+            return self.reply(400)
+        if length > 65536:
+            return self.reply(413)
+        body = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8', 'replace'))
+        event = dict([(k, v[0]) for k, v in body.items()])
+        record_id = event.get('record', '')
+        if self.server.project_id is not None and event.get('project_id') != self.server.project_id:
+            logging.warning('Data Entry Trigger from an unexpected project: ' + str(event.get('project_id')))
+            return self.reply(403)
+        if not RECORD_ID_PATTERN.match(record_id):
+            logging.warning('Data Entry Trigger without a valid record: ' + record_id[:64])
+            return self.reply(400)
+        enqueue_record(self.server.backlog, self.server.backlog_lock, record_id)
+        logging.debug(f"Data Entry Trigger for record {record_id}, instrument {event.get('instrument', '')}")
+        self.reply(200)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != '/health':
+            return self.reply(404)
+        backlog_size, dead_letter_size = backlog_stats(self.server.backlog, self.server.backlog_lock)
+        content = ('{"backlog": ' + str(backlog_size) + ', "dead_letter": ' + str(dead_letter_size) + '}').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def start_receiver(conn : sqlite3.Connection, lock : threading.Lock, host : str = '127.0.0.1', port : int = 8766, project_id : str = None) -> ThreadingHTTPServer:
+    '''
+    Start the Data Entry Trigger receiver in a background thread
+    Input: conn: sqlite3 connection to the backlog
+           lock: lock guarding the connection
+           host: address to listen on, local only by default (put it behind the web server that REDCap posts to)
+           port: port to listen on, 0 for any free port
+           project_id: the R4 project id, triggers of other projects are rejected if provided
+    Output: server: the running server
+    '''
+    server = ThreadingHTTPServer((host, port), DETHandler)
+    server.backlog = conn
+    server.backlog_lock = lock
+    server.project_id = project_id
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"DET receiver listening on {host}:{server.server_address[1]}")
+    return server
+
+
+if __name__ == "__main__":
+    try:
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--log_folder', type=str, required=False, help="folder to write log",)
+        parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
+        parser.add_argument('--ignore', type=str, required=False, help="json file with ignored R4 fields")
+        parser.add_argument('--backlog', type=str, required=False, default='./det_backlog.db', help="sqlite backlog of triggered records")
+        parser.add_argument('--schema_cache', type=str, required=False, default='./schema_cache.json', help="json cache of the R4 and local metadata")
+        parser.add_argument('--no_schema_drift', action='store_true', help="only use the ignore file, skip the schema-drift stage")
+        parser.add_argument('--host', type=str, required=False, default='127.0.0.1', help='address to listen on')
+        parser.add_argument('--port', type=int, required=False, default=8766, help='port to listen on')
+        parser.add_argument('--project_id', type=str, required=False, help='R4 project id, triggers of other projects are rejected')
+        parser.add_argument('--debounce', type=float, required=False, default=30, help='seconds without a new trigger before a record is synced')
+        parser.add_argument('--max_wait', type=float, required=False, default=300, help='maximum seconds between the first trigger of a record and its sync')
+        parser.add_argument('--max_batch', type=int, required=False, default=100, help='maximum number of records per targeted sync')
+        parser.add_argument('--max_attempts', type=int, required=False, default=3, help='failed imports of a record before it is dead-lettered')
+        parser.add_argument('--max_backlog', type=int, required=False, default=1000, help='backlog size before falling back to a full sync')
+        parser.add_argument('--full_sync_retry', type=float, required=False, default=3600, help='seconds before a failed full sync is tried again')
+        parser.add_argument('--context_ttl', type=float, required=False, default=3600, help='seconds before the metadata, ignore list and local ids are loaded again')
+        parser.add_argument('--reservation_file', type=str, required=False, default='../cuimc_id_reservation.txt', help='file shared by the syncs and batch uploads to reserve new cuimc_ids')
+        parser.add_argument('--poll_interval', type=float, required=False, default=5, help='seconds between two backlog checks')
+        args = parser.parse_args()
+
+        # if token file is not provided, use the default token file
+        if args.token is None:
+            token_file = '../api_tokens.json'
+        else:
+            token_file = args.token
+
+        # if ignore file is not provided, use the default ignore file
+        if args.ignore is None:
+            ignore_file = './ignore_R4_fields.json'
+        else:
+            ignore_file = args.ignore
+
+        # if log folder is not provided, use the default log folder
+        if args.log_folder is None:
+            log_folder = 'logs'
+        else:
+            log_folder = args.log_folder
+
+        # set up logging.
+        logging.basicConfig(filename=os.path.join(log_folder, 'det_receiver.log'), format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+        logging.info('Start DET receiver...')
+        config = {
+            'api_config': read_api_config(config_file = token_file),
+            'ignore_fields': read_ignore_fields(ignore_file = ignore_file),
+            'report_prefix': os.path.join(log_folder, 'det_'),
+            'schema_cache': args.schema_cache,
+            'schema_drift': not args.no_schema_drift,
+            'context_ttl': args.context_ttl,
+            'reservation_file': args.reservation_file
+        }
+        backlog = open_backlog(args.backlog)
+        backlog_lock = threading.Lock()
+        server = start_receiver(backlog, backlog_lock, host=args.host, port=args.port, project_id=args.project_id)
+        sync_loop(backlog, backlog_lock, config, poll_interval=args.poll_interval, debounce=args.debounce, max_wait=args.max_wait,
+                  max_batch=args.max_batch, max_attempts=args.max_attempts, max_backlog=args.max_backlog,
+                  full_sync_retry=args.full_sync_retry)
+    except Exception as e:
+        # send email if error occurs
+        logging.error('Error occured in DET receiver. ' + str(e))
+        send_alert('Error occured in DET receiver. ' + str(e))
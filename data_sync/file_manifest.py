@@ -0,0 +1,192 @@
+import sqlite3
+import logging
+import os
+from datetime import datetime
+
+def open_manifest(db_path : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the SQLite manifest of the content-addressed file_repo
+    Input: db_path: path to the manifest database
+    Output: conn: sqlite3 connection to the manifest
+    '''
+    logging.info("Opening file manifest " + db_path + "...")
+    db_dir = os.path.dirname(db_path)
+    if db_dir != '':
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS file_manifest (
+            record_id TEXT NOT NULL,
+            field_name TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (record_id, field_name)
+        )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS file_manifest_sha256 ON file_manifest (sha256)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS file_push (
+            cuimc_id TEXT NOT NULL,
+            field_name TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            pushed_at TEXT NOT NULL,
+            PRIMARY KEY (cuimc_id, field_name)
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )''')
+    conn.commit()
+    return conn
+
+def blob_path(file_repo : str, sha256 : str) -> str:
+    '''
+    Path of a blob in the content-addressed file_repo
+    Input: file_repo: root folder of the file repo
+           sha256: hex digest of the file content
+    Output: path: file_repo/blobs/<first 2 hex>/<sha256>
+    '''
+    return os.path.join(file_repo, 'blobs', sha256[:2], sha256)
+
+def store_blob(file_repo : str, tmp_path : str, sha256 : str) -> str:
+    '''
+    Move a downloaded temp file into the file_repo under its content hash
+    If the same content is already stored, the temp file is dropped.
+    Input: file_repo: root folder of the file repo
+           tmp_path: path of the fully written temp file
+           sha256: hex digest of the file content
+    Output: path: path of the blob
+    '''
+    path = blob_path(file_repo, sha256)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return path
+
+def upsert_manifest(conn : sqlite3.Connection, record_id : str, field_name : str, file_name : str, size : int, sha256 : str, fetched_at : str = None):
+    '''
+    Insert or replace the manifest entry of a (record_id, field_name)
+    Input: conn: sqlite3 connection to the manifest
+           record_id: the R4 record id
+           field_name: the file upload field
+           file_name: the file name reported by REDCap
+           size: number of bytes
+           sha256: hex digest of the file content
+           fetched_at: time of download, now if not provided
+    '''
+    if fetched_at is None:
+        fetched_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute('''
+        INSERT OR REPLACE INTO file_manifest (record_id, field_name, file_name, size, sha256, fetched_at)
+        VALUES (?, ?, ?, ?, ?, ?)''', (str(record_id), field_name, file_name, size, sha256, fetched_at))
+    conn.commit()
+
+def lookup_manifest(conn : sqlite3.Connection, record_id : str, field_name : str) -> dict:
+    '''
+    Look up the manifest entry of a (record_id, field_name)
+    Input: conn: sqlite3 connection to the manifest
+           record_id: the R4 record id
+           field_name: the file upload field
+    Output: entry: a dict of the manifest row, None if not found
+    '''
+    row = conn.execute('''
+        SELECT record_id, field_name, file_name, size, sha256, fetched_at
+        FROM file_manifest WHERE record_id = ? AND field_name = ?''', (str(record_id), field_name)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(['record_id', 'field_name', 'file_name', 'size', 'sha256', 'fetched_at'], row))
+
+def find_missing_files(conn : sqlite3.Connection, file_list : list, file_repo : str = None) -> list:
+    '''
+    Find the files that are not in the manifest, whose REDCap file name or size changed, or whose blob is gone
+    The exported list is loaded into a temp table and joined against the manifest, the size
+    is only compared when the entry has one. The record export only reports the file name,
+    so a file re-uploaded under the same name is not found here, it is picked up by
+    --incremental (records updated after the watermark) or --refresh.
+    Input: conn: sqlite3 connection to the manifest
+           file_list: a list of dict with record_id, field, file_name and optionally size
+           file_repo: root folder of the file repo, if provided a manifest entry without its blob is missing
+    Output: missing_list: the entries of file_list to be downloaded
+    '''
+    conn.execute('DROP TABLE IF EXISTS temp.exported_files')
+    conn.execute('CREATE TEMP TABLE exported_files (pos INTEGER PRIMARY KEY, record_id TEXT, field_name TEXT, file_name TEXT, size INTEGER)')
+    conn.executemany('INSERT INTO temp.exported_files VALUES (?, ?, ?, ?, ?)',
+                     [(i, str(f['record_id']), f['field'], f['file_name'], f.get('size')) for i, f in enumerate(file_list)])
+    rows = conn.execute('''
+        SELECT e.pos, m.record_id IS NULL OR m.file_name != e.file_name OR (e.size IS NOT NULL AND m.size != e.size), m.sha256
+        FROM temp.exported_files e
+        LEFT JOIN file_manifest m ON m.record_id = e.record_id AND m.field_name = e.field_name
+        ORDER BY e.pos''').fetchall()
+    conn.execute('DROP TABLE temp.exported_files')
+    missing_list = []
+    n_lost = 0
+    for pos, changed, sha256 in rows:
+        if changed:
+            missing_list.append(file_list[pos])
+        elif file_repo is not None and not os.path.exists(blob_path(file_repo, sha256)):
+            n_lost = n_lost + 1
+            missing_list.append(file_list[pos])
+    if n_lost > 0:
+        logging.warning(f"{n_lost} files in the manifest have no blob in {file_repo}, they are downloaded again")
+    return missing_list
+
+def find_pending_pushes(conn : sqlite3.Connection, mapping : list) -> list:
+    '''
+    Find the pulled files not yet imported into the local record with the same content
+    Input: conn: sqlite3 connection to the manifest
+           mapping: a list of (record_id, cuimc_id) pairs of the current R4 to local mapping
+    Output: pending_list: a list of dict with cuimc_id, record_id, field, file_name and sha256
+    '''
+    conn.execute('DROP TABLE IF EXISTS temp.id_mapping')
+    conn.execute('CREATE TEMP TABLE id_mapping (record_id TEXT, cuimc_id TEXT)')
+    conn.executemany('INSERT INTO temp.id_mapping VALUES (?, ?)', [(str(r), str(c)) for r, c in mapping])
+    rows = conn.execute('''
+        SELECT im.cuimc_id, m.record_id, m.field_name, m.file_name, m.sha256 FROM file_manifest m
+        JOIN temp.id_mapping im ON im.record_id = m.record_id
+        LEFT JOIN file_push p ON p.cuimc_id = im.cuimc_id AND p.field_name = m.field_name
+        WHERE p.sha256 IS NULL OR p.sha256 != m.sha256
+        ORDER BY CAST(im.cuimc_id AS INTEGER), m.field_name''').fetchall()
+    conn.execute('DROP TABLE temp.id_mapping')
+    return [dict(zip(['cuimc_id', 'record_id', 'field', 'file_name', 'sha256'], row)) for row in rows]
+
+def record_push(conn : sqlite3.Connection, cuimc_id : str, field_name : str, sha256 : str, pushed_at : str = None):
+    '''
+    Record that a blob has been imported into a local record
+    Input: conn: sqlite3 connection to the manifest
+           cuimc_id: the local record id
+           field_name: the file upload field
+           sha256: hex digest of the imported file
+           pushed_at: time of import, now if not provided
+    '''
+    if pushed_at is None:
+        pushed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute('''
+        INSERT OR REPLACE INTO file_push (cuimc_id, field_name, sha256, pushed_at)
+        VALUES (?, ?, ?, ?)''', (str(cuimc_id), field_name, sha256, pushed_at))
+    conn.commit()
+
+def get_sync_state(conn : sqlite3.Connection, key : str) -> str:
+    '''
+    Read a value (e.g. a watermark) stored with the manifest
+    Input: conn: sqlite3 connection to the manifest
+           key: name of the state
+    Output: value: the stored value, None if not set
+    '''
+    row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def set_sync_state(conn : sqlite3.Connection, key : str, value : str):
+    '''
+    Store a value (e.g. a watermark) with the manifest
+    Input: conn: sqlite3 connection to the manifest
+           key: name of the state
+           value: value to store
+    '''
+    conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+    conn.commit()
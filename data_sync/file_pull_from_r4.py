@@ -14,62 +14,217 @@ import os
 import smtplib
 from email.message import EmailMessage
 import sys
+import time
+import tempfile
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from data_pull_from_r4 import read_api_config
+from file_manifest import open_manifest, store_blob, upsert_manifest, find_missing_files, get_sync_state, set_sync_state
 
+# file upload fields to be pulled from R4
+FILE_FIELDS = ["metree_import_json_file","gira_pdf"]
+# stream downloads to disk in 1MB chunks so that large GIRA PDFs are not held in memory
+CHUNK_SIZE = 1024 * 1024
 
-
-def export_file_from_redcap(api_key : str, api_endpoint : str, record_id = None) -> list:
-    file_fields = ["metree_import_json_file","gira_pdf"]
+def export_file_names(api_key : str, api_endpoint : str, file_fields : list = FILE_FIELDS, record_id = None) -> list:
+    '''
+    Export the file names stored in the file upload fields
+    record_id, last_update_timestamp and all file fields are exported in one request.
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+           file_fields: a list of file upload fields
+           record_id: the record id of the participant if provided
+    Output: file_list: a list of dict with record_id, field, file_name and last_update_timestamp for non-empty file fields
+    '''
+    logging.info(f"Exporting file names from {api_endpoint}...")
+    data = {
+        'token': api_key,
+        'content': 'record',
+        'action': 'export',
+        'format': 'json',
+        'type': 'flat',
+        'csvDelimiter': '',
+        'fields[0]': 'record_id',
+        'fields[1]': 'last_update_timestamp',
+        'rawOrLabel': 'raw',
+        'rawOrLabelHeaders': 'raw',
+        'exportCheckboxLabel': 'false',
+        'exportSurveyFields': 'false',
+        'exportDataAccessGroups': 'false',
+        'returnFormat': 'json'
+        }
+    for i, ff in enumerate(file_fields):
+        data['fields[' + str(i + 2) + ']'] = ff
+    if record_id is not None:
+        data['records[0]'] = record_id
+    r = requests.post(api_endpoint,data=data)
+    if r.status_code != 200:
+        logging.error('Error occured in exporting file names from ' + api_endpoint)
+        logging.error('HTTP Status: ' + str(r.status_code))
+        logging.error(r.content)
+        raise Exception('Error occured in exporting file names')
+    return_name_list = r.json()
+    # last_update_timestamp is only filled in the non-repeating row of a record
+    last_update = {}
+    for return_name in return_name_list:
+        if return_name.get('last_update_timestamp', '') != '':
+            last_update[return_name['record_id']] = return_name['last_update_timestamp']
+    file_list = []
+    for return_name in return_name_list:
+        logging.debug('Return name: {}'.format(return_name))
+        for ff in file_fields:
+            if return_name.get(ff, '') != '':
+                file_list.append({'record_id': return_name['record_id'], 'field': ff, 'file_name': return_name[ff],
+                                  'last_update_timestamp': last_update.get(return_name['record_id'], '')})
     for ff in file_fields:
-        # get file name 
-        data = {
-            'token': api_key,
-            'content': 'record',
-            'action': 'export',
-            'format': 'json',
-            'type': 'flat',
-            'csvDelimiter': '',
-            'fields[0]': 'record_id',
-            'fields[1]': ff,
-            'rawOrLabel': 'raw',
-            'rawOrLabelHeaders': 'raw',
-            'exportCheckboxLabel': 'false',
-            'exportSurveyFields': 'false',
-            'exportDataAccessGroups': 'false',
-            'returnFormat': 'json'
-            }
-        if record_id is not None:
-            data['records[0]'] = record_id
-        r = requests.post(api_endpoint,data=data)
-        if r.json() != []:
-            return_name_list = r.json()
-            for return_name in return_name_list:
-                logging.debug('Return name: {}'.format(return_name))
-                record_id = return_name['record_id']
-                file_name = return_name[ff]
-                if file_name != '':
-                    # whether it is exist in the file_repo
-                    if os.path.exists(os.path.join('file_repo', file_name)):
-                        logging.debug('File {} for record {} is already downloaded.'.format(file_name, record_id))
-                    else:
-                        # download the file
-                        data = {
-                            'token': api_key,
-                            'content': 'file',
-                            'action': 'export',
-                            'record': record_id,
-                            'field': ff,
-                            'event': '',
-                            'returnFormat': 'json'
-                            }
-                        r = requests.post(api_endpoint,data=data)
-                        file_bytes = r.content
-                        with open(os.path.join('file_repo', file_name), 'wb') as f:
-                            f.write(file_bytes)
-                        logging.debug('File {} for record {} is downloaded.'.format(file_name, record_id))
-                        
-    return return_name_list       
-       
+        logging.info(f"Number of files in {ff}: {len([f for f in file_list if f['field'] == ff])}")
+    return file_list
+
+def download_file(session : requests.Session, api_key : str, api_endpoint : str, record_id : str, field : str, file_repo : str, chunk_size : int = CHUNK_SIZE) -> tuple:
+    '''
+    Stream a single file from REDCap into the content-addressed file_repo
+    The file is written into a temp file under file_repo/tmp while it is hashed,
+    and renamed to its blob path once complete, so that an interrupted download
+    never leaves a partial blob.
+    Input: session: requests session shared by the download workers
+           api_key: API token
+           api_endpoint: api endpoint url
+           record_id: the record id of the participant
+           field: the file upload field
+           file_repo: root folder of the file repo
+           chunk_size: number of bytes per streamed chunk
+    Output: n_bytes: number of bytes written
+            sha256: hex digest of the file content
+    '''
+    data = {
+        'token': api_key,
+        'content': 'file',
+        'action': 'export',
+        'record': record_id,
+        'field': field,
+        'event': '',
+        'returnFormat': 'json'
+        }
+    tmp_dir = os.path.join(file_repo, 'tmp')
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix=str(record_id) + '.' + field + '.', suffix='.part')
+    n_bytes = 0
+    h = hashlib.sha256()
+    try:
+        # the file object owns fd from here, it is closed on any error below
+        with os.fdopen(fd, 'wb') as f:
+            with session.post(api_endpoint, data=data, stream=True) as r:
+                if r.status_code != 200:
+                    raise Exception('HTTP Status: ' + str(r.status_code) + '. ' + str(r.content))
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+                    n_bytes = n_bytes + len(chunk)
+        sha256 = h.hexdigest()
+        store_blob(file_repo, tmp_path, sha256)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return n_bytes, sha256
+
+def sync_files(api_key : str, api_endpoint : str, file_list : list, file_repo : str = 'file_repo', manifest_db : str = None, max_workers : int = 4, chunk_size : int = CHUNK_SIZE, refresh : bool = False, since : str = None) -> dict:
+    '''
+    Download the files missing from the manifest with a bounded pool of workers
+    Files are stored by content hash under file_repo/blobs, and the manifest maps
+    (record_id, field) to the blob. A file is downloaded if the (record_id, field)
+    is not in the manifest, its REDCap file name changed, its blob is missing from
+    file_repo, or, when since is given, its record was updated after since.
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+           file_list: a list of dict with record_id, field and file_name
+           file_repo: root folder of the file repo
+           manifest_db: path to the manifest database, file_repo/manifest.db if not provided
+           max_workers: maximum number of concurrent downloads
+           chunk_size: number of bytes per streamed chunk
+           refresh: re-download every file in file_list regardless of the manifest
+           since: last_update_timestamp watermark, records updated after it are re-downloaded
+    Output: summary: a dict with number of files, bytes and failures, and elapsed seconds
+    '''
+    os.makedirs(os.path.join(file_repo, 'tmp'), exist_ok=True)
+    if manifest_db is None:
+        manifest_db = os.path.join(file_repo, 'manifest.db')
+    conn = open_manifest(manifest_db)
+    if refresh:
+        pending = file_list
+    else:
+        pending = find_missing_files(conn, file_list, file_repo=file_repo)
+        if since is not None:
+            # same file name can still be a re-uploaded file
+            pending_keys = set([(f['record_id'], f['field']) for f in pending])
+            updated = [f for f in file_list if f['last_update_timestamp'] > since and (f['record_id'], f['field']) not in pending_keys]
+            logging.info(f"{len(updated)} files with unchanged name in records updated after {since}")
+            pending = pending + updated
+    logging.info(f"Downloading {len(pending)} of {len(file_list)} files with {max_workers} workers...")
+
+    summary = {'files': 0, 'bytes': 0, 'failed': 0, 'seconds': 0.0}
+    start = time.time()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_file, session, api_key, api_endpoint, f['record_id'], f['field'], file_repo, chunk_size): f for f in pending}
+        for future in as_completed(futures):
+            f = futures[future]
+            try:
+                n_bytes, sha256 = future.result()
+                # manifest is only written from this thread
+                upsert_manifest(conn, f['record_id'], f['field'], f['file_name'], n_bytes, sha256)
+                summary['files'] = summary['files'] + 1
+                summary['bytes'] = summary['bytes'] + n_bytes
+                logging.debug('File {} for record {} is downloaded as {}.'.format(f['file_name'], f['record_id'], sha256))
+            except Exception as e:
+                summary['failed'] = summary['failed'] + 1
+                logging.error('Error occured in downloading {} for record {}. {}'.format(f['file_name'], f['record_id'], str(e)))
+    session.close()
+    conn.close()
+    summary['seconds'] = time.time() - start
+    elapsed = max(summary['seconds'], 1e-6)
+    logging.info(f"Downloaded {summary['files']} files ({summary['bytes']} bytes) in {summary['seconds']:.1f}s, {summary['failed']} failed.")
+    logging.info(f"Throughput: {summary['files'] / elapsed:.2f} files/s, {summary['bytes'] / elapsed:.0f} bytes/s")
+    return summary
+
+def export_file_from_redcap(api_key : str, api_endpoint : str, record_id = None, file_fields : list = FILE_FIELDS, file_repo : str = 'file_repo', manifest_db : str = None, max_workers : int = 4, refresh : bool = False, incremental : bool = False) -> list:
+    '''
+    Pull all configured file fields from REDCap into file_repo
+    In incremental mode, the max last_update_timestamp of a fully successful run is
+    stored with the manifest, and the next run only re-downloads the files of records
+    updated after it, on top of the new or renamed files.
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+           record_id: the record id of the participant if provided
+           file_fields: a list of file upload fields
+           file_repo: root folder of the file repo
+           manifest_db: path to the manifest database, file_repo/manifest.db if not provided
+           max_workers: maximum number of concurrent downloads
+           refresh: re-download every file regardless of the manifest
+           incremental: use the stored last_update_timestamp watermark
+    Output: file_list: a list of dict with record_id, field, file_name and last_update_timestamp
+    '''
+    if manifest_db is None:
+        manifest_db = os.path.join(file_repo, 'manifest.db')
+    file_list = export_file_names(api_key, api_endpoint, file_fields=file_fields, record_id=record_id)
+    since = None
+    if incremental:
+        conn = open_manifest(manifest_db)
+        since = get_sync_state(conn, 'last_update_timestamp')
+        conn.close()
+        logging.info(f"Incremental file pull since {since}")
+    summary = sync_files(api_key, api_endpoint, file_list, file_repo=file_repo, manifest_db=manifest_db, max_workers=max_workers, refresh=refresh, since=since)
+    # only a full successful run moves the watermark, a single record run would skip other records
+    if incremental and record_id is None and summary['failed'] == 0 and file_list != []:
+        watermark = max([f['last_update_timestamp'] for f in file_list])
+        if since is None or watermark > since:
+            conn = open_manifest(manifest_db)
+            set_sync_state(conn, 'last_update_timestamp', watermark)
+            conn.close()
+            logging.info(f"last_update_timestamp watermark moved to {watermark}")
+    return file_list
     
 
 if __name__ == "__main__":
@@ -78,6 +233,11 @@ if __name__ == "__main__":
         parser.add_argument('--log_folder', type=str, required=False, help="folder to write log",)    
         parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')   
         parser.add_argument('--r4_id', type=int, required=False, help="r4 id for a single participant sync")    
+        parser.add_argument('--file_repo', type=str, required=False, default='file_repo', help="root folder of the content-addressed file repo")
+        parser.add_argument('--manifest', type=str, required=False, help="sqlite manifest of the file repo, default to file_repo/manifest.db")
+        parser.add_argument('--refresh', action='store_true', help="re-download all files and refresh the manifest")
+        parser.add_argument('--incremental', action='store_true', help="only re-download files of records updated since the last run")
+        parser.add_argument('--max_workers', type=int, required=False, default=4, help="maximum number of concurrent downloads")
         args = parser.parse_args()
 
         # if token file is not provided, use the default token file
@@ -91,7 +251,7 @@ if __name__ == "__main__":
         if args.log_folder is None:
             log_file = 'logs/file_pull_from_r4_' + date_string + '.log'
         else:
-            log_file = os.path.join(args.log_folder, 'data_pull_from_r4_' + date_string + '.log')
+            log_file = os.path.join(args.log_folder, 'file_pull_from_r4_' + date_string + '.log')
         
         if args.r4_id is not None:
             r4_id = str(args.r4_id)
@@ -104,12 +264,10 @@ if __name__ == "__main__":
         logging.info('Start pulling file from R4...')
         
         api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
-        # for testing purpose
-        r4_id = None
-        return_name_list = export_file_from_redcap(api_key_r4,r4_api_endpoint, record_id=r4_id)
+        file_list = export_file_from_redcap(api_key_r4,r4_api_endpoint, record_id=r4_id, file_repo=args.file_repo, manifest_db=args.manifest, max_workers=args.max_workers, refresh=args.refresh, incremental=args.incremental)
         
         logging.info('Finished pulling file from R4.')
     
     except Exception as e:
         logging.error('Error: {}'.format(e))
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
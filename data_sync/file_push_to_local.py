@@ -0,0 +1,159 @@
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Suppress the InsecureRequestWarning
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from datetime import datetime
+import pandas as pd
+import warnings
+# Suppress the FutureWarning
+warnings.filterwarnings("ignore", category=FutureWarning)
+import logging
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from data_pull_from_r4 import read_api_config, export_data_from_redcap
+from file_manifest import open_manifest, blob_path, find_pending_pushes, record_push
+
+def get_r4_local_mapping(api_key_local : str, cu_local_endpoint : str, record_id = None) -> list:
+    '''
+    Get the current R4 to local mapping written by the data sync
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           record_id: the R4 record id of the participant if provided
+    Output: mapping: a list of (record_id, cuimc_id) pairs
+    '''
+    logging.info("Reading R4 to local mapping...")
+    local_data = export_data_from_redcap(api_key_local, cu_local_endpoint, id_only=True)
+    if not local_data:
+        raise Exception("Error occurred during data export from local REDCap")
+    local_data_df = pd.DataFrame(local_data)
+    local_data_df = local_data_df[local_data_df['record_id'].str.strip() != ''][['record_id','cuimc_id']].drop_duplicates()
+    local_data_df['record_id'] = local_data_df['record_id'].str.strip()
+    if record_id is not None:
+        local_data_df = local_data_df[local_data_df['record_id'] == str(record_id)]
+    # due to historical reason, one record_id can be mapped to multiple cuimc_ids. The data sync pushes to all of them.
+    n_multiple = (local_data_df.groupby('record_id')['cuimc_id'].nunique() > 1).sum()
+    if n_multiple > 0:
+        logging.warning(f"{n_multiple} R4 record_ids are mapped to more than one cuimc_id")
+    logging.info("Number of records in current mapping: " + str(local_data_df.shape[0]))
+    return list(local_data_df.itertuples(index=False, name=None))
+
+def import_file(session : requests.Session, api_key_local : str, cu_local_endpoint : str, cuimc_id : str, field : str, file_path : str, file_name : str):
+    '''
+    Import a single file into a local REDCap record
+    Input: session: requests session shared by the import workers
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           cuimc_id: the local record id
+           field: the file upload field
+           file_path: path of the blob to upload
+           file_name: the file name shown in REDCap
+    '''
+    data = {
+        'token': api_key_local,
+        'content': 'file',
+        'action': 'import',
+        'record': cuimc_id,
+        'field': field,
+        'event': '',
+        'returnFormat': 'json'
+        }
+    with open(file_path, 'rb') as f:
+        r = session.post(cu_local_endpoint, data=data, files={'file': (file_name, f)}, verify=False)
+    if r.status_code != 200:
+        raise Exception('HTTP Status: ' + str(r.status_code) + '. ' + str(r.content))
+
+def push_files_to_local(api_key_local : str, cu_local_endpoint : str, mapping : list, file_repo : str = 'file_repo', manifest_db : str = None, max_workers : int = 4) -> dict:
+    '''
+    Import the pulled R4 files into the matching local records with a bounded pool of workers
+    A file is skipped if the same content has already been imported into the same
+    cuimc_id and field. Every successful import is recorded in the manifest right away,
+    so a rerun after a failure resumes from the remaining files.
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           mapping: a list of (record_id, cuimc_id) pairs
+           file_repo: root folder of the file repo
+           manifest_db: path to the manifest database, file_repo/manifest.db if not provided
+           max_workers: maximum number of concurrent imports
+    Output: summary: a dict with number of files, bytes and failures, and elapsed seconds
+    '''
+    if manifest_db is None:
+        manifest_db = os.path.join(file_repo, 'manifest.db')
+    conn = open_manifest(manifest_db)
+    pending = find_pending_pushes(conn, mapping)
+    logging.info(f"Importing {len(pending)} files into local REDCap with {max_workers} workers...")
+
+    summary = {'files': 0, 'bytes': 0, 'failed': 0, 'seconds': 0.0}
+    start = time.time()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(import_file, session, api_key_local, cu_local_endpoint, f['cuimc_id'], f['field'], blob_path(file_repo, f['sha256']), f['file_name']): f for f in pending}
+        for future in as_completed(futures):
+            f = futures[future]
+            try:
+                future.result()
+                # manifest is only written from this thread
+                record_push(conn, f['cuimc_id'], f['field'], f['sha256'])
+                summary['files'] = summary['files'] + 1
+                summary['bytes'] = summary['bytes'] + os.path.getsize(blob_path(file_repo, f['sha256']))
+                logging.debug('File {} imported into cuimc_id {} {}.'.format(f['file_name'], f['cuimc_id'], f['field']))
+            except Exception as e:
+                summary['failed'] = summary['failed'] + 1
+                logging.error('Error occured in importing {} into cuimc_id {}. {}'.format(f['file_name'], f['cuimc_id'], str(e)))
+    session.close()
+    conn.close()
+    summary['seconds'] = time.time() - start
+    elapsed = max(summary['seconds'], 1e-6)
+    logging.info(f"Imported {summary['files']} files ({summary['bytes']} bytes) in {summary['seconds']:.1f}s, {summary['failed']} failed.")
+    logging.info(f"Throughput: {summary['files'] / elapsed:.2f} files/s, {summary['bytes'] / elapsed:.0f} bytes/s")
+    return summary
+
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--log_folder', type=str, required=False, help="folder to write log",)
+        parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
+        parser.add_argument('--r4_id', type=int, required=False, help="r4 id for a single participant sync")
+        parser.add_argument('--file_repo', type=str, required=False, default='file_repo', help="root folder of the content-addressed file repo")
+        parser.add_argument('--manifest', type=str, required=False, help="sqlite manifest of the file repo, default to file_repo/manifest.db")
+        parser.add_argument('--max_workers', type=int, required=False, default=4, help="maximum number of concurrent imports")
+        args = parser.parse_args()
+
+        # if token file is not provided, use the default token file
+        if args.token is None:
+            token_file = '../api_tokens.json'
+        else:
+            token_file = args.token
+
+        # if log file is not provided, use the default log file
+        date_string = datetime.now().strftime("%Y%m%d")
+        if args.log_folder is None:
+            log_file = 'logs/file_push_to_local_' + date_string + '.log'
+        else:
+            log_file = os.path.join(args.log_folder, 'file_push_to_local_' + date_string + '.log')
+
+        if args.r4_id is not None:
+            r4_id = str(args.r4_id)
+        else:
+            r4_id = None
+
+        # set up logging.
+        logging.basicConfig(filename=log_file, format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+        logging.info('Start pushing file to local REDCap...')
+
+        api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
+        mapping = get_r4_local_mapping(api_key_local, cu_local_endpoint, record_id=r4_id)
+        summary = push_files_to_local(api_key_local, cu_local_endpoint, mapping, file_repo=args.file_repo, manifest_db=args.manifest, max_workers=args.max_workers)
+
+        logging.info('Finished pushing file to local REDCap.')
+
+    except Exception as e:
+        logging.error('Error: {}'.format(e))
+        sys.exit(1)
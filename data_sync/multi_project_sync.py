@@ -0,0 +1,215 @@
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Suppress the InsecureRequestWarning
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import json
+from datetime import datetime
+import warnings
+# Suppress the FutureWarning
+warnings.filterwarnings("ignore", category=FutureWarning)
+import logging
+import argparse
+import os
+import threading
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
+from data_pull_from_r4 import send_email, read_ignore_fields, export_data_from_redcap, export_r4_data, r4_export_fields, sync_project
+from schema_drift import apply_schema_drift, cached_metadata
+
+def read_projects(projects_file : str) -> list:
+    '''
+    Read the project pairs to sync
+    Each project has a unique name and the keys of api_tokens.json (api_key_local, local_endpoint, api_key_r4,
+    r4_api_endpoint). Optional keys: ignore (ignore file), batch_size (participants per import, 500 by default),
+    max_push_connections (concurrent imports to its local server, 1 by default, the smallest value wins
+    when several projects share a server) and reservation_file (cuimc_id reservation file, shared with the
+    other syncs and batch uploads of the local project, <schema_cache_folder>/<name>_cuimc_id_reservation.txt by default).
+    Input: projects_file: path to the json list of projects
+    Output: projects: a list of project dicts
+    '''
+    logging.info("Reading projects...")
+    with open(projects_file,'r') as f:
+        projects = json.load(f)
+    names = [project['name'] for project in projects]
+    if len(set(names)) != len(names):
+        raise Exception('Project names are not unique in ' + projects_file)
+    return projects
+
+def r4_source(project : dict) -> tuple:
+    '''
+    Projects with the same R4 source share a single R4 export
+    '''
+    return project['r4_api_endpoint'], project['api_key_r4']
+
+def sync_projects(projects : list, default_ignore_file : str, log_folder : str, cache_folder : str, r4_id : str = None,
+                  max_workers : int = 4, schema_drift : bool = True, payload_validation : bool = True) -> dict:
+    '''
+    Sync several local projects in one process
+    The local id exports, the schema-drift stages, the R4 exports (one per R4 source, covering the R4 record ids
+    and the fields of all its targets) and the project syncs each run concurrently, sharing one http connection pool.
+    Input: projects: output of read_projects
+           default_ignore_file: ignore file of the projects without one
+           log_folder: folder of the drift and quarantine reports
+           cache_folder: folder of the per-project schema caches
+           r4_id: the R4 record id of a single participant sync
+           max_workers: maximum number of concurrent exports or syncs
+           schema_drift: whether to run the schema-drift stage
+           payload_validation: whether to validate the payloads before the import
+    Output: results: a dict of project name to its sync summary, or to the error message
+    '''
+    dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    date_string = datetime.now().strftime("%Y%m%d")
+    endpoints = set([project['local_endpoint'] for project in projects] + [project['r4_api_endpoint'] for project in projects])
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(endpoints), pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    push_connections = {}
+    for project in projects:
+        limit = project.get('max_push_connections', 1)
+        push_connections[project['local_endpoint']] = min(limit, push_connections.get(project['local_endpoint'], limit))
+    push_slots = dict([(endpoint, threading.BoundedSemaphore(limit)) for endpoint, limit in push_connections.items()])
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        local_futures = dict([(project['name'], executor.submit(export_data_from_redcap, project['api_key_local'], project['local_endpoint'], True, session=session))
+                              for project in projects])
+        local_data = {}
+        for project in projects:
+            data = local_futures[project['name']].result()
+            if not data:
+                results[project['name']] = 'Error occurred during data export from local REDCap'
+            else:
+                local_data[project['name']] = data
+
+        def drift_project(project):
+            threading.current_thread().name = project['name']
+            ignore_fields = read_ignore_fields(ignore_file = project.get('ignore', default_ignore_file))
+            if not schema_drift:
+                return ignore_fields, None
+            schema_cache = os.path.join(cache_folder, project['name'] + '_schema_cache.json')
+            ignore_fields = apply_schema_drift(project['api_key_r4'], project['r4_api_endpoint'], project['api_key_local'], project['local_endpoint'],
+                                               ignore_fields, cache_file = schema_cache,
+                                               report_file = os.path.join(log_folder, project['name'] + '_schema_drift_' + date_string + '.json'))
+            return ignore_fields, r4_export_fields(cached_metadata(project['api_key_r4'], project['r4_api_endpoint'], cache_file = schema_cache), ignore_fields)
+
+        # drifted fields are left out of the R4 exports
+        drift_futures = dict([(project['name'], executor.submit(drift_project, project)) for project in projects if project['name'] in local_data])
+        ignore_fields = {}
+        r4_fields = {}
+        for name, future in drift_futures.items():
+            try:
+                ignore_fields[name], r4_fields[name] = future.result()
+            except Exception as e:
+                logging.error('Error occured in the schema-drift stage of ' + name + '. ' + str(e))
+                results[name] = str(e)
+                del local_data[name]
+
+        sources = {}
+        for project in projects:
+            if project['name'] in local_data:
+                sources.setdefault(r4_source(project), []).append(project['name'])
+        logging.info(f"{len(local_data)} projects fed by {len(sources)} R4 exports")
+        source_fields = {}
+        for source, names in sources.items():
+            # one export feeds all the targets, all fields if a target has no field list
+            if any([r4_fields[name] is None for name in names]):
+                source_fields[source] = None
+            else:
+                source_fields[source] = list(dict.fromkeys([field for name in names for field in r4_fields[name]]))
+        r4_futures = dict([(source, executor.submit(export_r4_data, source[1], source[0], [local_data[name] for name in names], r4_id, session, source_fields[source]))
+                           for source, names in sources.items()])
+        r4_data = {}
+        for source, names in sources.items():
+            try:
+                r4_data[source] = r4_futures[source].result()
+            except Exception as e:
+                logging.error('Error occured in exporting data from ' + source[0] + '. ' + str(e))
+                for name in names:
+                    results[name] = str(e)
+
+        def run_project(project):
+            threading.current_thread().name = project['name']
+            logging.info('Start syncing ' + project['name'] + '...')
+            return sync_project(project['api_key_local'], project['local_endpoint'], project['api_key_r4'], project['r4_api_endpoint'],
+                                ignore_fields[project['name']], local_data[project['name']], r4_data[r4_source(project)], dt_string,
+                                report_prefix = os.path.join(log_folder, project['name'] + '_'),
+                                schema_cache = os.path.join(cache_folder, project['name'] + '_schema_cache.json'),
+                                payload_validation = payload_validation,
+                                batch_size = project.get('batch_size', 500), push_slots = push_slots[project['local_endpoint']],
+                                session = session,
+                                reservation_file = project.get('reservation_file', os.path.join(cache_folder, project['name'] + '_cuimc_id_reservation.txt')))
+
+        sync_futures = dict([(project['name'], executor.submit(run_project, project)) for project in projects
+                             if project['name'] in local_data and r4_source(project) in r4_data])
+        for name, future in sync_futures.items():
+            try:
+                results[name] = future.result()
+                logging.info(f"{name}: {results[name]}")
+            except Exception as e:
+                logging.error('Error occured in syncing ' + name + '. ' + str(e))
+                results[name] = str(e)
+    return results
+
+
+if __name__ == "__main__":
+    try:
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--log_folder', type=str, required=False, help="folder to write log",)
+        parser.add_argument('--projects', type=str, required=False, help='json list of the project pairs to sync')
+        parser.add_argument('--ignore', type=str, required=False, help="json file with ignored R4 fields, for projects without their own")
+        parser.add_argument('--r4_id', type=int, required=False, help="r4 id for a single participant sync")
+        parser.add_argument('--schema_cache_folder', type=str, required=False, default='.', help="folder of the per-project schema caches")
+        parser.add_argument('--max_workers', type=int, required=False, default=4, help="maximum number of concurrent exports or syncs")
+        parser.add_argument('--no_schema_drift', action='store_true', help="only use the ignore files, skip the schema-drift stage")
+        parser.add_argument('--no_payload_validation', action='store_true', help="push the prepared data without checking it against the local metadata")
+        args = parser.parse_args()
+
+        # if projects file is not provided, use the default projects file
+        if args.projects is None:
+            projects_file = '../projects.json'
+        else:
+            projects_file = args.projects
+
+        # if ignore file is not provided, use the default ignore file
+        if args.ignore is None:
+            ignore_file = './ignore_R4_fields.json'
+        else:
+            ignore_file = args.ignore
+
+        # if log file is not provided, use the default log file
+        date_string = datetime.now().strftime("%Y%m%d")
+        if args.log_folder is None:
+            log_folder = 'logs'
+        else:
+            log_folder = args.log_folder
+        log_file = os.path.join(log_folder, 'multi_project_sync_' + date_string + '.log')
+
+        # set up logging.
+        logging.basicConfig(filename=log_file, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+        logging.info('Start multi-project sync...')
+        projects = read_projects(projects_file)
+        results = sync_projects(projects, ignore_file, log_folder, args.schema_cache_folder,
+                                r4_id = None if args.r4_id is None else str(args.r4_id), max_workers = args.max_workers,
+                                schema_drift = not args.no_schema_drift, payload_validation = not args.no_payload_validation)
+        errors = [name + ': ' + result for name, result in results.items() if isinstance(result, str)]
+        errors = errors + [name + ': ' + str(result['failed_batches']) + ' failed batches' for name, result in results.items()
+                           if not isinstance(result, str) and result['failed_batches'] > 0]
+        if len(errors) > 0:
+            raise Exception('<br>'.join(errors))
+        logging.info('End multi-project sync...')
+    except Exception as e:
+        # send email if error occurs
+        logging.error('Error occured in multi-project sync. ' + str(e))
+        SMTP_HOST = "nova.cpmc.columbia.edu"
+        SMTP_PORT = 587
+        FROM_ADDR = "emerge_study@cumc.columbia.edu"
+        msg = EmailMessage()
+        msg['From'] = FROM_ADDR
+        msg['To'] = 'cl3720@cumc.columbia.edu,ct2865@cumc.columbia.edu'
+        msg['Subject'] = '[Error] eMERGE Columbia Data Sync Service'
+        body = 'Error occured in multi-project sync. ' + str(e)
+        msg.add_alternative(body,subtype='html')
+        send_email(msg, SMTP_HOST, SMTP_PORT)
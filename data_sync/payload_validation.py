@@ -0,0 +1,185 @@
+import requests
+import logging
+import os
+import re
+import time
+import pandas as pd
+from schema_drift import export_field_names, checkbox_codes
+
+# columns of a flat import that are not data dictionary fields
+REDCAP_SYSTEM_COLUMNS = ['redcap_repeat_instrument', 'redcap_repeat_instance', 'redcap_event_name', 'redcap_data_access_group']
+# field types with a fixed list of codes
+CHOICE_FIELD_TYPES = {'radio': None, 'dropdown': None, 'yesno': ['0', '1'], 'truefalse': ['0', '1']}
+# import formats of the validation types, REDCap imports dates as Y-M-D whatever the display format
+# the validation type name must match exactly, types not listed here are not checked
+VALIDATION_PATTERNS = [
+    (r'datetime_seconds_(ymd|mdy|dmy)', r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),
+    (r'datetime_(ymd|mdy|dmy)', r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}', '%Y-%m-%d %H:%M'),
+    (r'date_(ymd|mdy|dmy)', r'\d{4}-\d{2}-\d{2}', '%Y-%m-%d'),
+    (r'time_hh_mm_ss', r'([01]\d|2[0-3]):[0-5]\d:[0-5]\d', None),
+    (r'time_mm_ss', r'[0-5]\d:[0-5]\d', None),
+    (r'time', r'([01]\d|2[0-3]):[0-5]\d', None),
+    (r'integer', r'-?\d+', None),
+    (r'number(_\ddp)?', r'-?(\d+(\.\d*)?|\.\d+)', None),
+    (r'number(_\ddp)?_comma_decimal', r'-?(\d+(,\d*)?|,\d+)', None),
+]
+QUARANTINE_COLUMNS = ['cuimc_id', 'redcap_repeat_instrument', 'redcap_repeat_instance', 'field_name', 'value', 'reason']
+
+def export_repeating_forms(api_key : str, api_endpoint : str) -> list:
+    '''
+    Export the repeating instruments of a classic project
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+    Output: repeating_forms: a list of form names, None if the export failed
+    '''
+    data = {
+        'token': api_key,
+        'content': 'repeatingFormsEvents',
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    flag = 1
+    while(flag > 0 and flag < 4):
+        try:
+            r = requests.post(api_endpoint, data=data, verify=False, timeout=300)
+            if r.status_code == 200:
+                return [i['form_name'] for i in r.json()]
+            logging.error('Error occured in exporting repeating instruments from ' + api_endpoint)
+            logging.error('HTTP Status: ' + str(r.status_code))
+            logging.error(r.content)
+        except Exception as e:
+            logging.error('Error occured in exporting repeating instruments. ' + str(e))
+        time.sleep(flag * 10)
+        flag = flag + 1
+    return None
+
+def validation_rule(validation : str) -> tuple:
+    '''
+    Import pattern and date format of a text validation type, (None, None) if not checked
+    '''
+    for name, pattern, date_format in VALIDATION_PATTERNS:
+        if re.fullmatch(name, validation):
+            return pattern, date_format
+    return None, None
+
+def validate_payload(payload_df : pd.DataFrame, meta_local_json : list, repeating_forms : list = None) -> tuple:
+    '''
+    Check a prepared push frame against the local data dictionary before it is serialized
+    Each check runs on a whole column. The first failing check of a cell gives its reason.
+    Input: payload_df: output of prepare_local_list, with a unique index
+           meta_local_json: local data dictionary
+           repeating_forms: local repeating instruments, the repeat checks are skipped if None
+    Output: bad_cells: a boolean frame aligned with payload_df, True for the cells to leave out of the import
+            quarantine_df: one row per bad cell with QUARANTINE_COLUMNS
+    '''
+    columns = export_field_names(meta_local_json)
+    fields = dict([(i['field_name'], i) for i in meta_local_json])
+    record_id_field = meta_local_json[0]['field_name']
+    values = payload_df.fillna('').astype(str)
+    bad_cells = pd.DataFrame(False, index=payload_df.index, columns=payload_df.columns)
+    reasons = []
+
+    def flag_cells(column, mask, reason):
+        mask = mask & ~bad_cells[column]
+        if mask.any():
+            bad_cells.loc[mask, column] = True
+            reasons.append((column, mask, reason))
+
+    if 'redcap_repeat_instrument' in values.columns:
+        repeat_instrument = values['redcap_repeat_instrument']
+    else:
+        repeat_instrument = pd.Series('', index=values.index)
+    if repeating_forms is not None:
+        # rows of an instrument that is not repeating in local are left out as a whole
+        illegal_instrument = (repeat_instrument != '') & ~repeat_instrument.isin(repeating_forms)
+        if illegal_instrument.any():
+            flag_cells('redcap_repeat_instrument', illegal_instrument, 'not a repeating instrument')
+    for column in values.columns:
+        filled = values[column] != ''
+        if column in REDCAP_SYSTEM_COLUMNS or column == record_id_field:
+            continue
+        if column not in columns:
+            # even empty values of an unknown field fail the import
+            flag_cells(column, filled, 'not a field of the local project')
+            bad_cells[column] = True
+            continue
+        if not filled.any():
+            continue
+        field_name = columns[column]
+        if field_name not in fields:
+            # form_complete columns
+            flag_cells(column, filled & ~values[column].isin(['0', '1', '2']), 'invalid form status')
+            form_name = field_name[:-len('_complete')]
+        else:
+            field = fields[field_name]
+            form_name = field['form_name']
+            field_type = field['field_type']
+            if field_type == 'checkbox':
+                flag_cells(column, filled & ~values[column].isin(['0', '1']), 'invalid checkbox value')
+            elif field_type in CHOICE_FIELD_TYPES:
+                codes = CHOICE_FIELD_TYPES[field_type]
+                if codes is None:
+                    codes = checkbox_codes(field['select_choices_or_calculations'])
+                flag_cells(column, filled & ~values[column].isin(codes), 'invalid choice code')
+            elif field_type == 'text':
+                pattern, date_format = validation_rule(field.get('text_validation_type_or_show_slider_number', ''))
+                if pattern is not None:
+                    invalid = filled & ~values[column].str.fullmatch(pattern)
+                    if date_format is not None:
+                        invalid = invalid | (filled & pd.to_datetime(values[column].where(~invalid, ''), format=date_format, errors='coerce').isna())
+                    flag_cells(column, invalid, 'invalid ' + field['text_validation_type_or_show_slider_number'])
+        if repeating_forms is not None:
+            # R4 exports unchecked boxes as 0 on every row, only checked boxes count as data here
+            if field_name in fields and fields[field_name]['field_type'] == 'checkbox':
+                filled = values[column] == '1'
+            filled = filled & ~illegal_instrument
+            if form_name in repeating_forms:
+                flag_cells(column, filled & (repeat_instrument != form_name), 'repeating instrument field outside its instance')
+            else:
+                flag_cells(column, filled & (repeat_instrument != ''), 'non-repeating field in a repeating instance')
+
+    quarantine = []
+    for column, mask, reason in reasons:
+        rows = pd.DataFrame(index=payload_df.index[mask])
+        for key in ['cuimc_id', 'redcap_repeat_instrument', 'redcap_repeat_instance']:
+            rows[key] = values.loc[mask, key] if key in values.columns else ''
+        rows['field_name'] = column
+        rows['value'] = values.loc[mask, column]
+        rows['reason'] = reason
+        quarantine.append(rows)
+    if len(quarantine) > 0:
+        quarantine_df = pd.concat(quarantine, ignore_index=True)[QUARANTINE_COLUMNS]
+    else:
+        quarantine_df = pd.DataFrame(columns=QUARANTINE_COLUMNS)
+    return bad_cells, quarantine_df
+
+def payload_records(batch_df : pd.DataFrame, bad_cells : pd.DataFrame) -> list:
+    '''
+    Serialize a batch, leaving the bad cells out of the records so that the local values are kept
+    Rows with a bad redcap_repeat_instrument are left out entirely.
+    Input: batch_df: rows of the push frame
+           bad_cells: output of validate_payload
+    Output: batch: a list of records
+    '''
+    batch = batch_df.to_dict(orient='records')
+    batch_bad_cells = bad_cells.loc[batch_df.index]
+    if not batch_bad_cells.values.any():
+        return batch
+    for row, column in zip(*batch_bad_cells.values.nonzero()):
+        batch[row].pop(batch_bad_cells.columns[column], None)
+    if 'redcap_repeat_instrument' in batch_bad_cells.columns:
+        batch = [record for record in batch if 'redcap_repeat_instrument' in record]
+    return batch
+
+def write_quarantine_report(quarantine_df : pd.DataFrame, report_file : str):
+    '''
+    Write the quarantined cells, nothing is written if there is none
+    '''
+    if len(quarantine_df) == 0:
+        logging.info("Payload validation passed")
+        return
+    logging.warning(f"Payload validation: {len(quarantine_df)} cells quarantined in {quarantine_df['field_name'].nunique()} fields, see {report_file}")
+    report_dir = os.path.dirname(report_file)
+    if report_dir != '':
+        os.makedirs(report_dir, exist_ok=True)
+    quarantine_df.to_csv(report_file, index=False)
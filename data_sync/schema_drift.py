@@ -0,0 +1,234 @@
+import requests
+import json
+import hashlib
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+# fields the sync always writes, never added to the ignore list
+SYNC_KEY_FIELDS = ['record_id', 'redcap_repeat_instrument', 'redcap_repeat_instance', 'cuimc_id', 'r4_survey_queue_link', 'last_r4_pull']
+# seconds subtracted from the last check when reading the design log, for a clock difference with the REDCap server
+DESIGN_LOG_MARGIN = 3600
+
+def export_metadata(api_key : str, api_endpoint : str) -> list:
+    '''
+    Export the data dictionary of a project
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+    Output: metadata: a list of fields, None if the export failed
+    '''
+    logging.info(f"Exporting metadata from {api_endpoint}...")
+    data = {
+        'token': api_key,
+        'content': 'metadata',
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    flag = 1
+    while(flag > 0 and flag < 4):
+        try:
+            r = requests.post(api_endpoint, data=data, verify=False, timeout=300)
+            if r.status_code == 200:
+                return r.json()
+            logging.error('Error occured in exporting metadata from ' + api_endpoint)
+            logging.error('HTTP Status: ' + str(r.status_code))
+            logging.error(r.content)
+        except Exception as e:
+            logging.error('Error occured in exporting metadata. ' + str(e))
+        time.sleep(flag * 10)
+        flag = flag + 1
+    return None
+
+def export_design_log(api_key : str, api_endpoint : str, begin_time : str) -> list:
+    '''
+    Export the project design (Manage/Design) log events since begin_time
+    A single try, the caller falls back to the metadata export, e.g. if the token has no logging rights.
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+           begin_time: 'YYYY-MM-DD HH:MM'
+    Output: events: a list of log events, None if the export failed
+    '''
+    data = {
+        'token': api_key,
+        'content': 'log',
+        'logtype': 'manage',
+        'beginTime': begin_time,
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    try:
+        r = requests.post(api_endpoint, data=data, verify=False, timeout=60)
+        if r.status_code == 200:
+            return r.json()
+        logging.warning('Design log of ' + api_endpoint + ' not available, HTTP Status: ' + str(r.status_code))
+    except Exception as e:
+        logging.warning('Design log of ' + api_endpoint + ' not available. ' + str(e))
+    return None
+
+def metadata_hash(metadata : list) -> str:
+    '''
+    Hash of a data dictionary, independent of the key order of the fields
+    '''
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+
+def project_key(api_key : str, api_endpoint : str) -> str:
+    '''
+    Cache key of a project, the token itself is not stored in the cache
+    '''
+    return hashlib.sha256((api_endpoint + '|' + api_key).encode('utf-8')).hexdigest()[:16]
+
+def read_schema_cache(cache_file : str) -> dict:
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+def write_schema_cache(cache_file : str, cache : dict):
+    '''
+    Write the cache through a temp file so that a killed run never leaves a truncated cache
+    '''
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir != '':
+        os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(cache_file + '.tmp', cache_file)
+
+def load_metadata(api_key : str, api_endpoint : str, cache_file : str = './schema_cache.json') -> tuple:
+    '''
+    Export the data dictionary and keep it in the schema cache
+    The design log since the last check is exported first, the cached data dictionary is used as is
+    if no design change was logged. Otherwise the data dictionary is exported and its hash compared.
+    If the export fails, the cached data dictionary of the previous run is used.
+    Input: api_key: API token
+           api_endpoint: api endpoint url
+           cache_file: path to the schema cache
+    Output: metadata: a list of fields
+            version: dict with the metadata hash, when it was fetched, and whether it changed since the previous run
+    '''
+    cache = read_schema_cache(cache_file)
+    key = project_key(api_key, api_endpoint)
+    cached = cache.get(key)
+    if cached is not None and 'checked_at' in cached:
+        begin_time = (datetime.strptime(cached['checked_at'], '%Y-%m-%d %H:%M:%S') - timedelta(seconds=DESIGN_LOG_MARGIN)).strftime('%Y-%m-%d %H:%M')
+        events = export_design_log(api_key, api_endpoint, begin_time)
+        if events == []:
+            logging.info(f"No design change in {api_endpoint} since {cached['checked_at']}, using cached metadata")
+            return cached['metadata'], {'hash': cached['hash'], 'fetched_at': cached['fetched_at'], 'changed': False, 'from_cache': True}
+    checked_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    metadata = export_metadata(api_key, api_endpoint)
+    if metadata is None:
+        if cached is None:
+            raise Exception('Error occured in exporting metadata from ' + api_endpoint + ' and no cached metadata')
+        logging.warning(f"Using cached metadata of {api_endpoint} fetched at {cached['fetched_at']}")
+        return cached['metadata'], {'hash': cached['hash'], 'fetched_at': cached['fetched_at'], 'changed': False, 'from_cache': True}
+    new_hash = metadata_hash(metadata)
+    changed = cached is None or cached['hash'] != new_hash
+    if changed:
+        logging.info(f"Metadata of {api_endpoint} changed since the previous run")
+        cache[key] = {'endpoint': api_endpoint, 'hash': new_hash, 'fetched_at': checked_at, 'metadata': metadata}
+    cache[key]['checked_at'] = checked_at
+    write_schema_cache(cache_file, cache)
+    return metadata, {'hash': new_hash, 'fetched_at': cache[key]['fetched_at'], 'changed': changed, 'from_cache': False}
+
+def cached_metadata(api_key : str, api_endpoint : str, cache_file : str = './schema_cache.json') -> list:
+    '''
+    The data dictionary kept by the last load_metadata, exported if not cached yet
+    '''
+    cached = read_schema_cache(cache_file).get(project_key(api_key, api_endpoint))
+    if cached is None:
+        return load_metadata(api_key, api_endpoint, cache_file)[0]
+    return cached['metadata']
+
+def checkbox_codes(choices : str) -> list:
+    '''
+    Raw codes of a "1, Yes | 2, No" choice list
+    '''
+    return [i.split(',')[0].strip() for i in choices.split('|') if i.strip() != '']
+
+def export_field_names(metadata : list) -> dict:
+    '''
+    Map the record export columns of a data dictionary to their field
+    Checkbox fields are exported as one column per choice (field___code), each form has a
+    form_complete column and descriptive fields are not exported.
+    Input: metadata: a list of fields
+    Output: columns: a dict of export column name to field name
+    '''
+    columns = {}
+    for field in metadata:
+        field_name = field['field_name']
+        if field['field_type'] == 'descriptive':
+            continue
+        if field['field_type'] == 'checkbox':
+            for code in checkbox_codes(field['select_choices_or_calculations']):
+                columns[field_name + '___' + re.sub('[^a-z0-9_]', '_', code.lower())] = field_name
+        else:
+            columns[field_name] = field_name
+        columns.setdefault(field['form_name'] + '_complete', field['form_name'] + '_complete')
+    return columns
+
+def is_calc_field(field : dict) -> bool:
+    '''
+    Whether REDCap computes the value of a field, calc fields and @CALC... action tags
+    '''
+    return field['field_type'] == 'calc' or '@CALC' in field.get('field_annotation', '').upper()
+
+def detect_schema_drift(meta_r4_json : list, meta_local_json : list, ignore_fields : list = []) -> dict:
+    '''
+    Find the R4 export columns the sync cannot write to local
+    Input: meta_r4_json: R4 data dictionary
+           meta_local_json: local data dictionary
+           ignore_fields: fields already ignored
+    Output: drift: missing_in_local: R4 columns that are not real data fields in local
+                   calc_in_local: R4 columns computed by local REDCap
+                   type_mismatch: fields whose field type differs, reported only
+                   new_ignore_fields: columns to add to the ignore list for this run
+    '''
+    r4_columns = export_field_names(meta_r4_json)
+    local_columns = export_field_names(meta_local_json)
+    local_fields = dict([(i['field_name'], i) for i in meta_local_json])
+    r4_fields = dict([(i['field_name'], i) for i in meta_r4_json])
+    ignore_fields = set(ignore_fields)
+    candidates = [i for i in r4_columns if i not in ignore_fields and i not in SYNC_KEY_FIELDS]
+    missing_in_local = [i for i in candidates if i not in local_columns]
+    calc_in_local = [i for i in candidates if i in local_columns and local_columns[i] in local_fields and is_calc_field(local_fields[local_columns[i]])]
+    type_mismatch = [{'field_name': i, 'r4': r4_fields[i]['field_type'], 'local': local_fields[i]['field_type']}
+                     for i in r4_fields if i in local_fields and r4_fields[i]['field_type'] != local_fields[i]['field_type']]
+    return {
+        'missing_in_local': missing_in_local,
+        'calc_in_local': calc_in_local,
+        'type_mismatch': type_mismatch,
+        'new_ignore_fields': missing_in_local + calc_in_local
+    }
+
+def apply_schema_drift(api_key_r4 : str, r4_api_endpoint : str, api_key_local : str, cu_local_endpoint : str, ignore_fields : list,
+                       cache_file : str = './schema_cache.json', report_file : str = None) -> list:
+    '''
+    Schema-drift stage run before the R4 export, extends the ignore list of this run
+    The ignore file is not modified, the report lists the fields to review.
+    Input: api_key_r4: API token for R4
+           r4_api_endpoint: R4 api endpoint
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           ignore_fields: fields from the ignore file
+           cache_file: path to the schema cache
+           report_file: path to write the drift report, not written if None
+    Output: effective_ignore_fields: ignore_fields plus the drifted fields
+    '''
+    logging.info("Checking R4 schema drift...")
+    meta_r4_json, r4_version = load_metadata(api_key_r4, r4_api_endpoint, cache_file)
+    meta_local_json, local_version = load_metadata(api_key_local, cu_local_endpoint, cache_file)
+    drift = detect_schema_drift(meta_r4_json, meta_local_json, ignore_fields)
+    if len(drift['new_ignore_fields']) > 0:
+        logging.warning(f"Schema drift, ignoring {len(drift['new_ignore_fields'])} more fields in this run: " + ','.join(drift['new_ignore_fields']))
+    for mismatch in drift['type_mismatch']:
+        logging.warning(f"Field type differs for {mismatch['field_name']}: R4 {mismatch['r4']}, local {mismatch['local']}")
+    if report_file is not None:
+        report_dir = os.path.dirname(report_file)
+        if report_dir != '':
+            os.makedirs(report_dir, exist_ok=True)
+        with open(report_file, 'w') as f:
+            json.dump(dict(drift, r4_metadata=r4_version, local_metadata=local_version), f, indent=2)
+    return list(ignore_fields) + [i for i in drift['new_ignore_fields'] if i not in ignore_fields]
@@ -2,104 +2,234 @@ import requests
 import json
 import argparse # for command line arguments
 
+# forms replaced by their R4 version. ror patch
+FORMS_FOR_UPDATE = ['postror_adult','postror_child']
+# fields written by the R4 sync on top of the R4 fields themselves
+SYNC_MAPPING_FIELDS = ['cuimc_id', 'r4_survey_queue_link', 'last_r4_pull']
+# field attributes that change what values REDCap accepts on import
+BREAKING_ATTRIBUTES = ['form_name', 'field_type', 'select_choices_or_calculations', 'text_validation_type_or_show_slider_number',
+                       'text_validation_min', 'text_validation_max']
 
-# read api tokens from json file.
-argparser = argparse.ArgumentParser()
-argparser.add_argument('--api_token_file', help='path to api token file', required=False)
-args = argparser.parse_args()
-if args.api_token_file:
-    api_token_file = args.api_token_file
-else:
-    api_token_file = '../api_tokens.json'
-
-with open(api_token_file,'r') as f:
-    api_conf = json.load(f)
-
-api_key_local = api_conf['api_key_local'] # API token for local
-api_key_r4 = api_conf['api_key_r4'] # API token for R4.
-cu_local_endpoint = api_conf['local_endpoint'] # local api endpoint
-r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
-
-# local Data dictionary export
-data = {
-    'token': api_key_local,
-    'content': 'metadata',
-    'format': 'json',
-    'returnFormat': 'json'
-}
-r = requests.post(cu_local_endpoint,data=data)
-meta_local_json = r.json()
-print('HTTP Status: ' + str(r.status_code))
-
-# R4 Data dictionary export
-data = {
-    'token': api_key_r4,
-    'content': 'metadata',
-    'format': 'json',
-    'returnFormat': 'json'
-}
-r = requests.post(r4_api_endpoint,data=data)
-meta_r4_json = r.json()
-print('HTTP Status: ' + str(r.status_code))
-
-# remove field already existing.
-# ror patch
-forms_for_update = ['postror_adult','postror_child']
-meta_local_json_field_name_list = [i['field_name'] for i in meta_local_json if i['form_name'] not in forms_for_update]
-meta_r4_json_deduplicated = [i for i in meta_r4_json if i['field_name'] not in meta_local_json_field_name_list]
-meta_local_json = [i for i in meta_local_json if i['form_name'] not in forms_for_update]
-
-# new_json = []
-# form_name_current = ""
-# for meta_local_field in meta_local_json:
-#     form_name_new = meta_local_field['form_name']
-#     if (form_name_new == form_name_current) or form_name_current == "":
-#         new_json.append(meta_local_field)
-#         form_name_current = form_name_new
-#     else:
-#         for meta_r4_field in meta_r4_json_deduplicated:
-#             if meta_r4_field['form_name'] == form_name_current:
-#                 new_json.append(meta_r4_field)
-#         form_name_current = form_name_new
-
-meta_json = meta_local_json + meta_r4_json_deduplicated
-# redcap requires form in sequential order.
-# meta_json.sort(key=lambda x: x["form_name"]) # this will change the order and re-assign the record id.
-ordered_form_names = []
-for i in meta_json:
-    if i['form_name'] not in ordered_form_names:
-        ordered_form_names.append(i['form_name'])
-new_json = []
-for i in ordered_form_names:
-    for j in meta_json:
-        if j['form_name'] == i:
-            new_json.append(j)
-
-with open('./test_meta.json','w') as f:
-    json.dump(new_json,f)
-
-data = {
-    'token': api_key_local,
-    'content': 'project',
-    'format': 'json',
-    'returnFormat': 'json'
-}
-r = requests.post(cu_local_endpoint,data=data)
-print('HTTP Status: ' + str(r.status_code))
-print(r.json())
-
-# update local data dictionary
-# IMPORTANT: need to re-arrange the 
-data = {
-    'token': api_key_local,
-    'content': 'metadata',
-    'format': 'json',
-    'returnFormat': 'json',
-    'data': json.dumps(new_json)
-}
-r = requests.post(cu_local_endpoint,data=data)
-print('HTTP Status: ' + str(r.status_code))
-print('Number of fields: ' + r.content.decode('utf-8'))
-# HTTP Status: {"error":"This method cannot be used while the project is in Production status."}
-# Move Back to Development status.
+def read_api_config(config_file: str = '../api_tokens.json') -> tuple:
+    '''
+    Read api tokens and endpoint url from api_config.json
+    Input: config_file: path to api_config.json
+    Output: api_key_local: API token for local
+            api_key_r4: API token for R4.
+            cu_local_endpoint: local api endpoint
+            r4_api_endpoint: R4 api endpoint
+    '''
+    with open(config_file,'r') as f:
+        api_conf = json.load(f)
 
+    api_key_local = api_conf['api_key_local'] # API token for local
+    api_key_r4 = api_conf['api_key_r4'] # API token for R4.
+    cu_local_endpoint = api_conf['local_endpoint'] # local api endpoint
+    r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
+    return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
+
+def export_metadata(api_key : str, api_endpoint : str) -> list:
+    '''
+    Export the data dictionary of a project
+    Input: api_key: API token
+           api_endpoint: api endpoint
+    Output: metadata: a list of fields
+    '''
+    data = {
+        'token': api_key,
+        'content': 'metadata',
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    r = requests.post(api_endpoint,data=data)
+    print('HTTP Status: ' + str(r.status_code))
+    if r.status_code != 200:
+        raise Exception('Error occured in exporting metadata from ' + api_endpoint + ': ' + r.content.decode('utf-8'))
+    return r.json()
+
+def index_metadata(metadata : list) -> tuple:
+    '''
+    Index a data dictionary by field and by form in a single pass
+    Input: metadata: a list of fields
+    Output: fields: a dict of field_name to field
+            forms: a dict of form_name to the list of its field names, in form order
+    '''
+    fields = {}
+    forms = {}
+    for field in metadata:
+        fields[field['field_name']] = field
+        forms.setdefault(field['form_name'], []).append(field['field_name'])
+    return fields, forms
+
+def merge_metadata(meta_local_json : list, meta_r4_json : list, forms_for_update : list = FORMS_FOR_UPDATE) -> list:
+    '''
+    Merge the local and R4 data dictionaries
+    The REDCap metadata import replaces the whole dictionary, so the merge is always uploaded in full.
+    Local fields are kept, except the forms_for_update which are taken from R4, then the R4 fields
+    missing from local are added. REDCap requires the fields of a form to be contiguous, so fields
+    are grouped by form, forms in order of first appearance, keeping the field order within a form.
+    Input: meta_local_json: local data dictionary
+           meta_r4_json: R4 data dictionary
+           forms_for_update: forms replaced by their R4 version
+    Output: new_json: the merged data dictionary
+    '''
+    meta_local_json = [i for i in meta_local_json if i['form_name'] not in forms_for_update]
+    local_field_names = set([i['field_name'] for i in meta_local_json])
+    meta_r4_json_deduplicated = [i for i in meta_r4_json if i['field_name'] not in local_field_names]
+    forms = {}
+    for field in meta_local_json + meta_r4_json_deduplicated:
+        forms.setdefault(field['form_name'], []).append(field)
+    return [field for form_fields in forms.values() for field in form_fields]
+
+def diff_metadata(old_json : list, new_json : list) -> dict:
+    '''
+    Compare two data dictionaries
+    Input: old_json: current data dictionary
+           new_json: data dictionary to upload
+    Output: diff: added, removed and changed fields and forms, and whether the form order changed
+    '''
+    old_fields, old_forms = index_metadata(old_json)
+    new_fields, new_forms = index_metadata(new_json)
+    changed_fields = {}
+    for field_name in old_fields.keys() & new_fields.keys():
+        old_field = old_fields[field_name]
+        new_field = new_fields[field_name]
+        changes = dict([(k, [old_field.get(k, ''), new_field.get(k, '')]) for k in old_field.keys() | new_field.keys()
+                        if old_field.get(k, '') != new_field.get(k, '')])
+        if len(changes) > 0:
+            changed_fields[field_name] = changes
+    common_forms = [i for i in old_forms if i in new_forms]
+    return {
+        'added_fields': [i for i in new_fields if i not in old_fields],
+        'removed_fields': [i for i in old_fields if i not in new_fields],
+        'changed_fields': dict([(i, changed_fields[i]) for i in new_fields if i in changed_fields]),
+        'added_forms': [i for i in new_forms if i not in old_forms],
+        'removed_forms': [i for i in old_forms if i not in new_forms],
+        'changed_forms': [i for i in common_forms if old_forms[i] != new_forms[i]],
+        'form_order_changed': common_forms != [i for i in new_forms if i in old_forms]
+    }
+
+def has_changes(diff : dict) -> bool:
+    '''
+    Whether the diff would change the data dictionary
+    '''
+    return diff['form_order_changed'] or any([len(diff[k]) > 0 for k in diff if k != 'form_order_changed'])
+
+def find_breaking_sync_fields(diff : dict, meta_local_json : list, meta_r4_json : list, ignore_fields : list = None) -> dict:
+    '''
+    Find the fields written by the R4 sync that the new data dictionary would break
+    The sync writes the R4 fields that exist in local and the mapping fields. A field breaks if it is
+    removed, or if an attribute that controls the accepted values changes.
+    Input: diff: output of diff_metadata(meta_local_json, new_json)
+           meta_local_json: current local data dictionary
+           meta_r4_json: R4 data dictionary
+           ignore_fields: R4 fields not synced
+    Output: breaking: a dict of field name to the reason
+    '''
+    if ignore_fields is None:
+        ignore_fields = []
+    local_field_names = set([i['field_name'] for i in meta_local_json])
+    sync_fields = set([i['field_name'] for i in meta_r4_json if i['field_name'] in local_field_names and i['field_name'] not in ignore_fields])
+    sync_fields.update([i for i in SYNC_MAPPING_FIELDS if i in local_field_names])
+    breaking = {}
+    for field_name in diff['removed_fields']:
+        if field_name in sync_fields:
+            breaking[field_name] = 'removed'
+    for field_name, changes in diff['changed_fields'].items():
+        attributes = [k for k in BREAKING_ATTRIBUTES if k in changes]
+        if field_name in sync_fields and len(attributes) > 0:
+            breaking[field_name] = 'changed ' + ', '.join(attributes)
+    return breaking
+
+def write_diff_report(diff : dict, breaking : dict, report_file : str):
+    '''
+    Write the change report as json
+    Input: diff: output of diff_metadata
+           breaking: output of find_breaking_sync_fields
+           report_file: path to the report
+    '''
+    with open(report_file,'w') as f:
+        json.dump(dict(diff, breaking_sync_fields=breaking), f, indent=2)
+
+def print_diff_summary(diff : dict, breaking : dict):
+    '''
+    Print a short summary of the change report
+    '''
+    for k in ['added_fields', 'removed_fields', 'changed_fields', 'added_forms', 'removed_forms', 'changed_forms']:
+        print(k + ': ' + str(len(diff[k])) + ('' if len(diff[k]) == 0 else ' ' + ', '.join(list(diff[k])[:20])))
+    print('form_order_changed: ' + str(diff['form_order_changed']))
+    print('breaking_sync_fields: ' + str(len(breaking)))
+    for field_name, reason in breaking.items():
+        print('  ' + field_name + ': ' + reason)
+
+def import_metadata(api_key : str, api_endpoint : str, new_json : list):
+    '''
+    Upload a data dictionary, the project must be in development status
+    Input: api_key: API token
+           api_endpoint: api endpoint
+           new_json: data dictionary to upload
+    '''
+    data = {
+        'token': api_key,
+        'content': 'project',
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    r = requests.post(api_endpoint,data=data)
+    print('HTTP Status: ' + str(r.status_code))
+    print(r.json())
+
+    # update local data dictionary
+    data = {
+        'token': api_key,
+        'content': 'metadata',
+        'format': 'json',
+        'returnFormat': 'json',
+        'data': json.dumps(new_json)
+    }
+    r = requests.post(api_endpoint,data=data)
+    print('HTTP Status: ' + str(r.status_code))
+    print('Number of fields: ' + r.content.decode('utf-8'))
+    # HTTP Status: {"error":"This method cannot be used while the project is in Production status."}
+    # Move Back to Development status.
+
+
+if __name__ == "__main__":
+
+    # read api tokens from json file.
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--api_token_file', help='path to api token file', required=False)
+    argparser.add_argument('--ignore', help='json file with ignored R4 fields', required=False)
+    argparser.add_argument('--report', help='path to the change report', required=False, default='./metadata_diff.json')
+    argparser.add_argument('--dry_run', help='report the changes without uploading', action='store_true')
+    args = argparser.parse_args()
+    if args.api_token_file:
+        api_token_file = args.api_token_file
+    else:
+        api_token_file = '../api_tokens.json'
+
+    api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = api_token_file)
+
+    ignore_fields = []
+    if args.ignore:
+        with open(args.ignore,'r') as f:
+            ignore_fields = [k for k, v in json.load(f).items() if str(v) == '1']
+
+    meta_local_json = export_metadata(api_key_local, cu_local_endpoint)
+    meta_r4_json = export_metadata(api_key_r4, r4_api_endpoint)
+    new_json = merge_metadata(meta_local_json, meta_r4_json)
+
+    with open('./test_meta.json','w') as f:
+        json.dump(new_json,f)
+
+    diff = diff_metadata(meta_local_json, new_json)
+    breaking = find_breaking_sync_fields(diff, meta_local_json, meta_r4_json, ignore_fields)
+    write_diff_report(diff, breaking, args.report)
+    print_diff_summary(diff, breaking)
+
+    if args.dry_run:
+        print('Dry run, the data dictionary is not uploaded.')
+    elif not has_changes(diff):
+        print('No changes, the data dictionary is not uploaded.')
+    else:
+        import_metadata(api_key_local, cu_local_endpoint, new_json)
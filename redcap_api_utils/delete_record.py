@@ -1,5 +1,7 @@
 import requests
 import json
+import logging
+from delete_record_local import bulk_delete
 
 def read_api_config(config_file = './api_tokens.json'):
     api_token_file = config_file
@@ -24,7 +26,8 @@ def delete_record(record_id,api_key_local,cu_local_endpoint):
     print(r.text)
 
 if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
     api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config()
     record_id_list = [24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,51,52]
-    for record_id in record_id_list:
-        delete_record(record_id,api_key_local,cu_local_endpoint)
\ No newline at end of file
+    summary = bulk_delete(record_id_list, api_key_local, cu_local_endpoint)
+    logging.info('Delete summary: ' + str(summary))
\ No newline at end of file
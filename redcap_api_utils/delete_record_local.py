@@ -3,7 +3,11 @@ import json
 import argparse
 import pandas as pd
 import logging
+import os
+import time
+import csv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 
@@ -29,11 +33,157 @@ def delete_record(record_id,api_key_local,cu_local_endpoint):
     logging.debug('HTTP Status: ' + str(r.status_code))
     logging.debug(r.text)
 
+def export_records(session : requests.Session, record_id_list : list, api_key_local : str, cu_local_endpoint : str) -> list:
+    '''
+    Export all fields of the given records, used as the pre-delete backup
+    Input: session: requests session shared by the workers
+           record_id_list: a list of cuimc_ids
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+    Output: data: a list of records (flat, all fields)
+    '''
+    data = {
+        'token': api_key_local,
+        'content': 'record',
+        'action': 'export',
+        'format': 'json',
+        'type': 'flat',
+        'rawOrLabel': 'raw',
+        'rawOrLabelHeaders': 'raw',
+        'exportCheckboxLabel': 'false',
+        'exportSurveyFields': 'false',
+        'exportDataAccessGroups': 'false',
+        'returnFormat': 'json'
+    }
+    for i, record_id in enumerate(record_id_list):
+        data['records[' + str(i) + ']'] = str(record_id)
+    flag = 1
+    while(flag > 0 and flag < 5):
+        r = session.post(cu_local_endpoint, data=data)
+        if r.status_code == 200:
+            return r.json()
+        logging.error('Error occured in exporting records before delete. HTTP Status: ' + str(r.status_code) + '. ' + str(r.content))
+        flag = flag + 1
+        time.sleep(flag)
+    raise Exception('Failed to export records ' + str(record_id_list[0]) + '..' + str(record_id_list[-1]))
+
+def delete_records(session : requests.Session, record_id_list : list, api_key_local : str, cu_local_endpoint : str) -> int:
+    '''
+    Delete several records in a single API call
+    Input: session: requests session shared by the workers
+           record_id_list: a list of existing cuimc_ids
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+    Output: n_deleted: number of records deleted as reported by REDCap
+    '''
+    data = {
+        'token': api_key_local,
+        'action': 'delete',
+        'content': 'record',
+    }
+    for i, record_id in enumerate(record_id_list):
+        data['records[' + str(i) + ']'] = str(record_id)
+    flag = 1
+    while(flag > 0 and flag < 5):
+        r = session.post(cu_local_endpoint, data=data)
+        logging.debug('HTTP Status: ' + str(r.status_code))
+        if r.status_code == 200:
+            return int(r.text)
+        logging.error('Error occured in deleting records. HTTP Status: ' + str(r.status_code) + '. ' + str(r.content))
+        flag = flag + 1
+        time.sleep(flag)
+    raise Exception('Failed to delete records ' + str(record_id_list[0]) + '..' + str(record_id_list[-1]))
+
+def bulk_delete(record_id_list : list, api_key_local : str, cu_local_endpoint : str, chunk_size : int = 100, max_workers : int = 4, dry_run : bool = False, journal_file : str = None, backup_file : str = None) -> dict:
+    '''
+    Delete records in chunks of multi-record deletes with bounded concurrency
+    All records are exported first and saved to backup_file, so they can be imported
+    again if deleted by mistake. Ids that do not exist are skipped, since REDCap
+    rejects the whole delete call if one of the records does not exist.
+    Every id is written to journal_file with its status (deleted, failed, not_found, dry_run).
+    Input: record_id_list: a list of cuimc_ids
+           api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           chunk_size: number of records per delete call
+           max_workers: maximum number of concurrent calls
+           dry_run: only export and journal the records, do not delete
+           journal_file: csv journal of the deleted ids
+           backup_file: json export of the records before delete
+    Output: summary: a dict with number of deleted, failed and not found records
+    '''
+    date_string = datetime.now().strftime("%Y%m%d%H%M%S")
+    if journal_file is None:
+        journal_file = './delete_records_journal_' + date_string + '.csv'
+    if backup_file is None:
+        backup_file = './delete_records_backup_' + date_string + '.json'
+    record_id_list = [str(i) for i in dict.fromkeys(record_id_list)]
+    chunks = [record_id_list[i:i + chunk_size] for i in range(0, len(record_id_list), chunk_size)]
+    logging.info(f"Deleting {len(record_id_list)} records in {len(chunks)} chunks with {max_workers} workers{' (dry run)' if dry_run else ''}...")
+    start = time.time()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # pre-delete export for recovery
+    backup = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for records in executor.map(lambda chunk: export_records(session, chunk, api_key_local, cu_local_endpoint), chunks):
+            backup.extend(records)
+    with open(backup_file + '.tmp', 'w') as f:
+        json.dump(backup, f)
+    os.replace(backup_file + '.tmp', backup_file)
+    logging.info(f"Saved {len(backup)} rows of the records to be deleted to {backup_file}.")
+
+    existing_ids = set([str(r['cuimc_id']) for r in backup])
+    summary = {'deleted': 0, 'failed': 0, 'not_found': 0}
+    with open(journal_file, 'w', newline='') as journal:
+        writer = csv.writer(journal)
+        writer.writerow(['cuimc_id', 'status', 'time'])
+        def write_journal(ids, status):
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            writer.writerows([[i, status, now] for i in ids])
+            journal.flush()
+        missing_ids = [i for i in record_id_list if i not in existing_ids]
+        if missing_ids != []:
+            logging.warning(f"{len(missing_ids)} records do not exist and are skipped.")
+            write_journal(missing_ids, 'not_found')
+            summary['not_found'] = len(missing_ids)
+        chunks = [[i for i in chunk if i in existing_ids] for chunk in chunks]
+        chunks = [chunk for chunk in chunks if chunk != []]
+        if dry_run:
+            for chunk in chunks:
+                write_journal(chunk, 'dry_run')
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(delete_records, session, chunk, api_key_local, cu_local_endpoint): chunk for chunk in chunks}
+                # journal is only written from this thread
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        n_deleted = future.result()
+                        if n_deleted != len(chunk):
+                            logging.warning(f"REDCap reported {n_deleted} deleted records for a chunk of {len(chunk)}.")
+                        write_journal(chunk, 'deleted')
+                        summary['deleted'] = summary['deleted'] + len(chunk)
+                    except Exception as e:
+                        write_journal(chunk, 'failed')
+                        summary['failed'] = summary['failed'] + len(chunk)
+                        logging.error('Error occured in deleting records. ' + str(e))
+    session.close()
+    logging.info(f"Deleted {summary['deleted']} records in {time.time() - start:.1f}s, {summary['failed']} failed, {summary['not_found']} not found. Journal: {journal_file}")
+    return summary
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--log', type=str, required=False, help="file to write log",)    
     parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
     parser.add_argument('--delete_id_df', type=str, required=True, help='Path to the csv file containing the record ids to be deleted')
+    parser.add_argument('--chunk_size', type=int, required=False, default=100, help='number of records per delete call')
+    parser.add_argument('--max_workers', type=int, required=False, default=4, help='maximum number of concurrent delete calls')
+    parser.add_argument('--dry_run', action='store_true', help='only export and journal the records to be deleted')
+    parser.add_argument('--journal', type=str, required=False, help='csv journal of the deleted ids')
+    parser.add_argument('--backup', type=str, required=False, help='json export of the records before delete')
     args = parser.parse_args()
     
      # if token file is not provided, use the default token file
@@ -59,7 +209,6 @@ if __name__ == "__main__":
     delete_id_df = pd.read_csv(args.delete_id_df)
     record_id_list = delete_id_df['cuimc_id'].unique().tolist()
     api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file=token_file)
-    for record_id in record_id_list:
-        delete_record(record_id,api_key_local,cu_local_endpoint)
+    bulk_delete(record_id_list, api_key_local, cu_local_endpoint, chunk_size=args.chunk_size, max_workers=args.max_workers, dry_run=args.dry_run, journal_file=args.journal, backup_file=args.backup)
     logging.info('End program...')
     
@@ -4,6 +4,8 @@ from datetime import datetime
 import pandas as pd
 import logging
 import argparse
+import os
+from identity_index import open_identity_index, rebuild_identity_index, upsert_identities, remove_identities, lookup_keys, load_clusters, get_sync_state, set_sync_state, KEY_COLUMNS
    
 def read_api_config(config_file: str = '../api_tokens.json') -> tuple:
     '''
@@ -25,12 +27,13 @@ def read_api_config(config_file: str = '../api_tokens.json') -> tuple:
     r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
     return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
 
-def export_data_from_redcap(api_key : str, api_endpoint : str, is_local_record : bool = False) -> list:
+def export_data_from_redcap(api_key : str, api_endpoint : str, is_local_record : bool = False, date_range_begin : str = None) -> list:
     '''
     Export data from REDCap using API
     Input: api_key: API token
            api_endpoint: api endpoint url
            id_only: whether to export only id fields
+           date_range_begin: only export records created or modified after this time (YYYY-MM-DD HH:MM:SS)
     Output: data: a json object containing all the data from REDCap
     '''
     logging.info(f"Exporting data from {api_endpoint}...")
@@ -95,6 +98,8 @@ def export_data_from_redcap(api_key : str, api_endpoint : str, is_local_record :
         'exportDataAccessGroups': 'false',
         'returnFormat': 'json'
     }
+    if date_range_begin is not None:
+        data['dateRangeBegin'] = date_range_begin
     flag = 1
     while(flag > 0 and flag < 5):
         try:
@@ -120,7 +125,7 @@ def indexing_local_data(data: list) -> pd.DataFrame:
     Output: local_data_df: a dataframe containing all the local data
     '''
     logging.info("Indexing local dataset...")
-    if local_data != []:
+    if data != []:
         df = pd.DataFrame(data)
         # identify the fields for mapping purpose in local data
         # patch 6/6 match by child and parent seperatedly.
@@ -193,6 +198,124 @@ def de_duplicates(duplicates_df):
     not_to_delete_df = duplicates_df[duplicates_df['cuimc_id'].isin(cuimc_id_not_delete)]
     return R4_id_available_df,  declined_df, delete_df, not_to_delete_df
 
+def de_duplicates_grouped(duplicates_df):
+    '''
+    Same rules and outputs as de_duplicates, computed in one grouped pass
+    Each row gets its cluster (dob, first_local, last_local) and a decision flag. Decisions
+    are made per cuimc_id, i.e. a flag set on any row of a cuimc_id applies to all its rows.
+        1. if there is a R4 ID in the cluster, keep all records
+        2. if declined, keep the declined record with the largest cuimc id
+        3. if not declined, keep the record with the largest cuimc id
+    Input: duplicates_df: output of find_duplicates
+    Output: R4_id_available_df, declined_df, delete_df, not_to_delete_df as in de_duplicates
+    '''
+    df = duplicates_df.reset_index(drop=True)
+    cluster = df.groupby(['dob','first_local','last_local'], sort=False).ngroup()
+    cuimc_id = df['cuimc_id']
+    def cluster_any(mask):
+        return mask.groupby(cluster).transform('any')
+    def id_any(mask):
+        return mask.groupby(cuimc_id).transform('any')
+    def is_cluster_max(mask):
+        # largest cuimc id of the cluster among the rows in mask
+        return mask & (cuimc_id == cuimc_id.where(mask).groupby(cluster).transform('max'))
+
+    has_r4_id = df['record_id'] != ''
+    r4_cluster = cluster_any(has_r4_id)
+    r4_id = id_any(r4_cluster)
+    declined = ~r4_id & id_any((df['rec_outcome'] == '9') | (df['rec_outcome_2'] == '9') | (df['rec_outcome_3'] == '9'))
+    in_declined_cluster = id_any(~r4_id & cluster_any(declined))
+    not_declined = ~r4_id & ~in_declined_cluster
+    keep = r4_id | id_any(is_cluster_max(not_declined) | is_cluster_max(declined))
+    logging.info(f"Decisions: {r4_id.sum()} rows R4-linked keep, {(keep & declined).sum()} rows declined keep, {(keep & ~r4_id & ~declined).sum()} rows largest-id keep, {(~keep).sum()} rows delete.")
+
+    # R4 clusters in the order of their first row with a R4 ID, as the merge in de_duplicates returns them
+    position = pd.Series(range(df.shape[0]), dtype='float64')
+    first_r4_position = position.where(has_r4_id).groupby(cluster).transform('min')
+    R4_id_available_df = df[r4_cluster].assign(_order=first_r4_position[r4_cluster]).sort_values(by='_order', kind='stable').drop(columns=['_order']).drop_duplicates()
+    declined_df = df[declined]
+    delete_df = df[~keep]
+    not_to_delete_df = df[keep]
+    return R4_id_available_df,  declined_df, delete_df, not_to_delete_df
+
+def find_duplicates_incremental(api_key_local : str, cu_local_endpoint : str, index_db : str, full : bool = False) -> tuple:
+    '''
+    Find duplicates using the persistent identity index
+    On the first run (or if full is True) all local records are exported and the index is rebuilt.
+    Afterwards only records created or modified since the last run are exported. They are
+    upserted into the index, and only the clusters they left or joined are checked again.
+    Records deleted from REDCap are not reported by the change watermark, run with full
+    from time to time to drop them from the index.
+    Input: api_key_local: API token for local
+           cu_local_endpoint: local api endpoint
+           index_db: path to the identity index database
+           full: whether to rebuild the index from a full export
+    Output: duplicates_df: the duplicates in the checked clusters, same layout as find_duplicates
+            keys_df: the (dob, first_local, last_local) keys checked, None after a full run
+    '''
+    conn = open_identity_index(index_db)
+    watermark = get_sync_state(conn, 'last_run')
+    # take the time before the export so that changes made during the run are picked up next time
+    run_start = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if full or watermark is None:
+        logging.info("Full duplicate check, rebuilding identity index...")
+        local_data = export_data_from_redcap(api_key_local, cu_local_endpoint, is_local_record=True)
+        if local_data == {}:
+            raise Exception("Error occurred during data export from local REDCap")
+        local_data_df = indexing_local_data(local_data)
+        rebuild_identity_index(conn, local_data_df)
+        set_sync_state(conn, 'last_run', run_start)
+        conn.close()
+        return find_duplicates(local_data_df), None
+
+    logging.info(f"Incremental duplicate check of records changed since {watermark}...")
+    changed_data = export_data_from_redcap(api_key_local, cu_local_endpoint, is_local_record=True, date_range_begin=watermark)
+    if changed_data == {}:
+        raise Exception("Error occurred during data export from local REDCap")
+    changed_ids = list(set([int(r['cuimc_id']) for r in changed_data if str(r.get('cuimc_id', '')).strip() != '']))
+    changed_df = indexing_local_data(changed_data)
+    logging.info(f"{len(changed_ids)} records changed since last run.")
+    # a changed record may leave its old cluster, so the old keys are checked as well
+    keys_df = lookup_keys(conn, changed_ids)
+    if changed_df.shape[0] > 0:
+        # records without a first name are not indexed, drop their old entry
+        remove_identities(conn, [i for i in changed_ids if i not in set(changed_df['cuimc_id'])])
+        upsert_identities(conn, changed_df)
+        keys_df = pd.concat([keys_df, changed_df[KEY_COLUMNS]])
+    else:
+        remove_identities(conn, changed_ids)
+    keys_df = keys_df.drop_duplicates().reset_index(drop=True)
+    cluster_df = load_clusters(conn, keys_df)
+    logging.info(f"Checking {cluster_df.shape[0]} indexed records in {keys_df.shape[0]} clusters.")
+    duplicates_df = find_duplicates(cluster_df)
+    set_sync_state(conn, 'last_run', run_start)
+    conn.close()
+    return duplicates_df, keys_df
+
+def update_report(report_df : pd.DataFrame, report_file : str, keys_df : pd.DataFrame):
+    '''
+    Append newly checked clusters to an existing report
+    Rows of the existing report in the checked clusters are replaced, other rows are kept.
+    Input: report_df: rows of the checked clusters
+           report_file: path to the report csv
+           keys_df: the (dob, first_local, last_local) keys checked
+    '''
+    if not os.path.exists(report_file):
+        report_df.to_csv(report_file, index=False)
+        return
+    existing_df = pd.read_csv(report_file, dtype=str, keep_default_na=False)
+    keys = keys_df[KEY_COLUMNS].copy()
+    keys['dob'] = keys['dob'].dt.strftime('%Y-%m-%d')
+    keys = keys.fillna('').drop_duplicates()
+    existing_df = existing_df.merge(keys, how='left', on=KEY_COLUMNS, indicator=True)
+    n_replaced = (existing_df['_merge'] == 'both').sum()
+    existing_df = existing_df[existing_df['_merge'] == 'left_only'].drop(columns=['_merge'])
+    tmp_file = report_file + '.tmp'
+    existing_df.to_csv(tmp_file, index=False)
+    report_df[existing_df.columns].to_csv(tmp_file, index=False, header=False, mode='a')
+    os.replace(tmp_file, report_file)
+    logging.info(f"{report_file}: replaced {n_replaced} rows with {report_df.shape[0]} rows.")
+
     
 if __name__ == "__main__":
 
@@ -200,6 +323,9 @@ if __name__ == "__main__":
     parser.add_argument('--log', type=str, required=False, help="file to write log",)    
     parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
     parser.add_argument('--output_prefix', type=str, required=False, help='prefix of output files')
+    parser.add_argument('--incremental', action='store_true', help='only check records changed since the last run and update the reports')
+    parser.add_argument('--index', type=str, required=False, default='./identity_index.db', help='sqlite identity index used by the incremental mode')
+    parser.add_argument('--full', action='store_true', help='rebuild the identity index from a full export')
     args = parser.parse_args()
 
     # if token file is not provided, use the default token file
@@ -229,12 +355,18 @@ if __name__ == "__main__":
     dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
 
     api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
-    local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, is_local_record=True)
-    local_data_df = indexing_local_data(local_data)
-    duplicates_df = find_duplicates(local_data_df)
-    R4_id_available_df,  declined_df, delete_df, not_to_delete_df = de_duplicates(duplicates_df)
-    declined_df.to_csv(output_prefix + '_declined.csv', index=False)
-    R4_id_available_df.to_csv(output_prefix + '_R4_id_available.csv', index=False)
-    delete_df.to_csv(output_prefix + '_to_delete.csv', index=False)
-    not_to_delete_df.to_csv(output_prefix + '_not_to_delete.csv', index=False)
+    if args.incremental or args.full:
+        duplicates_df, keys_df = find_duplicates_incremental(api_key_local, cu_local_endpoint, args.index, full=args.full)
+    else:
+        local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, is_local_record=True)
+        local_data_df = indexing_local_data(local_data)
+        duplicates_df = find_duplicates(local_data_df)
+        keys_df = None
+    R4_id_available_df,  declined_df, delete_df, not_to_delete_df = de_duplicates_grouped(duplicates_df)
+    reports = {'_declined.csv': declined_df, '_R4_id_available.csv': R4_id_available_df, '_to_delete.csv': delete_df, '_not_to_delete.csv': not_to_delete_df}
+    for suffix, report_df in reports.items():
+        if keys_df is None:
+            report_df.to_csv(output_prefix + suffix, index=False)
+        else:
+            update_report(report_df, output_prefix + suffix, keys_df)
     logging.info('End program...')
@@ -0,0 +1,60 @@
+import sqlite3
+import time
+import pandas as pd
+from sqlite_cache import open_cache, select_by_keys, write_rows
+
+def open_empi_cache(db_path : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the SQLite MRN to EMPI cache
+    Input: db_path: path to the cache database
+    Output: conn: sqlite3 connection to the cache
+    '''
+    return open_cache(db_path, 'EMPI', '''
+        CREATE TABLE IF NOT EXISTS empi_cache (
+            mrn TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            empis TEXT NOT NULL,
+            cached_at REAL NOT NULL
+        )''')
+
+def read_empi_cache(conn : sqlite3.Connection, mrn_list : list, ttl : int = 2592000, negative_ttl : int = 86400, now : float = None) -> tuple:
+    '''
+    Read the fresh cache entries of the given MRNs
+    Unique mappings are kept for ttl seconds. Ambiguous and missing mappings are negative
+    entries, they are kept for negative_ttl seconds so that new mappings are picked up sooner.
+    Input: conn: sqlite3 connection to the cache
+           mrn_list: a list of MRNs
+           ttl: maximum age in seconds of a unique mapping
+           negative_ttl: maximum age in seconds of an ambiguous or missing mapping
+           now: current time, time.time() if not provided
+    Output: mapping_df: the cached (MRN, EMPI) pairs, in the layout of resolve_empi
+            cached_mrns: the set of MRNs with a fresh entry, including negative ones
+    '''
+    if now is None:
+        now = time.time()
+    rows = select_by_keys(conn, ['mrn'], [(str(mrn),) for mrn in mrn_list], '''
+        SELECT c.mrn, c.empis FROM empi_cache c
+        JOIN temp.query_keys q ON q.mrn = c.mrn
+        WHERE (c.status = 'unique' AND c.cached_at >= ?) OR (c.status != 'unique' AND c.cached_at >= ?)''', (now - ttl, now - negative_ttl))
+    pairs = [(mrn, empi) for mrn, empis in rows for empi in empis.split(',') if empi != '']
+    mapping_df = pd.DataFrame(pairs, columns=['MRN', 'EMPI'])
+    return mapping_df, set([mrn for mrn, _ in rows])
+
+def write_empi_cache(conn : sqlite3.Connection, mrn_list : list, mapping_df : pd.DataFrame, now : float = None):
+    '''
+    Store the warehouse lookup of the given MRNs, including MRNs without any mapping
+    Input: conn: sqlite3 connection to the cache
+           mrn_list: the MRNs that were looked up
+           mapping_df: output of resolve_empi for these MRNs
+           now: current time, time.time() if not provided
+    '''
+    if now is None:
+        now = time.time()
+    empis = mapping_df.groupby('MRN')['EMPI'].agg(lambda x: ','.join(sorted(set(x))))
+    rows = []
+    for mrn in set([str(mrn) for mrn in mrn_list]):
+        mrn_empis = empis.get(mrn, '')
+        n_empi = len(mrn_empis.split(',')) if mrn_empis != '' else 0
+        status = 'unique' if n_empi == 1 else ('ambiguous' if n_empi > 1 else 'missing')
+        rows.append((mrn, status, mrn_empis, now))
+    write_rows(conn, 'empi_cache', ['mrn', 'status', 'empis', 'cached_at'], rows)
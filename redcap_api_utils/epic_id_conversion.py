@@ -2,13 +2,13 @@ import requests
 import json
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import logging
 import argparse
 
-import sqlalchemy
 import urllib
 import configparser
-import pyodbc
+from empi_cache import open_empi_cache, read_empi_cache, write_empi_cache
 
 def read_api_config(config_file):
     logging.info("Reading api tokens and endpoint url...")
@@ -24,6 +24,9 @@ def read_api_config(config_file):
 
 def read_sql_connection(configFile='/projects/phi/cl3720/db.conf', database = 'ohdsi_cumc_2022q3r1'):
     logging.info("Reading sql configuration...")
+    # the warehouse drivers are only needed here, the lookups also run against a DB-API stand-in
+    import sqlalchemy
+    import pyodbc
     config = configparser.ConfigParser()
     config.read('/projects/phi/cl3720/db.conf')
         # self.config.sections()
@@ -37,7 +40,11 @@ def read_sql_connection(configFile='/projects/phi/cl3720/db.conf', database = 'o
     cursor = cnxn.cursor()
     return engine, cursor, cnxn
 
-def get_local_mrn(api_key_local,cu_local_endpoint):
+def get_local_mrn(api_key_local,cu_local_endpoint, pending_only = True):
+    '''
+    export cuimc_id, mrn, cuimc_empi
+    if pending_only, only the records with a mrn and no cuimc_empi are exported
+    '''
     logging.info('Export records...')
     data = {
     'token': api_key_local,
@@ -56,49 +63,135 @@ def get_local_mrn(api_key_local,cu_local_endpoint):
     'exportDataAccessGroups': 'false',
     'returnFormat': 'json'
 }
+    if pending_only:
+        data['filterLogic'] = "[cuimc_empi] = '' and [mrn] <> ''"
+    records = None
     flag = 1
     while(flag > 0 and flag < 5):
         r = requests.post(cu_local_endpoint,data=data)
         if r.status_code == 200:
             logging.info('HTTP Status: ' + str(r.status_code))
             records = r.json()
+            logging.info(f"Exported {len(records)} records.")
             flag = 0
         else:
             logging.error('Error occured in exporting data from ' + cu_local_endpoint)
             logging.error('HTTP Status: ' + str(r.status_code))
             logging.error(r.content)
             flag = flag + 1
+    if records is None:
+        raise Exception('Error occured in exporting data from ' + cu_local_endpoint)
     return records
 
-def convert_to_empi(records,cnxn):
+def resolve_empi(mrn_list, cnxn, mapping_table = '[mappings].[patient_mappings]', chunk_size = 1000):
+    '''
+    Look up the EMPIs of many MRNs with a few parameterized queries
+    An MRN matches a mapping row if it is the EMPI itself, or the LOCAL_PT_ID of facility P or UI.
+    The input MRNs are carried through the query as input_mrn and returned as MRN, so that an MRN the
+    warehouse matches through trailing spaces, collation or a numeric LOCAL_PT_ID is not reported missing.
+    Input: mrn_list: a list of MRNs
+           cnxn: DB-API connection to the warehouse (or a SQLite stand-in of the mapping table)
+           mapping_table: name of the mapping table
+           chunk_size: number of MRNs per query, SQL Server allows 2100 parameters per query
+    Output: mapping_df: a dataframe of distinct (MRN, EMPI) pairs, as strings, MRN as given in mrn_list
+    '''
+    mrn_list = list(dict.fromkeys([str(mrn) for mrn in mrn_list]))
+    logging.info(f"Resolving {len(mrn_list)} MRNs in chunks of {chunk_size}...")
+    mapping_dfs = []
+    for i in range(0, len(mrn_list), chunk_size):
+        chunk = mrn_list[i:i + chunk_size]
+        # UNION ALL rather than a VALUES table, the SQLite stand-in has no derived column lists
+        input_mrns = 'SELECT ? AS input_mrn' + ' UNION ALL SELECT ?' * (len(chunk) - 1)
+        by_empi_sql = '''
+                SELECT DISTINCT Q.input_mrn AS MRN, M.EMPI
+                FROM ({q}) Q
+                JOIN {t} M ON M.EMPI = Q.input_mrn
+            '''.format(t = mapping_table, q = input_mrns)
+        by_local_id_sql = '''
+                SELECT DISTINCT Q.input_mrn AS MRN, M.EMPI
+                FROM ({q}) Q
+                JOIN {t} M ON M.LOCAL_PT_ID = Q.input_mrn
+                WHERE M.FACILITY_CODE = 'P' OR M.FACILITY_CODE = 'UI'
+            '''.format(t = mapping_table, q = input_mrns)
+        mapping_dfs.append(pd.read_sql(by_empi_sql, cnxn, params=chunk))
+        mapping_dfs.append(pd.read_sql(by_local_id_sql, cnxn, params=chunk))
+    mapping_df = pd.concat(mapping_dfs) if mapping_dfs != [] else pd.DataFrame(columns=['MRN', 'EMPI'])
+    mapping_df = mapping_df.dropna().astype(str).drop_duplicates().reset_index(drop=True)
+    return mapping_df
+
+def resolve_empi_cached(mrn_list, cnxn, cache_db, mapping_table = '[mappings].[patient_mappings]', chunk_size = 1000, ttl = 2592000, negative_ttl = 86400):
+    '''
+    Look up the EMPIs of many MRNs, querying the warehouse only for MRNs without a fresh cache entry
+    Input: mrn_list: a list of MRNs
+           cnxn: DB-API connection to the warehouse
+           cache_db: path to the SQLite EMPI cache
+           mapping_table: name of the mapping table
+           chunk_size: number of MRNs per query
+           ttl: maximum age in seconds of a cached unique mapping
+           negative_ttl: maximum age in seconds of a cached ambiguous or missing mapping
+    Output: mapping_df: a dataframe of distinct (MRN, EMPI) pairs, as strings
+    '''
+    mrn_list = list(dict.fromkeys([str(mrn) for mrn in mrn_list]))
+    conn = open_empi_cache(cache_db)
+    cached_df, cached_mrns = read_empi_cache(conn, mrn_list, ttl=ttl, negative_ttl=negative_ttl)
+    missed_mrns = [mrn for mrn in mrn_list if mrn not in cached_mrns]
+    logging.info(f"EMPI cache: {len(cached_mrns)} hits, {len(missed_mrns)} misses.")
+    resolved_df = resolve_empi(missed_mrns, cnxn, mapping_table=mapping_table, chunk_size=chunk_size)
+    write_empi_cache(conn, missed_mrns, resolved_df)
+    conn.close()
+    return pd.concat([cached_df, resolved_df]).reset_index(drop=True)
+
+def classify_empi(mrn_df, mapping_df):
+    '''
+    Classify the EMPI lookup of each MRN as unique, ambiguous or missing
+    Input: mrn_df: a dataframe with a mrn column
+           mapping_df: output of resolve_empi
+    Output: mrn_df with an empi_status column, and the EMPI in cuimc_empi if unique
+    MRNs are matched on the input_mrn carried by resolve_empi, not on the warehouse LOCAL_PT_ID.
+    '''
+    n_empi = mapping_df.groupby('MRN')['EMPI'].nunique()
+    unique_empi = mapping_df[mapping_df['MRN'].isin(n_empi[n_empi == 1].index)].drop_duplicates('MRN').set_index('MRN')['EMPI']
+    counts = mrn_df['mrn'].astype(str).map(n_empi).fillna(0)
+    mrn_df = mrn_df.copy()
+    mrn_df['empi_status'] = np.select([counts == 1, counts > 1], ['unique', 'ambiguous'], default='missing')
+    mrn_df['cuimc_empi'] = mrn_df['mrn'].astype(str).map(unique_empi).fillna('')
+    return mrn_df
+
+def convert_to_empi(records, cnxn, mapping_table = '[mappings].[patient_mappings]', chunk_size = 1000, cache_db = None, ttl = 2592000, negative_ttl = 86400):
     '''
     input has 3 keys: cuimc_id, mrn, cuimc_empi
+    if cache_db is provided, MRNs with a fresh entry in the EMPI cache are not sent to the warehouse
+    returns only the records with a newly converted cuimc_empi
     '''
     logging.info('Convert to EMPI...')
+    records_df = pd.DataFrame(records, columns=['cuimc_id', 'mrn', 'cuimc_empi']).fillna('')
+    has_empi = records_df['cuimc_empi'] != ''
+    no_mrn = ~has_empi & (records_df['mrn'] == '')
+    logging.info(f"EMPI field is not empty for {has_empi.sum()} records.")
+    for cuimc_id in records_df.loc[no_mrn, 'cuimc_id']:
+        logging.error("MRN empty for CUIMC ID: " +  str(cuimc_id))
+    pending_df = records_df[~has_empi & ~no_mrn]
+    if cache_db is None:
+        mapping_df = resolve_empi(pending_df['mrn'].tolist(), cnxn, mapping_table=mapping_table, chunk_size=chunk_size)
+    else:
+        mapping_df = resolve_empi_cached(pending_df['mrn'].tolist(), cnxn, cache_db, mapping_table=mapping_table, chunk_size=chunk_size, ttl=ttl, negative_ttl=negative_ttl)
+    pending_df = classify_empi(pending_df, mapping_df)
+    for _, record in pending_df[pending_df['empi_status'] != 'unique'].iterrows():
+        logging.error("EMPI " + record['empi_status'] + " for CUIMC ID: " + str(record['cuimc_id']) + ", MRN: " + str(record['mrn']))
+    logging.info(f"EMPI converted for {(pending_df['empi_status'] == 'unique').sum()} records, {(pending_df['empi_status'] == 'ambiguous').sum()} ambiguous, {(pending_df['empi_status'] == 'missing').sum()} missing.")
+    converted = pending_df[pending_df['empi_status'] == 'unique']
+    converted = dict(zip(converted['cuimc_id'], converted['cuimc_empi']))
+    changed_records = []
     for record in records:
-        if record['cuimc_empi'] != '':
-            logging.error("EMPI field is not empty for CUIMC ID: " +  record['cuimc_id'])
-            continue
-        mrn = record['mrn']
-        if mrn == '':
-            logging.error("MRN empty for CUIMC ID: " +  record['cuimc_id'])
-            continue
-        sql = '''
-                SELECT DISTINCT M.EMPI
-                FROM [mappings].[patient_mappings] M 
-                where M.EMPI IN ({l}) or (M.LOCAL_PT_ID IN ({l}) AND (M.FACILITY_CODE = 'P' OR M.FACILITY_CODE = 'UI'))
-            '''.format(l = "'" + str(mrn) + "'" )
-        mapping_df = pd.read_sql(sql,cnxn)
-        if len(mapping_df['EMPI'].tolist()) == 1:
-            # unique mapping
-            record['cuimc_empi'] = str(mapping_df['EMPI'].tolist()[0])
-            logging.info("EMPI converted for CUIMC ID: " +  record['cuimc_id'])
-
-        else:
-            logging.error("EMPI not unique for CUIMC ID: " +  record['cuimc_id'])
-            logging.error(mrn)
-            logging.error(mapping_df)
+        if record['cuimc_empi'] == '' and record['mrn'] != '' and record['cuimc_id'] in converted:
+            record['cuimc_empi'] = converted[record['cuimc_id']]
+            changed_records.append(record)
+    return changed_records
 
+def build_import_data(records, api_key_local):
+    '''
+    build the import payload of the given records
+    '''
     upload_data = json.dumps(records)
     data = {
         'token': api_key_local,
@@ -127,6 +220,20 @@ def execute_import(data, cu_local_endpoint, flag = 1, max_try = 5):
             logging.error('Error occured in importing data to ' + cu_local_endpoint)
             logging.error(r.content)
             flag = flag + 1
+    return flag == 0
+
+def import_in_chunks(records, api_key_local, cu_local_endpoint, chunk_size = 500):
+    '''
+    import the changed records in chunks of chunk_size
+    '''
+    n_failed = 0
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        if not execute_import(build_import_data(chunk, api_key_local), cu_local_endpoint):
+            n_failed = n_failed + len(chunk)
+            logging.error('Failed to import CUIMC IDs ' + ', '.join([str(record['cuimc_id']) for record in chunk]))
+    logging.info(f"Imported {len(records) - n_failed} records, {n_failed} failed.")
+    return n_failed
 
 
 if __name__ == "__main__":
@@ -135,7 +242,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--log', type=str, required=True, help="file to write log",)    
     parser.add_argument('--token', type=str, required=True, help='json file with api tokens')    
+    parser.add_argument('--mapping_table', type=str, required=False, default='[mappings].[patient_mappings]', help='MRN to EMPI mapping table')
+    parser.add_argument('--chunk_size', type=int, required=False, default=1000, help='number of MRNs per query')
+    parser.add_argument('--cache', type=str, required=False, default='./empi_cache.db', help='sqlite MRN to EMPI cache')
+    parser.add_argument('--no_cache', action='store_true', help='always query the warehouse')
+    parser.add_argument('--cache_ttl', type=int, required=False, default=2592000, help='maximum age in seconds of a cached EMPI')
+    parser.add_argument('--negative_cache_ttl', type=int, required=False, default=86400, help='maximum age in seconds of a cached ambiguous or missing EMPI')
+    parser.add_argument('--import_chunk_size', type=int, required=False, default=500, help='number of records per import call')
+    parser.add_argument('--warm_cache', action='store_true', help='look up the MRNs of all local records without a fresh cache entry, store them in the cache and exit, e.g. off business hours')
     args = parser.parse_args()
+    if args.warm_cache and args.no_cache:
+        parser.error('--warm_cache fills the cache, it cannot be used with --no_cache')
     log_file = args.log
     token_file = args.token
     
@@ -147,8 +264,12 @@ if __name__ == "__main__":
     logging.info("Current Time =" +  dt_string)
 
     api_key_local, _, cu_local_endpoint, _ = read_api_config(config_file = token_file)
-    print(api_key_local)
     engine, cursor, cnxn = read_sql_connection()
-    records = get_local_mrn(api_key_local, cu_local_endpoint)
-    upload_data = convert_to_empi(records,cnxn)
-    execute_import(upload_data,cu_local_endpoint)    
+    cache_db = None if args.no_cache else args.cache
+    records = get_local_mrn(api_key_local, cu_local_endpoint, pending_only=not args.warm_cache)
+    if args.warm_cache:
+        mrn_list = [record['mrn'] for record in records if record['mrn'] != '']
+        resolve_empi_cached(mrn_list, cnxn, args.cache, mapping_table=args.mapping_table, chunk_size=args.chunk_size, ttl=args.cache_ttl, negative_ttl=args.negative_cache_ttl)
+    else:
+        changed_records = convert_to_empi(records, cnxn, mapping_table=args.mapping_table, chunk_size=args.chunk_size, cache_db=cache_db, ttl=args.cache_ttl, negative_ttl=args.negative_cache_ttl)
+        import_in_chunks(changed_records, api_key_local, cu_local_endpoint, chunk_size=args.import_chunk_size)    
@@ -0,0 +1,289 @@
+import json
+from datetime import datetime
+import time
+import pandas as pd
+import numpy as np
+import logging
+import argparse
+from duplicate_marker_local import read_api_config, export_data_from_redcap, indexing_local_data
+
+# names longer than this are truncated before scoring
+MAX_NAME_LENGTH = 20
+# weight of the name similarity in the pair score, the rest is on dob
+NAME_WEIGHT = 0.6
+
+# American soundex codes. vowels and y are 0 (separators, dropped at the end), h and w are removed.
+SOUNDEX_TABLE = str.maketrans('abcdefghijklmnopqrstuvwxyz', '01230120022455012623010202', 'hw')
+
+def normalize_names(names: pd.Series) -> pd.DataFrame:
+    '''
+    Normalize a name column for fuzzy matching
+    Input: names: a pandas series of names
+    Output: a dataframe with the letters-only full name, and the first and last token of
+            hyphenated / multi-part names
+    '''
+    names = names.fillna('').astype(str).str.lower()
+    tokens = names.str.findall(r'[a-z]+')
+    return pd.DataFrame({
+        'full': tokens.str.join('').str[:MAX_NAME_LENGTH],
+        'first_token': tokens.str[0].fillna('').str[:MAX_NAME_LENGTH],
+        'last_token': tokens.str[-1].fillna('').str[:MAX_NAME_LENGTH],
+    }, index=names.index)
+
+def soundex(names: pd.Series) -> pd.Series:
+    '''
+    Vectorized American soundex of letters-only, lower case names
+    Input: names: a pandas series of normalized names
+    Output: a pandas series of 4 character soundex codes, '' for empty names
+    '''
+    first = names.str[:1]
+    codes = names.str.translate(SOUNDEX_TABLE)
+    # collapse adjacent letters with the same code
+    codes = codes.str.replace(r'(\d)\1+', r'\1', regex=True)
+    # the first letter keeps its letter, drop its code unless it was h/w (removed)
+    codes = codes.where(first.isin(['h', 'w']), codes.str[1:])
+    codes = codes.str.replace('0', '', regex=False)
+    return (first.str.upper() + codes + '000').str[:4].where(names != '', '')
+
+def levenshtein_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''
+    Vectorized normalized Levenshtein similarity of two aligned arrays of strings
+    The edit distance matrix is filled row by row for all pairs at once.
+    Input: a, b: numpy arrays of strings of the same length
+    Output: similarity: 1 - distance / longest length, 0 if both strings are empty
+    '''
+    n = len(a)
+    if n == 0:
+        return np.zeros(0)
+    a = np.asarray(a, dtype='U' + str(MAX_NAME_LENGTH))
+    b = np.asarray(b, dtype='U' + str(MAX_NAME_LENGTH))
+    len_a = np.char.str_len(a)
+    len_b = np.char.str_len(b)
+    max_len = max(int(len_a.max()), int(len_b.max()), 1)
+    # (position, pair) layout so that every step works on contiguous rows
+    codes_a = np.ascontiguousarray(a.view(np.uint32).reshape(n, MAX_NAME_LENGTH)[:, :max_len].T)
+    codes_b = np.ascontiguousarray(b.view(np.uint32).reshape(n, MAX_NAME_LENGTH)[:, :max_len].T)
+    prev = np.repeat(np.arange(max_len + 1, dtype=np.int16)[:, None], n, axis=1)
+    distance = np.where(len_a == 0, len_b, 0).astype(np.int16)
+    pair_index = np.arange(n)
+    for i in range(1, max_len + 1):
+        cur = np.empty_like(prev)
+        cur[0] = i
+        for j in range(1, max_len + 1):
+            cur[j] = np.minimum(np.minimum(prev[j] + 1, cur[j - 1] + 1), prev[j - 1] + (codes_a[i - 1] != codes_b[j - 1]))
+        done = len_a == i
+        distance[done] = cur[len_b[done], pair_index[done]]
+        prev = cur
+    longest = np.maximum(len_a, len_b)
+    return np.where(longest > 0, 1 - distance / np.maximum(longest, 1), 0.0)
+
+def block_pairs(keys: np.ndarray, max_block_size: int = 1000) -> np.ndarray:
+    '''
+    All pairs of records sharing a blocking key
+    Input: keys: an int64 blocking key per record, -1 for records without a key
+           max_block_size: blocks larger than this are skipped (e.g. a placeholder dob)
+    Output: pair codes i * n + j with i < j
+    '''
+    n = len(keys)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    _, block_start, block_size = np.unique(sorted_keys, return_index=True, return_counts=True)
+    valid = np.repeat((block_size <= max_block_size) & (block_size > 1), block_size)
+    valid = valid & (sorted_keys != -1)
+    skipped = block_size[block_size > max_block_size]
+    if len(skipped) > 0:
+        logging.warning(f"Skipped {len(skipped)} blocks larger than {max_block_size} records ({skipped.sum()} records)")
+    pos = np.nonzero(valid)[0]
+    pairs = []
+    offset = 1
+    # pairs (p, p + offset) inside the same block. A position drops out once p + offset leaves its block.
+    while len(pos) > 0:
+        pos = pos[pos + offset < n]
+        pos = pos[sorted_keys[pos + offset] == sorted_keys[pos]]
+        if len(pos) == 0:
+            break
+        i = order[pos]
+        j = order[pos + offset]
+        pairs.append(np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j))
+        offset = offset + 1
+    if pairs == []:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs)
+
+def sorted_neighborhood_pairs(sort_key: pd.Series, window: int = 5) -> np.ndarray:
+    '''
+    Pairs of records within window positions of each other after sorting on sort_key
+    Input: sort_key: a pandas series of strings
+           window: size of the sliding window
+    Output: pair codes i * n + j with i < j
+    '''
+    n = len(sort_key)
+    order = np.argsort(sort_key.to_numpy(dtype=str), kind='stable')
+    pairs = []
+    for offset in range(1, window):
+        i = order[:n - offset]
+        j = order[offset:]
+        pairs.append(np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j))
+    if pairs == []:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs)
+
+def prepare_candidates(local_data_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Normalized names, phonetic codes and dob parts of the records to be compared
+    Input: local_data_df: output of indexing_local_data
+    Output: a dataframe with one row per record
+    '''
+    df = local_data_df[local_data_df['child_first'] == ''][['cuimc_id', 'first_local', 'last_local', 'dob']].reset_index(drop=True)
+    first = normalize_names(df['first_local'])
+    last = normalize_names(df['last_local'])
+    dob = pd.to_datetime(df['dob'], errors='coerce')
+    return pd.DataFrame({
+        'cuimc_id': df['cuimc_id'].to_numpy(),
+        'first': first['full'], 'first_first_token': first['first_token'], 'first_last_token': first['last_token'],
+        'last': last['full'], 'last_first_token': last['first_token'], 'last_last_token': last['last_token'],
+        'first_soundex': soundex(first['full']), 'last_soundex': soundex(last['full']),
+        'dob_year': dob.dt.year.fillna(-1).astype(int).to_numpy(),
+        'dob_month': dob.dt.month.fillna(-1).astype(int).to_numpy(),
+        'dob_day': dob.dt.day.fillna(-1).astype(int).to_numpy(),
+        'dob_key': np.where(dob.isna(), -1, dob.to_numpy(dtype='datetime64[D]').astype(np.int64)),
+    })
+
+def candidate_pairs(candidates: pd.DataFrame, window: int = 5, max_block_size: int = 1000) -> tuple:
+    '''
+    Candidate pairs from three blocking passes
+    1. same dob, and at least one initial in common in either name order
+    2. same soundex of the last name and same birth year
+    3. sorted neighborhood on the name with first/last in alphabetical order
+    Input: candidates: output of prepare_candidates
+           window: size of the sorted neighborhood window
+           max_block_size: blocks larger than this are skipped
+    Output: i, j: aligned arrays of record positions in candidates
+    '''
+    n = len(candidates)
+    dob_pairs = block_pairs(candidates['dob_key'].to_numpy(), max_block_size)
+    i, j = dob_pairs // n, dob_pairs % n
+    initials = np.stack([candidates['first'].str[:1].to_numpy(dtype=str), candidates['last'].str[:1].to_numpy(dtype=str)])
+    same_initial = (initials[0, i] == initials[0, j]) | (initials[1, i] == initials[1, j]) | (initials[0, i] == initials[1, j]) | (initials[1, i] == initials[0, j])
+    dob_pairs = dob_pairs[same_initial]
+    soundex_key = (candidates['last_soundex'] + '|' + candidates['dob_year'].astype(str)).where(candidates['last_soundex'] != '', '')
+    soundex_key = np.where(soundex_key == '', -1, pd.util.hash_array(soundex_key.to_numpy(dtype=object)).astype(np.int64) & 0x7FFFFFFFFFFFFFFF)
+    soundex_pairs = block_pairs(soundex_key, max_block_size)
+    name_key = pd.Series(np.where(candidates['first'] <= candidates['last'], candidates['first'] + ' ' + candidates['last'], candidates['last'] + ' ' + candidates['first']))
+    neighborhood_pairs = sorted_neighborhood_pairs(name_key, window)
+    logging.info(f"Candidate pairs: {len(dob_pairs)} by dob, {len(soundex_pairs)} by soundex, {len(neighborhood_pairs)} by sorted neighborhood")
+    pairs = np.unique(np.concatenate([dob_pairs, soundex_pairs, neighborhood_pairs]))
+    return pairs // n, pairs % n
+
+def score_pairs(candidates: pd.DataFrame, i: np.ndarray, j: np.ndarray) -> pd.DataFrame:
+    '''
+    Score candidate pairs on name similarity (either name order) and dob agreement
+    Input: candidates: output of prepare_candidates
+           i, j: aligned arrays of record positions in candidates
+    Output: a dataframe with first_sim, last_sim, name_swapped, dob_score and score per pair
+    '''
+    def col(name, idx):
+        return candidates[name].to_numpy(dtype=str)[idx]
+    def name_sim(name_i, name_j):
+        # letters-only full name, or the first / last part of a hyphenated or multi-part name
+        return np.maximum.reduce([
+            levenshtein_similarity(col(name_i, i), col(name_j, j)),
+            levenshtein_similarity(col(name_i + '_first_token', i), col(name_j + '_first_token', j)),
+            levenshtein_similarity(col(name_i + '_last_token', i), col(name_j + '_last_token', j)),
+        ])
+    first_sim = name_sim('first', 'first')
+    last_sim = name_sim('last', 'last')
+    swapped_first_sim = name_sim('first', 'last')
+    swapped_last_sim = name_sim('last', 'first')
+    name_swapped = (swapped_first_sim + swapped_last_sim) > (first_sim + last_sim)
+    name_score = np.where(name_swapped, swapped_first_sim + swapped_last_sim, first_sim + last_sim) / 2
+
+    year, month, day = [candidates[c].to_numpy() for c in ['dob_year', 'dob_month', 'dob_day']]
+    has_dob = (year[i] != -1) & (year[j] != -1)
+    n_equal = (year[i] == year[j]).astype(int) + (month[i] == month[j]) + (day[i] == day[j])
+    month_day_swapped = (year[i] == year[j]) & (month[i] == day[j]) & (day[i] == month[j]) & (month[i] != day[i])
+    dob_score = np.select([~has_dob, n_equal == 3, month_day_swapped, n_equal == 2], [0.0, 1.0, 0.8, 0.6], default=0.0)
+    return pd.DataFrame({
+        'first_sim': np.where(name_swapped, swapped_first_sim, first_sim).round(3),
+        'last_sim': np.where(name_swapped, swapped_last_sim, last_sim).round(3),
+        'name_swapped': name_swapped,
+        'dob_score': dob_score,
+        'score': (NAME_WEIGHT * name_score + (1 - NAME_WEIGHT) * dob_score).round(3),
+    })
+
+def find_fuzzy_duplicates(local_data_df: pd.DataFrame, threshold: float = 0.85, window: int = 5, max_block_size: int = 1000, batch_size: int = 1000000) -> pd.DataFrame:
+    '''
+    Find likely duplicate records with typos, hyphenated or swapped names
+    Input: local_data_df: output of indexing_local_data
+           threshold: minimum score of a reported pair
+           window: size of the sorted neighborhood window
+           max_block_size: blocks larger than this are skipped
+           batch_size: number of candidate pairs scored at once
+    Output: duplicates_df: candidate pairs with scores, ranked by score
+    '''
+    logging.info("Checking fuzzy duplicates...")
+    start = time.time()
+    candidates = prepare_candidates(local_data_df)
+    i, j = candidate_pairs(candidates, window=window, max_block_size=max_block_size)
+    logging.info(f"Scoring {len(i)} candidate pairs among {len(candidates)} records...")
+    scored = []
+    for b in range(0, len(i), batch_size):
+        bi, bj = i[b:b + batch_size], j[b:b + batch_size]
+        scores = score_pairs(candidates, bi, bj)
+        keep = (scores['score'] >= threshold).to_numpy()
+        scores = scores[keep]
+        scores.insert(0, 'i', bi[keep])
+        scores.insert(1, 'j', bj[keep])
+        scored.append(scores)
+    scored = pd.concat(scored) if scored != [] else pd.DataFrame(columns=['i', 'j', 'first_sim', 'last_sim', 'name_swapped', 'dob_score', 'score'])
+    records = local_data_df[local_data_df['child_first'] == ''][['cuimc_id', 'first_local', 'last_local', 'dob', 'record_id']].reset_index(drop=True)
+    duplicates_df = pd.concat([
+        records.iloc[scored['i'].to_numpy()].add_suffix('_1').reset_index(drop=True),
+        records.iloc[scored['j'].to_numpy()].add_suffix('_2').reset_index(drop=True),
+        scored.drop(columns=['i', 'j']).reset_index(drop=True),
+    ], axis=1)
+    duplicates_df = duplicates_df[duplicates_df['cuimc_id_1'] != duplicates_df['cuimc_id_2']]
+    duplicates_df = duplicates_df.sort_values(by=['score', 'cuimc_id_1', 'cuimc_id_2'], ascending=[False, True, True])
+    logging.info(f"Found {duplicates_df.shape[0]} fuzzy duplicate pairs in {time.time() - start:.1f}s.")
+    return duplicates_df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', type=str, required=False, help="file to write log",)
+    parser.add_argument('--token', type=str, required=False,  help='json file with api tokens')
+    parser.add_argument('--output_prefix', type=str, required=False, help='prefix of output files')
+    parser.add_argument('--threshold', type=float, required=False, default=0.85, help='minimum score of a reported pair')
+    parser.add_argument('--window', type=int, required=False, default=5, help='size of the sorted neighborhood window')
+    parser.add_argument('--max_block_size', type=int, required=False, default=1000, help='blocks larger than this are skipped')
+    args = parser.parse_args()
+
+    # if token file is not provided, use the default token file
+    if args.token is None:
+        token_file = '../api_tokens.json'
+    else:
+        token_file = args.token
+
+    # if log file is not provided, use the default log file
+    if args.log is None:
+        log_file = './fuzzy_duplicates_marker.log'
+    else:
+        log_file = args.log
+
+    # if output prefix is not provided, use the default output prefix
+    if args.output_prefix is None:
+        output_prefix = './test'
+    else:
+        output_prefix = args.output_prefix
+
+    # set up logging.
+    logging.basicConfig(filename=log_file, format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    logging.info('Start program...')
+    api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint = read_api_config(config_file = token_file)
+    local_data = export_data_from_redcap(api_key_local,cu_local_endpoint, is_local_record=True)
+    local_data_df = indexing_local_data(local_data)
+    duplicates_df = find_fuzzy_duplicates(local_data_df, threshold=args.threshold, window=args.window, max_block_size=args.max_block_size)
+    duplicates_df.to_csv(output_prefix + '_fuzzy_duplicates.csv', index=False)
+    logging.info('End program...')
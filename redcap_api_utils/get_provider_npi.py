@@ -3,10 +3,54 @@ import requests
 import json
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import logging
 import argparse
 import copy
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from npi_cache import open_npi_cache, read_npi_cache, write_npi_cache
+
+NPPES_NPI_REGISTRY_ENDPOINT = "https://npiregistry.cms.hhs.gov/api"
+# name prefixes and suffixes recognized by the provider name parser, lower case without punctuation
+PROVIDER_TITLES = ['dr', 'dra', 'doctor']
+PROVIDER_SUFFIXES = ['md', 'np']
+# same tokens as the split in parse_names
+PROVIDER_NAME_TOKEN = re.compile(r'[^,.\s]+')
+# letters only, with inner hyphens or apostrophes
+PROVIDER_NAME_LETTERS = re.compile(r"[^\W\d_]+(?:['-][^\W\d_]+)*")
+# responses retried with backoff
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter shared by the lookup workers
+    Input: rate: number of tokens added per second, i.e. the allowed request rate
+           capacity: maximum number of tokens, i.e. the allowed burst, no burst by default
+    '''
+    def __init__(self, rate, capacity = 1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        block until a token is available and take it
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 def read_api_config(config_file):
     logging.info("reading api tokens and endpoint url...")
@@ -31,6 +75,7 @@ def export_data_from_redcap(api_key, api_endpoint):
         'csvDelimiter': '',
         'fields[0]': 'cuimc_id',
         'fields[1]': 'provider_name',
+        'fields[2]': 'provider_npi',
         'rawOrLabel': 'raw',
         'rawOrLabelHeaders': 'raw',
         'exportCheckboxLabel': 'false',
@@ -55,6 +100,8 @@ def export_data_from_redcap(api_key, api_endpoint):
 def parse_names(provider_name):
     tokens =  re.split(',|\s+|\.',provider_name)
     tokens = [token for token in tokens if token != '']
+    if tokens == []:
+        return '', ''
     if tokens[0].lower() == 'dr.' or tokens[0].lower() == 'dr' or tokens[0].lower() == 'doctor' or tokens[0].lower() == 'dra.' or tokens[0].lower() == 'dra':
         if len(tokens) == 4:
             # skip middle name
@@ -81,75 +128,216 @@ def parse_names(provider_name):
             return tokens[0], tokens[2]
     return '', ''
 
-def get_provider_api(first_name, last_name):
-    npi = 0
-    try:
-        # provider_name = record['provider_name']
-        # first_name = provider_name.split(' ')[0].strip()
-        # last_name = provider_name.split(' ')[1].strip()
-        NPPES_NPI_Registry_endpoint = "https://npiregistry.cms.hhs.gov/api"
-        # first_name = 'Wendy'
-        # last_name = 'Makkawi'
-        params = {
-            'number' : '',
-            'enumeration_type' : '',
-            'taxonomy_description' : '',
-            'first_name' : first_name,
-            'use_first_name_alias' : '',
-            'last_name': last_name,
-            'organization_name' : '',
-            'address_purpose': '',
-            'city': '',
-            'state': '',
-            'postal_code': '',
-            'country_code': '',
-            'limit': '',
-            'skip' : '',
-            'pretty' : '',
-            'version' : 2.1
+def parse_names_vectorized(provider_names, titles = PROVIDER_TITLES, suffixes = PROVIDER_SUFFIXES):
+    '''
+    parse a whole provider_name column with the same rules as parse_names
+    a name is confident if both first and last names are found, the last name is not a
+    title or suffix (e.g. "Dr John Smith MD"), and the names have letters only.
+    low confidence names should not be sent to NPPES.
+    returns a dataframe with first_name, last_name and confident, aligned with provider_names
+    '''
+    # a few hundred distinct providers cover thousands of records, parse each distinct name once
+    codes, unique_names = pd.factorize(provider_names.fillna('').astype(str))
+    tokens = [PROVIDER_NAME_TOKEN.findall(name) for name in unique_names]
+    n_tokens = np.array([len(name_tokens) for name_tokens in tokens], dtype=int)
+    # first 4 tokens and the last token of each name, '' if missing
+    padded = np.array([(name_tokens + ['', '', '', ''])[:4] + [name_tokens[-1] if name_tokens else ''] for name_tokens in tokens], dtype=object).reshape(len(tokens), 5)
+    t = [padded[:, i] for i in range(4)]
+    titles = set(titles)
+    suffixes = set(suffixes)
+    has_title = np.array([token.lower() in titles for token in t[0]], dtype=bool)
+    has_suffix = ~has_title & np.array([token.lower() in suffixes for token in padded[:, 4]], dtype=bool)
+    no_affix = ~has_title & ~has_suffix
+    conditions = [
+        has_title & (n_tokens == 4), has_title & (n_tokens == 3), has_title & (n_tokens == 2),
+        has_suffix & (n_tokens == 4), has_suffix & (n_tokens == 3), has_suffix & (n_tokens == 2),
+        no_affix & (n_tokens == 2), no_affix & (n_tokens == 3),
+    ]
+    first_name = np.select(conditions, [t[1], t[1], '', t[0], t[0], '', t[0], t[0]], default='')
+    last_name = np.select(conditions, [t[3], t[2], t[1], t[2], t[1], t[0], t[1], t[2]], default='')
+    confident = np.array([first != '' and last != '' and last.lower() not in titles and last.lower() not in suffixes
+                          and PROVIDER_NAME_LETTERS.fullmatch(first) is not None and PROVIDER_NAME_LETTERS.fullmatch(last) is not None
+                          for first, last in zip(first_name, last_name)], dtype=bool)
+    names_df = pd.DataFrame({'first_name': first_name[codes], 'last_name': last_name[codes], 'confident': confident[codes]}, index=provider_names.index)
+    return names_df
+
+def nppes_params(first_name, last_name):
+    params = {
+        'number' : '',
+        'enumeration_type' : '',
+        'taxonomy_description' : '',
+        'first_name' : first_name,
+        'use_first_name_alias' : '',
+        'last_name': last_name,
+        'organization_name' : '',
+        'address_purpose': '',
+        'city': '',
+        'state': '',
+        'postal_code': '',
+        'country_code': '',
+        'limit': '',
+        'skip' : '',
+        'pretty' : '',
+        'version' : 2.1
+    }
+    return params
+
+def query_nppes(session, first_name, last_name, bucket, nppes_endpoint = NPPES_NPI_REGISTRY_ENDPOINT, timeout = 10, max_retries = 5):
+    '''
+    rate limited NPPES lookup with a timeout and backoff on network errors, 429 and 5xx responses
+    returns the NPI if the name matches a single provider, 0 if not, None if the lookup failed
+    a 200 with an Errors list or without results is a rejected query, it is not retried
+    '''
+    for attempt in range(max_retries):
+        bucket.acquire()
+        try:
+            r = session.get(nppes_endpoint, params=nppes_params(first_name, last_name), timeout=timeout)
+        except Exception as e:
+            logging.warning('NPPES error for ' + str(first_name) + ' ' + str(last_name) + ': ' + str(e))
+            time.sleep(2 ** attempt)
+            continue
+        if r.status_code == 200:
+            try:
+                results = r.json()
+            except ValueError:
+                results = {}
+            if not isinstance(results, dict) or 'Errors' in results or 'result_count' not in results or 'results' not in results:
+                errors = results.get('Errors', r.text[:200]) if isinstance(results, dict) else r.text[:200]
+                logging.error('query_nppes error for ' + str(first_name) + ' ' + str(last_name) + ': ' + str(errors))
+                return None
+            if results['result_count'] == 1:
+                return results["results"][0]['number']
+            return 0
+        if r.status_code not in RETRY_STATUS_CODES:
+            logging.error('query_nppes error for ' + str(first_name) + ' ' + str(last_name) + ': HTTP Status ' + str(r.status_code))
+            return None
+        logging.warning('NPPES HTTP Status ' + str(r.status_code) + ' for ' + str(first_name) + ' ' + str(last_name))
+        retry_after = r.headers.get('Retry-After', '')
+        time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+    logging.error('query_nppes error for ' + str(first_name) + ' ' + str(last_name) + ': no response after ' + str(max_retries) + ' tries')
+    return None
+
+def query_nppes_concurrent(name_keys, nppes_endpoint = NPPES_NPI_REGISTRY_ENDPOINT, rate = 5, max_workers = 8, timeout = 10):
+    '''
+    look up many names with bounded concurrency, at most rate requests per second
+    returns the NPIs in the order of name_keys
+    '''
+    bucket = TokenBucket(rate)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        npis = list(executor.map(lambda key: query_nppes(session, key[0], key[1], bucket, nppes_endpoint=nppes_endpoint, timeout=timeout), name_keys))
+    session.close()
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info(f"Looked up {len(name_keys)} names in {elapsed:.1f}s ({len(name_keys) / elapsed:.1f} names/s).")
+    return npis
+
+def normalize_name_key(first_name, last_name):
+    return first_name.strip().lower(), last_name.strip().lower()
+
+def lookup_npis(name_keys, nppes_endpoint = NPPES_NPI_REGISTRY_ENDPOINT, cache_db = None, ttl = 2592000, negative_ttl = 604800, rate = 5, max_workers = 8, timeout = 10):
+    '''
+    look up each distinct normalized (first, last) name once
+    if cache_db is provided, fresh cache entries are used and new lookups are stored.
+    failed lookups are not cached and are retried on the next run.
+    returns a dict of (first, last) to NPI, 0 if no unique NPI
+    '''
+    name_keys = list(dict.fromkeys([key for key in name_keys if key[1] != '']))
+    npis = {}
+    if cache_db is not None:
+        conn = open_npi_cache(cache_db)
+        npis = read_npi_cache(conn, name_keys, ttl=ttl, negative_ttl=negative_ttl)
+    missed_keys = [key for key in name_keys if key not in npis]
+    logging.info(f"{len(name_keys)} distinct provider names, {len(npis)} cached, {len(missed_keys)} to look up.")
+    looked_up = {}
+    for key, npi in zip(missed_keys, query_nppes_concurrent(missed_keys, nppes_endpoint=nppes_endpoint, rate=rate, max_workers=max_workers, timeout=timeout)):
+        if npi is not None:
+            looked_up[key] = npi
+    if cache_db is not None:
+        write_npi_cache(conn, dict([(key, '' if npi == 0 else npi) for key, npi in looked_up.items()]))
+        conn.close()
+    npis.update(looked_up)
+    return dict([(key, 0 if npi == '' else npi) for key, npi in npis.items()])
+
+def build_npi_updates(records, name_keys, npis):
+    '''
+    collect the resolved NPIs of the records, skipping records that already have the same NPI
+    returns a list of {cuimc_id, provider_npi}, one per cuimc_id
+    '''
+    updates = {}
+    for record, name_key in zip(records, name_keys):
+        npi = npis.get(name_key, 0)
+        if npi is None or npi == 0 or str(npi) == record.get('provider_npi', ''):
+            continue
+        updates[record['cuimc_id']] = {'cuimc_id': record['cuimc_id'], 'provider_npi': str(npi)}
+    logging.info(f"{len(updates)} records with a new NPI.")
+    return list(updates.values())
+
+def import_npi_updates(api_key, api_endpoint, updates, batch_size = 500, failed_csv = None):
+    '''
+    import the NPI updates in batches, verifying the imported ids returned by REDCap
+    returns a dataframe of the updates that failed, written to failed_csv if provided
+    '''
+    failed = []
+    for i in range(0, len(updates), batch_size):
+        batch = updates[i:i + batch_size]
+        data = {
+            'token': api_key,
+            'content': 'record',
+            'action': 'import',
+            'format': 'json',
+            'type': 'flat',
+            'overwriteBehavior': 'normal',
+            'forceAutoNumber': 'false',
+            'data': json.dumps(batch),
+            'returnContent': 'ids',
+            'returnFormat': 'json'
         }
-        r = requests.get(NPPES_NPI_Registry_endpoint, params=params)
-        results = r.json()
-        if results['result_count'] == 1:
-            npi = results["results"][0]['number']
-    except Exception as e:
-        logging.error('get_provider_api error for ' + str(record['cuimc_id'] + ': '  + str(e) ))
-    return npi
-
-def updata_npi_in_redcap(api_key, api_endpoint, record):
-    if record['provider_name'] != '':
-        logging.info('provider name: ' + str(record['provider_name']) + ' for cuimc_id: ' + str(record['cuimc_id']))
-        first_name, last_name = parse_names(record['provider_name'])
-        logging.info('provider first name: ' + str(first_name) + ' for cuimc_id: ' + str(record['cuimc_id']))
-        logging.info('provider last name: ' + str(last_name) + ' for cuimc_id: ' + str(record['cuimc_id']))
-        npi = get_provider_api(first_name, last_name)
-        if npi != 0:
+        error = ''
+        imported_ids = []
+        flag = 1
+        while(flag > 0 and flag < 5):
             try:
-                record['provider_npi'] = str(npi)
-                del record['redcap_repeat_instrument']
-                del record['redcap_repeat_instance']
-                del record['provider_name']
-                data = {
-                    'token': api_key,
-                    'content': 'record',
-                    'action': 'import',
-                    'format': 'json',
-                    'type': 'flat',
-                    'overwriteBehavior': 'normal',
-                    'forceAutoNumber': 'false',
-                    'data': json.dumps([record]),
-                    'returnContent': 'count',
-                    'returnFormat': 'json'
-                }
                 r = requests.post(api_endpoint,data=data)
-                # logging.info('HTTP Status: ' + str(r.status_code))
+                if r.status_code == 200:
+                    imported_ids = [str(record_id) for record_id in r.json()]
+                    flag = 0
+                else:
+                    error = 'HTTP Status: ' + str(r.status_code) + '. ' + str(r.content)
+                    logging.error('Error occured in importing NPI. ' + error)
+                    flag = flag + 1
             except Exception as e:
-                logging.error('updata_npi_in_redcap error for ' + str(record['cuimc_id']) + ': ' + str(e) )
+                error = str(e)
+                logging.error('Error occured in importing NPI. ' + error)
+                flag = flag + 1
+        if flag == 0:
+            error = 'not in imported ids'
+        imported_ids = set(imported_ids)
+        failed.extend([dict(update, error=error) for update in batch if str(update['cuimc_id']) not in imported_ids])
+    failed_df = pd.DataFrame(failed, columns=['cuimc_id', 'provider_npi', 'error'])
+    logging.info(f"Imported {len(updates) - failed_df.shape[0]} NPI updates, {failed_df.shape[0]} failed.")
+    if failed_csv is not None and failed_df.shape[0] > 0:
+        failed_df.to_csv(failed_csv, index=False)
+        logging.info("Failed NPI updates written to " + failed_csv)
+    return failed_df
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log', type=str, required=True, help="file to write log",)    
     parser.add_argument('--token', type=str, required=True, help='json file with api tokens')    
+    parser.add_argument('--nppes_endpoint', type=str, required=False, default=NPPES_NPI_REGISTRY_ENDPOINT, help='NPPES NPI registry api endpoint')
+    parser.add_argument('--batch_size', type=int, required=False, default=500, help='number of records per import call')
+    parser.add_argument('--failed_csv', type=str, required=False, default='./npi_import_failed.csv', help='report of the NPI updates that failed to import')
+    parser.add_argument('--rate', type=float, required=False, default=5, help='maximum NPPES requests per second')
+    parser.add_argument('--max_workers', type=int, required=False, default=8, help='maximum number of concurrent NPPES requests')
+    parser.add_argument('--timeout', type=float, required=False, default=10, help='timeout in seconds of a NPPES request')
+    parser.add_argument('--cache', type=str, required=False, default='./npi_cache.db', help='sqlite provider name to NPI cache')
+    parser.add_argument('--no_cache', action='store_true', help='always query NPPES')
+    parser.add_argument('--cache_ttl', type=int, required=False, default=2592000, help='maximum age in seconds of a cached NPI')
+    parser.add_argument('--negative_cache_ttl', type=int, required=False, default=604800, help='maximum age in seconds of a cached name without a unique NPI')
     args = parser.parse_args()
     log_file = args.log
     token_file = args.token
@@ -163,8 +351,13 @@ if __name__ == '__main__':
     api_key_local, _, cu_local_endpoint, _ = read_api_config(token_file)
     records = export_data_from_redcap(api_key_local, cu_local_endpoint)
     logging.info("Update NPI...")
-    for record in records:
-        updata_npi_in_redcap(api_key_local, cu_local_endpoint, record)
+    records = [record for record in records if record['provider_name'] != '']
+    names_df = parse_names_vectorized(pd.Series([record['provider_name'] for record in records], dtype=object))
+    logging.info(f"{(~names_df['confident']).sum()} provider names parsed with low confidence are not looked up.")
+    name_keys = [normalize_name_key(first_name, last_name) if confident else ('', '') for first_name, last_name, confident in names_df.itertuples(index=False, name=None)]
+    npis = lookup_npis(name_keys, nppes_endpoint=args.nppes_endpoint, cache_db=None if args.no_cache else args.cache, ttl=args.cache_ttl, negative_ttl=args.negative_cache_ttl, rate=args.rate, max_workers=args.max_workers, timeout=args.timeout)
+    updates = build_npi_updates(records, name_keys, npis)
+    import_npi_updates(api_key_local, cu_local_endpoint, updates, batch_size=args.batch_size, failed_csv=args.failed_csv)
 
 
 
@@ -0,0 +1,145 @@
+import sqlite3
+import logging
+import os
+import pandas as pd
+
+# columns of indexing_local_data kept in the identity index
+INDEX_COLUMNS = ['cuimc_id','first_local','last_local','dob','child_first','last_child','dob_child', 'mrn', 'cuimc_empi', 'record_id', 'participant_lab_id','age','rec_outcome','rec_outcome_2','rec_outcome_3']
+DATE_COLUMNS = ['dob', 'dob_child']
+KEY_COLUMNS = ['dob', 'first_local', 'last_local']
+
+def open_identity_index(db_path : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the SQLite identity index of the local records
+    Input: db_path: path to the index database
+    Output: conn: sqlite3 connection to the index
+    '''
+    logging.info("Opening identity index " + db_path + "...")
+    db_dir = os.path.dirname(db_path)
+    if db_dir != '':
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    columns = ', '.join([c + ' TEXT NOT NULL' for c in INDEX_COLUMNS[1:]])
+    conn.execute('CREATE TABLE IF NOT EXISTS identity_index (cuimc_id INTEGER PRIMARY KEY, ' + columns + ')')
+    conn.execute('CREATE INDEX IF NOT EXISTS identity_index_key ON identity_index (dob, first_local, last_local)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )''')
+    conn.commit()
+    return conn
+
+def to_index_rows(local_data_df : pd.DataFrame) -> list:
+    '''
+    Convert indexed local data into rows of the identity index
+    Input: local_data_df: output of indexing_local_data
+    Output: rows: a list of tuples in the order of INDEX_COLUMNS, dates as %Y-%m-%d
+    '''
+    df = local_data_df[INDEX_COLUMNS].copy()
+    for c in DATE_COLUMNS:
+        df[c] = df[c].dt.strftime('%Y-%m-%d')
+    df = df.fillna('')
+    df[INDEX_COLUMNS[1:]] = df[INDEX_COLUMNS[1:]].astype(str)
+    df['cuimc_id'] = df['cuimc_id'].astype(int)
+    return list(df.itertuples(index=False, name=None))
+
+def from_index_rows(rows : list) -> pd.DataFrame:
+    '''
+    Convert rows of the identity index back into the layout of indexing_local_data
+    Input: rows: a list of tuples in the order of INDEX_COLUMNS
+    Output: local_data_df: a dataframe with the same columns and types as indexing_local_data
+    '''
+    df = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    for c in DATE_COLUMNS:
+        df[c] = pd.to_datetime(df[c], format='%Y-%m-%d', errors='coerce')
+    df['cuimc_id'] = df['cuimc_id'].astype(int)
+    return df
+
+def rebuild_identity_index(conn : sqlite3.Connection, local_data_df : pd.DataFrame):
+    '''
+    Replace the whole identity index with the current local population
+    Input: conn: sqlite3 connection to the index
+           local_data_df: output of indexing_local_data
+    '''
+    conn.execute('DELETE FROM identity_index')
+    upsert_identities(conn, local_data_df)
+    logging.info(f"Identity index rebuilt with {local_data_df.shape[0]} records.")
+
+def upsert_identities(conn : sqlite3.Connection, local_data_df : pd.DataFrame):
+    '''
+    Insert or replace the index entries of the given records
+    Input: conn: sqlite3 connection to the index
+           local_data_df: output of indexing_local_data
+    '''
+    placeholders = ', '.join(['?'] * len(INDEX_COLUMNS))
+    conn.executemany('INSERT OR REPLACE INTO identity_index (' + ', '.join(INDEX_COLUMNS) + ') VALUES (' + placeholders + ')', to_index_rows(local_data_df))
+    conn.commit()
+
+def remove_identities(conn : sqlite3.Connection, cuimc_ids : list):
+    '''
+    Remove records from the index, e.g. records whose name has been cleared
+    Input: conn: sqlite3 connection to the index
+           cuimc_ids: a list of cuimc_ids
+    '''
+    conn.executemany('DELETE FROM identity_index WHERE cuimc_id = ?', [(int(i),) for i in cuimc_ids])
+    conn.commit()
+
+def lookup_keys(conn : sqlite3.Connection, cuimc_ids : list) -> pd.DataFrame:
+    '''
+    Current (dob, first_local, last_local) keys of the given records in the index
+    Input: conn: sqlite3 connection to the index
+           cuimc_ids: a list of cuimc_ids
+    Output: keys_df: a dataframe of the keys, dob as datetime
+    '''
+    conn.execute('DROP TABLE IF EXISTS temp.query_ids')
+    conn.execute('CREATE TEMP TABLE query_ids (cuimc_id INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT OR IGNORE INTO temp.query_ids VALUES (?)', [(int(i),) for i in cuimc_ids])
+    rows = conn.execute('''
+        SELECT DISTINCT i.dob, i.first_local, i.last_local FROM identity_index i
+        JOIN temp.query_ids q ON q.cuimc_id = i.cuimc_id''').fetchall()
+    conn.execute('DROP TABLE temp.query_ids')
+    keys_df = pd.DataFrame(rows, columns=KEY_COLUMNS)
+    keys_df['dob'] = pd.to_datetime(keys_df['dob'], format='%Y-%m-%d', errors='coerce')
+    return keys_df
+
+def load_clusters(conn : sqlite3.Connection, keys_df : pd.DataFrame) -> pd.DataFrame:
+    '''
+    All indexed records sharing one of the given (dob, first_local, last_local) keys
+    Input: conn: sqlite3 connection to the index
+           keys_df: a dataframe of keys, dob as datetime
+    Output: local_data_df: the matching records in the layout of indexing_local_data
+    '''
+    keys = keys_df[KEY_COLUMNS].copy()
+    keys['dob'] = keys['dob'].dt.strftime('%Y-%m-%d')
+    keys = keys.fillna('').drop_duplicates()
+    conn.execute('DROP TABLE IF EXISTS temp.query_keys')
+    conn.execute('CREATE TEMP TABLE query_keys (dob TEXT, first_local TEXT, last_local TEXT)')
+    conn.executemany('INSERT INTO temp.query_keys VALUES (?, ?, ?)', list(keys.itertuples(index=False, name=None)))
+    rows = conn.execute('SELECT ' + ', '.join(['i.' + c for c in INDEX_COLUMNS]) + ''' FROM identity_index i
+        JOIN temp.query_keys k ON k.dob = i.dob AND k.first_local = i.first_local AND k.last_local = i.last_local
+        ORDER BY i.cuimc_id''').fetchall()
+    conn.execute('DROP TABLE temp.query_keys')
+    return from_index_rows(rows)
+
+def get_sync_state(conn : sqlite3.Connection, key : str) -> str:
+    '''
+    Read a value (e.g. a watermark) stored with the index
+    Input: conn: sqlite3 connection to the index
+           key: name of the state
+    Output: value: the stored value, None if not set
+    '''
+    row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def set_sync_state(conn : sqlite3.Connection, key : str, value : str):
+    '''
+    Store a value (e.g. a watermark) with the index
+    Input: conn: sqlite3 connection to the index
+           key: name of the state
+           value: value to store
+    '''
+    conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+    conn.commit()
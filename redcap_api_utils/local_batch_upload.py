@@ -7,6 +7,10 @@ import pandas as pd
 import numpy as np
 import logging
 import argparse
+import os
+import time
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def read_api_config(config_file):
     logging.info("reading api tokens and endpoint url...")
@@ -20,50 +24,107 @@ def read_api_config(config_file):
     r4_api_endpoint = api_conf['r4_api_endpoint'] # R4 api endpoint
     return api_key_local, api_key_r4, cu_local_endpoint, r4_api_endpoint
 
-def read_batch_upload_csv(csv_file):
-    df = pd.read_csv(csv_file,dtype=object)
+def format_batch_upload_df(df):
     df['dob'] = pd.to_datetime(df['dob'])
     df['dob_child'] = pd.to_datetime(df['dob_child'])
     df = df.fillna('')
     return df
 
-def clean_upload(upload_df, existing_df, replicate_records_csv):
+def read_batch_upload_csv(csv_file):
+    df = pd.read_csv(csv_file,dtype=object)
+    return format_batch_upload_df(df)
+
+def iter_batch_upload_csv(csv_file, chunk_size):
+    '''
+    Stream the upload csv in chunks of chunk_size rows
+    '''
+    for df in pd.read_csv(csv_file,dtype=object,chunksize=chunk_size):
+        yield format_batch_upload_df(df)
+
+# name + dob key of a record, in local field names
+NAME_KEY_COLUMNS = ['last_local','first_local','dob','last_child','child_first','dob_child']
+# the same key in R4 field names
+R4_NAME_KEY_COLUMNS = {"last_name": "last_local", "first_name": "first_local", "date_of_birth": "dob","last_name_child":"last_child","first_name_child":"child_first","date_of_birth_child":"dob_child"}
+
+def normalize_key_columns(df):
+    '''
+    Lower case and strip the key columns. Dates are written as YYYY-MM-DD, empty values
+    (including NaT/nan) become ''.
+    '''
+    key_df = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            key_df[col] = df[col].dt.strftime('%Y-%m-%d').fillna('')
+        else:
+            key_df[col] = df[col].fillna('').astype(str).str.strip().str.lower()
+            key_df.loc[key_df[col].isin(['nan','nat','none']), col] = ''
+    return key_df
+
+def hash_name_keys(df):
+    '''
+    64-bit hash of the normalized (last, first, dob, child last, child first, child dob) key of each row
+    '''
+    return pd.util.hash_pandas_object(normalize_key_columns(df[NAME_KEY_COLUMNS]), index=False).to_numpy()
+
+def build_dedupe_index(existing_df):
+    '''
+    Build the dedupe index once from the local export: the set of existing mrns
+    and the hashed name + dob keys of both the local and the R4 name fields.
+    '''
+    logging.info("Building dedupe index from " + str(len(existing_df)) + " local records...")
+    mrns = existing_df['mrn'].fillna('').astype(str).str.strip()
+    mrns = mrns[mrns != ''].unique()
+    name_keys = [hash_name_keys(existing_df)]
+    if all([c in existing_df.columns for c in R4_NAME_KEY_COLUMNS]):
+        name_keys.append(hash_name_keys(existing_df[list(R4_NAME_KEY_COLUMNS)].rename(columns=R4_NAME_KEY_COLUMNS)))
+    name_keys = np.unique(np.concatenate(name_keys))
+    logging.info("Dedupe index: " + str(len(mrns)) + " mrns, " + str(len(name_keys)) + " name keys")
+    return {'mrn': mrns, 'name_keys': name_keys}
+
+def classify_upload(upload_df, dedupe_index):
+    '''
+    Classify every upload row in one vectorized pass.
+    Output: a Series with the reject reason of each row, '' if the row is to be uploaded
+    '''
+    key_df = normalize_key_columns(upload_df[['mrn'] + NAME_KEY_COLUMNS])
+    empty_mrn = key_df['mrn'] == ''
+    missing_name_dob = (key_df['last_local'] == '') | (key_df['first_local'] == '') | (key_df['dob'] == '')
+    mrn_match = upload_df['mrn'].fillna('').astype(str).str.strip().isin(dedupe_index['mrn'])
+    name_match = np.isin(hash_name_keys(upload_df), dedupe_index['name_keys'])
+    reason = np.select([empty_mrn, missing_name_dob, mrn_match, name_match],
+                       ['empty mrn', 'missing name or dob', 'mrn match', 'name and dob match'], default='')
+    return pd.Series(reason, index=upload_df.index)
+
+def clean_upload(upload_df, existing_df, replicate_records_csv, append=False, dedupe_index=None):
     '''
     There are three reasons a record won't be uploaded.
     1. empty mrn
     2. empty names and dob
     3. existing record matched by mrn or name + dob
+    The rejected records are written to replicate_records_csv with a reject_reason column.
+    append: append the replicated records to replicate_records_csv (chunked upload)
+    dedupe_index: index from build_dedupe_index, built from existing_df if not provided
     '''
-    upload_init_df = upload_df.copy(deep=True)
-    # clean empty mrn
-    upload_df = upload_df[upload_df['mrn']!='']
-    # clean empty names and dobs
-    upload_df = upload_df[upload_df['last_local']!='']
-    upload_df = upload_df[upload_df['first_local']!='']
-    upload_df = upload_df[upload_df['dob']!='']
-
-    existing_mrns = existing_df['mrn'].drop_duplicates().to_list()
-    existing_mrns = [i for i in existing_mrns if i!='']
-    # replicated_df1 = upload_df[upload_df['mrn'].isin(existing_mrns)]
-    upload_df = upload_df[~upload_df['mrn'].isin(existing_mrns)]
-    name_local_df = existing_df[['last_local','first_local','dob','last_child','child_first','dob_child']]
-    name_local_df = name_local_df.apply(lambda x: x.astype(str).str.lower().str.strip())
-    name_r4_df = existing_df[['last_name','first_name','date_of_birth','last_name_child','first_name_child','date_of_birth_child']]
-    name_r4_df = name_r4_df.apply(lambda x: x.astype(str).str.strip().str.lower())
-    name_r4_df = name_r4_df.rename(columns={"last_name": "last_local", "first_name": "first_local", "date_of_birth": "dob","last_name_child":"last_child","first_name_child":"child_first","date_of_birth_child":"dob_child"})
-    existing_name = pd.concat([name_local_df,name_r4_df]).drop_duplicates(keep="first")
-    upload_df = upload_df.copy(deep=True).apply(lambda x: x.astype(str).str.strip().str.lower())
-    upload_df = pd.merge(upload_df,existing_name,on=['last_local','first_local','dob','last_child','child_first','dob_child'],how="outer",indicator=True)
-    # replicated_df2 = upload_df[upload_df['_merge']=='both']
-    # replicated_df2 = replicated_df2.drop(columns='_merge')
-    upload_df = upload_df[upload_df['_merge']=='left_only']
-    upload_df = upload_df.drop(columns='_merge')
+    if dedupe_index is None:
+        dedupe_index = build_dedupe_index(existing_df)
+    reason = classify_upload(upload_df, dedupe_index)
+    cleaned_results = upload_df[reason != ''].copy()
+    cleaned_results['reject_reason'] = reason[reason != '']
+    for r, n in cleaned_results['reject_reason'].value_counts().items():
+        logging.info("Rejected " + str(n) + " records: " + r)
+    kept_df = upload_df[reason == '']
+    upload_df = pd.DataFrame(index=kept_df.index)
+    for col in kept_df.columns:
+        upload_df[col] = kept_df[col].astype(str).str.strip().str.lower()
     # patch 2022-10-18, fix date format
-    upload_df['dob'] = pd.to_datetime(upload_df['dob'].astype(str)).dt.strftime('%m/%d/%Y')
-    upload_df['dob_child'] = pd.to_datetime(upload_df['dob_child'].astype(str)).dt.strftime('%m/%d/%Y')
+    upload_df['dob'] = pd.to_datetime(kept_df['dob']).dt.strftime('%m/%d/%Y')
+    upload_df['dob_child'] = pd.to_datetime(kept_df['dob_child']).dt.strftime('%m/%d/%Y')
     upload_df = upload_df.fillna('')
-    cleaned_results = upload_init_df[~upload_init_df['cuimc_id'].isin(upload_df['cuimc_id'].to_list())]
-    cleaned_results.to_csv(replicate_records_csv,index=None)
+    if append:
+        write_header = not os.path.exists(replicate_records_csv) or os.path.getsize(replicate_records_csv) == 0
+        cleaned_results.to_csv(replicate_records_csv,index=None,mode='a',header=write_header)
+    else:
+        cleaned_results.to_csv(replicate_records_csv,index=None)
     return upload_df
 
 class NpEncoder(json.JSONEncoder):
@@ -106,21 +167,114 @@ def get_local_record(api_key_local,cu_local_endpoint):
     df = pd.DataFrame(data)
     return df
 
+# the only local fields needed to allocate cuimc_ids and dedupe an upload
+IDENTIFIER_FIELDS = ['cuimc_id','mrn'] + NAME_KEY_COLUMNS + list(R4_NAME_KEY_COLUMNS)
+
+def export_local_fields(api_key_local, cu_local_endpoint, fields):
+    data = {
+        'token': api_key_local,
+        'content': 'record',
+        'action': 'export',
+        'format': 'json',
+        'type': 'flat',
+        'csvDelimiter': '',
+        'rawOrLabel': 'raw',
+        'rawOrLabelHeaders': 'raw',
+        'exportCheckboxLabel': 'false',
+        'exportSurveyFields': 'false',
+        'exportDataAccessGroups': 'false',
+        'returnFormat': 'json'
+    }
+    for i, field in enumerate(fields):
+        data['fields[' + str(i) + ']'] = field
+    flag = 1
+    while(flag > 0 and flag < 5):
+        r = requests.post(cu_local_endpoint,data=data)
+        if r.status_code == 200:
+            logging.info('HTTP Status: ' + str(r.status_code))
+            return r.json()
+        else:
+            logging.error('Error occured in exporting data from ' + cu_local_endpoint)
+            logging.error('HTTP Status: ' + str(r.status_code))
+            logging.error(r.content)
+            flag = flag + 1
+    raise Exception('Error occured in exporting data from ' + cu_local_endpoint)
+
+def cuimc_id_fingerprint(records):
+    cuimc_ids = set([int(r['cuimc_id']) for r in records if str(r['cuimc_id']).strip() != ''])
+    return {'count': len(cuimc_ids), 'max': max(cuimc_ids) if cuimc_ids else 0}
+
+def get_local_identifiers(api_key_local, cu_local_endpoint, cache_file = None, max_age = 3600):
+    '''
+    Export only the identifier fields needed by the upload, instead of the full project.
+    The export is cached in cache_file. The cache is used if it is younger than max_age
+    seconds and a cuimc_id-only export still has the same number of records and max cuimc_id.
+    Output: a dataframe of IDENTIFIER_FIELDS, one row per local record
+    '''
+    records = None
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file,'r') as f:
+            cache = json.load(f)
+        age = time.time() - cache['exported_at']
+        if age < max_age:
+            fingerprint = cuimc_id_fingerprint(export_local_fields(api_key_local, cu_local_endpoint, ['cuimc_id']))
+            if fingerprint == cache['fingerprint']:
+                logging.info('Use cached local identifiers from ' + cache_file + ', ' + str(int(age)) + 's old')
+                records = cache['records']
+            else:
+                logging.info('Cached local identifiers are stale: ' + str(cache['fingerprint']) + ' vs ' + str(fingerprint))
+    if records is None:
+        logging.info('Export local identifiers...')
+        records = export_local_fields(api_key_local, cu_local_endpoint, IDENTIFIER_FIELDS)
+        # repeat instances carry no identifiers
+        records = [r for r in records if r.get('redcap_repeat_instrument', '') == '']
+        records = [{k: r.get(k, '') for k in IDENTIFIER_FIELDS} for r in records]
+        if cache_file is not None:
+            cache = {'exported_at': time.time(), 'fingerprint': cuimc_id_fingerprint(records), 'records': records}
+            with open(cache_file + '.tmp','w') as f:
+                json.dump(cache, f)
+            os.replace(cache_file + '.tmp', cache_file)
+    return pd.DataFrame(records, columns=IDENTIFIER_FIELDS)
+
+def reserve_cuimc_ids(count, cuimc_id_floor, reservation_file):
+    '''
+    Reserve count contiguous cuimc_ids, starting at cuimc_id_floor or after the last reserved id.
+    The last reserved id is kept in reservation_file under an exclusive lock, so two uploads
+    running at the same time never get overlapping ranges.
+    Output: the first reserved cuimc_id
+    '''
+    with open(reservation_file,'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            last_reserved = f.read().strip()
+            last_reserved = int(last_reserved) if last_reserved != '' else 0
+            cuimc_id_start = max(int(cuimc_id_floor), last_reserved + 1)
+            f.seek(0)
+            f.truncate()
+            f.write(str(cuimc_id_start + count - 1))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    logging.info('Reserved cuimc_id ' + str(cuimc_id_start) + ' - ' + str(cuimc_id_start + count - 1))
+    return cuimc_id_start
+
 def get_lastest_cuimd_id(api_key_local,cu_local_endpoint, local_df):
     local_df['cuimc_id'] = local_df['cuimc_id'].astype(int)
     cuimc_id_latest = local_df[['cuimc_id']].max()[0]
     return cuimc_id_latest
 
-def prepare_batch_upload(api_key_local, cu_local_endpoint, upload_df,local_df,replicate_records_csv):
-    cuimc_id_latest = get_lastest_cuimd_id(api_key_local,cu_local_endpoint,local_df) + 1
-    upload_df_cleaned = clean_upload(upload_df,local_df,replicate_records_csv)
+def assign_cuimc_ids(upload_df_cleaned, cuimc_id_start):
     batch_records = upload_df_cleaned.to_dict('records')
-
+    cuimc_id_latest = cuimc_id_start
     for record in batch_records:
         record['cuimc_id'] = str(cuimc_id_latest)
         record['local_batch_upload'] = "1"
         cuimc_id_latest = cuimc_id_latest + 1
-    
+    return batch_records
+
+def build_import_data(api_key_local, batch_records):
     upload_data = json.dumps(batch_records, cls=NpEncoder)
     data = {
         'token': api_key_local,
@@ -137,30 +291,138 @@ def prepare_batch_upload(api_key_local, cu_local_endpoint, upload_df,local_df,re
     }
     return data
 
+def prepare_batch_upload(api_key_local, cu_local_endpoint, upload_df,local_df,replicate_records_csv,reservation_file=None):
+    cuimc_id_latest = get_lastest_cuimd_id(api_key_local,cu_local_endpoint,local_df) + 1
+    upload_df_cleaned = clean_upload(upload_df,local_df,replicate_records_csv)
+    if reservation_file is not None:
+        cuimc_id_latest = reserve_cuimc_ids(len(upload_df_cleaned), cuimc_id_latest, reservation_file)
+    batch_records = assign_cuimc_ids(upload_df_cleaned, cuimc_id_latest)
+    data = build_import_data(api_key_local, batch_records)
+    return data
+
 def execute_batch_upload(data, cu_local_endpoint, flag = 1, max_try = 5):
+    '''
+    Output: 1 if success, 0 if failure
+    '''
     while(flag > 0 and flag < max_try):
         r = requests.post(cu_local_endpoint,data=data)
         if r.status_code == 200:
             logging.info('HTTP Status: ' + str(r.status_code))
             flag = 0
+            return 1
         else:
             logging.error('Error occured in importing data to ' + cu_local_endpoint)
             logging.error(r.content)
             flag = flag + 1
+    return 0
+
+def read_resume_file(resume_file, csv_file, chunk_size):
+    '''
+    Read the chunk status of a previous run of the same csv file and chunk size
+    '''
+    if resume_file is None or not os.path.exists(resume_file):
+        return {'csv_file': os.path.abspath(csv_file), 'chunk_size': chunk_size, 'chunks': {}}
+    with open(resume_file,'r') as f:
+        state = json.load(f)
+    if state['csv_file'] != os.path.abspath(csv_file) or state['chunk_size'] != chunk_size:
+        raise Exception('Resume file ' + resume_file + ' was written for ' + state['csv_file'] + ' with chunk size ' + str(state['chunk_size']))
+    logging.info('Resume from ' + resume_file + ': ' + str(len([c for c in state['chunks'].values() if c['status'] == 'done'])) + ' chunks already uploaded')
+    return state
+
+def write_resume_file(resume_file, state):
+    if resume_file is None:
+        return
+    # write then rename, a crash never leaves a truncated resume file
+    with open(resume_file + '.tmp','w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(resume_file + '.tmp', resume_file)
+
+def upload_chunk(api_key_local, cu_local_endpoint, batch_records):
+    data = build_import_data(api_key_local, batch_records)
+    return execute_batch_upload(data, cu_local_endpoint)
+
+def chunked_batch_upload(api_key_local, cu_local_endpoint, csv_file, local_df, replicate_records_csv, chunk_size = 500, max_workers = 4, resume_file = None, reservation_file = None):
+    '''
+    Upload a large csv in chunks of chunk_size rows with up to max_workers concurrent imports.
+    Each chunk gets a contiguous cuimc_id range before upload, reserved in reservation_file
+    if provided, and its status is kept in resume_file, so a rerun skips the chunks that
+    were already uploaded.
+    Output: a list of per-chunk results
+    '''
+    state = read_resume_file(resume_file, csv_file, chunk_size)
+    if state['chunks'] == {} and os.path.exists(replicate_records_csv):
+        os.remove(replicate_records_csv)
+    # never re-use an id range handed out in a previous run
+    cuimc_id_next = int(get_lastest_cuimd_id(api_key_local,cu_local_endpoint,local_df)) + 1
+    for chunk in state['chunks'].values():
+        cuimc_id_next = max(cuimc_id_next, chunk['cuimc_id_start'] + chunk['count'])
+
+    dedupe_index = build_dedupe_index(local_df)
+    results = []
+    def collect(done_futures):
+        for future in done_futures:
+            chunk_result = futures.pop(future)
+            try:
+                status = future.result()
+            except Exception as e:
+                logging.error('Error occured in uploading chunk ' + str(chunk_result['chunk']) + '. ' + str(e))
+                status = 0
+            chunk_result['status'] = 'done' if status == 1 else 'failed'
+            state['chunks'][str(chunk_result['chunk'])] = {'cuimc_id_start': chunk_result['cuimc_id_start'], 'count': chunk_result['uploaded'], 'status': chunk_result['status']}
+            write_resume_file(resume_file, state)
+            logging.info('Chunk ' + str(chunk_result['chunk']) + ': ' + chunk_result['status'] + ', ' + str(chunk_result['uploaded']) + ' uploaded, ' + str(chunk_result['rejected']) + ' rejected, cuimc_id ' + str(chunk_result['cuimc_id_start']) + ' - ' + str(chunk_result['cuimc_id_start'] + chunk_result['uploaded'] - 1))
+            results.append(chunk_result)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, upload_df in enumerate(iter_batch_upload_csv(csv_file, chunk_size)):
+            if state['chunks'].get(str(i), {}).get('status') == 'done':
+                logging.info('Chunk ' + str(i) + ' already uploaded, skip')
+                continue
+            upload_df_cleaned = clean_upload(upload_df,local_df,replicate_records_csv,append=True,dedupe_index=dedupe_index)
+            chunk_result = {'chunk': i, 'rows': len(upload_df), 'uploaded': len(upload_df_cleaned), 'rejected': len(upload_df) - len(upload_df_cleaned), 'cuimc_id_start': cuimc_id_next, 'status': 'pending'}
+            if len(upload_df_cleaned) == 0:
+                chunk_result['status'] = 'done'
+                state['chunks'][str(i)] = {'cuimc_id_start': cuimc_id_next, 'count': 0, 'status': 'done'}
+                write_resume_file(resume_file, state)
+                results.append(chunk_result)
+                continue
+            if reservation_file is not None:
+                cuimc_id_next = reserve_cuimc_ids(len(upload_df_cleaned), cuimc_id_next, reservation_file)
+                chunk_result['cuimc_id_start'] = cuimc_id_next
+            batch_records = assign_cuimc_ids(upload_df_cleaned, cuimc_id_next)
+            cuimc_id_next = cuimc_id_next + len(batch_records)
+            futures[executor.submit(upload_chunk, api_key_local, cu_local_endpoint, batch_records)] = chunk_result
+            # bound the number of chunks held in memory
+            if len(futures) >= 2 * max_workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(futures))
+    results.sort(key=lambda x: x['chunk'])
+    failed = [str(x['chunk']) for x in results if x['status'] != 'done']
+    logging.info('Uploaded ' + str(sum([x['uploaded'] for x in results if x['status'] == 'done'])) + ' records in ' + str(len(results)) + ' chunks')
+    if failed != []:
+        logging.error('Failed chunks: ' + ','.join(failed) + '. Rerun with the same resume file to retry.')
+    return results
 
 
 if __name__ == "__main__":
-    log_file = '/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload.log'
-    token_file = '/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/api_tokens.json'
-    csv_file = '/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload_to_local_redcap/drlantigua_drsinger_drevans_upload_local_10-31-22.csv'
-    replicate_records_csv_file = '/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload_to_local_redcap/drlantigua_drsinger_drevans_upload_local_10-31-22_failed.csv'
-    # parser = argparse.ArgumentParser()
-    # parser.add_argument('--log', type=str, required=True, help="file to write log",)    
-    # parser.add_argument('--token', type=str, required=True, help='json file with api tokens')    
-    # args = parser.parse_args()
-    # log_file = args.log
-    # token_file = args.token
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', type=str, required=False, default='/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload.log', help="file to write log",)
+    parser.add_argument('--token', type=str, required=False, default='/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/api_tokens.json', help='json file with api tokens')
+    parser.add_argument('--csv', type=str, required=False, default='/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload_to_local_redcap/drlantigua_drsinger_drevans_upload_local_10-31-22.csv', help='csv file to upload')
+    parser.add_argument('--failed_csv', type=str, required=False, default='/phi_home/cl3720/phi/eMERGE/eIV-recruitement-support-redcap/batch_upload_to_local_redcap/drlantigua_drsinger_drevans_upload_local_10-31-22_failed.csv', help='csv file to write the records not uploaded')
+    parser.add_argument('--chunk_size', type=int, required=False, help='upload in chunks of this many rows')
+    parser.add_argument('--max_workers', type=int, required=False, default=4, help='maximum number of concurrent chunk uploads')
+    parser.add_argument('--resume_file', type=str, required=False, help='json file to keep chunk status for a resumable chunked upload')
+    parser.add_argument('--id_cache', type=str, required=False, help='json file to cache the local identifiers between runs')
+    parser.add_argument('--id_cache_max_age', type=int, required=False, default=3600, help='maximum age in seconds of the cached local identifiers')
+    parser.add_argument('--reservation_file', type=str, required=False, default='../cuimc_id_reservation.txt', help='file shared by concurrent uploads and the R4 syncs to reserve cuimc_id ranges')
+    args = parser.parse_args()
+    log_file = args.log
+    token_file = args.token
+    csv_file = args.csv
+    replicate_records_csv_file = args.failed_csv
 
     logging.basicConfig(filename=log_file, level=logging.INFO)
     # logging.basicConfig(level=logging.INFO)
@@ -169,7 +431,10 @@ if __name__ == "__main__":
     logging.info("Current Time =" +  dt_string)
 
     api_key_local, _, cu_local_endpoint, _ = read_api_config(config_file = token_file)
-    upload_df = read_batch_upload_csv(csv_file)
-    local_df = get_local_record(api_key_local,cu_local_endpoint)
-    upload_data = prepare_batch_upload(api_key_local,cu_local_endpoint,upload_df,local_df,replicate_records_csv_file)
-    execute_batch_upload(upload_data,cu_local_endpoint)    
+    local_df = get_local_identifiers(api_key_local,cu_local_endpoint,cache_file=args.id_cache,max_age=args.id_cache_max_age)
+    if args.chunk_size is not None:
+        chunked_batch_upload(api_key_local,cu_local_endpoint,csv_file,local_df,replicate_records_csv_file,chunk_size=args.chunk_size,max_workers=args.max_workers,resume_file=args.resume_file,reservation_file=args.reservation_file)
+    else:
+        upload_df = read_batch_upload_csv(csv_file)
+        upload_data = prepare_batch_upload(api_key_local,cu_local_endpoint,upload_df,local_df,replicate_records_csv_file,reservation_file=args.reservation_file)
+        execute_batch_upload(upload_data,cu_local_endpoint)
@@ -0,0 +1,49 @@
+import sqlite3
+import time
+from sqlite_cache import open_cache, select_by_keys, write_rows
+
+def open_npi_cache(db_path : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) the SQLite provider name to NPI cache
+    Input: db_path: path to the cache database
+    Output: conn: sqlite3 connection to the cache
+    '''
+    return open_cache(db_path, 'NPI', '''
+        CREATE TABLE IF NOT EXISTS npi_cache (
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            npi TEXT NOT NULL,
+            cached_at REAL NOT NULL,
+            PRIMARY KEY (first_name, last_name)
+        )''')
+
+def read_npi_cache(conn : sqlite3.Connection, name_keys : list, ttl : int = 2592000, negative_ttl : int = 604800, now : float = None) -> dict:
+    '''
+    Read the fresh cache entries of the given normalized (first, last) names
+    Names without a unique NPI are cached as '' (negative entries) and kept for negative_ttl seconds.
+    Input: conn: sqlite3 connection to the cache
+           name_keys: a list of normalized (first_name, last_name) tuples
+           ttl: maximum age in seconds of a found NPI
+           negative_ttl: maximum age in seconds of a negative entry
+           now: current time, time.time() if not provided
+    Output: npis: a dict of (first_name, last_name) to NPI, '' for negative entries
+    '''
+    if now is None:
+        now = time.time()
+    rows = select_by_keys(conn, ['first_name', 'last_name'], name_keys, '''
+        SELECT c.first_name, c.last_name, c.npi FROM npi_cache c
+        JOIN temp.query_keys q ON q.first_name = c.first_name AND q.last_name = c.last_name
+        WHERE (c.npi != '' AND c.cached_at >= ?) OR (c.npi = '' AND c.cached_at >= ?)''', (now - ttl, now - negative_ttl))
+    return dict([((first_name, last_name), npi) for first_name, last_name, npi in rows])
+
+def write_npi_cache(conn : sqlite3.Connection, npis : dict, now : float = None):
+    '''
+    Store NPPES lookups
+    Input: conn: sqlite3 connection to the cache
+           npis: a dict of normalized (first_name, last_name) to NPI, '' if no unique NPI
+           now: current time, time.time() if not provided
+    '''
+    if now is None:
+        now = time.time()
+    write_rows(conn, 'npi_cache', ['first_name', 'last_name', 'npi', 'cached_at'],
+               [(first_name, last_name, str(npi), now) for (first_name, last_name), npi in npis.items()])
@@ -0,0 +1,48 @@
+import sqlite3
+import logging
+import os
+
+def open_cache(db_path : str, name : str, create_table_sql : str) -> sqlite3.Connection:
+    '''
+    Open (and create if needed) a SQLite lookup cache
+    Input: db_path: path to the cache database
+           name: name of the cache, for the log
+           create_table_sql: CREATE TABLE IF NOT EXISTS statement of the cache table
+    Output: conn: sqlite3 connection to the cache
+    '''
+    logging.info("Opening " + name + " cache " + db_path + "...")
+    db_dir = os.path.dirname(db_path)
+    if db_dir != '':
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute(create_table_sql)
+    conn.commit()
+    return conn
+
+def select_by_keys(conn : sqlite3.Connection, key_columns : list, keys : list, select_sql : str, params : tuple = ()) -> list:
+    '''
+    Run a query joined to a temp table of lookup keys, instead of an IN-list with one parameter per key
+    Input: conn: sqlite3 connection to the cache
+           key_columns: names of the key columns of temp.query_keys
+           keys: a list of key tuples
+           select_sql: query joining temp.query_keys q to the cache table
+           params: parameters of select_sql
+    Output: rows: the rows of the query
+    '''
+    conn.execute('DROP TABLE IF EXISTS temp.query_keys')
+    conn.execute('CREATE TEMP TABLE query_keys ({c}, PRIMARY KEY ({k}))'.format(c = ', '.join([i + ' TEXT' for i in key_columns]), k = ', '.join(key_columns)))
+    conn.executemany('INSERT OR IGNORE INTO temp.query_keys VALUES ({p})'.format(p = ', '.join(['?'] * len(key_columns))), keys)
+    rows = conn.execute(select_sql, params).fetchall()
+    conn.execute('DROP TABLE temp.query_keys')
+    return rows
+
+def write_rows(conn : sqlite3.Connection, table : str, columns : list, rows : list):
+    '''
+    Insert or replace cache entries
+    Input: conn: sqlite3 connection to the cache
+           table: name of the cache table
+           columns: column names of the rows
+           rows: a list of tuples
+    '''
+    conn.executemany('INSERT OR REPLACE INTO {t} ({c}) VALUES ({p})'.format(t = table, c = ', '.join(columns), p = ', '.join(['?'] * len(columns))), rows)
+    conn.commit()
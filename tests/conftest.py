@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts import their siblings by module name, as when run from their own folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['redcap_api_utils', 'data_sync', 'project_setup']:
+    sys.path.insert(0, os.path.join(ROOT, folder))
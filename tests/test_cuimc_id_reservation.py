@@ -0,0 +1,30 @@
+import pandas as pd
+from data_pull_from_r4 import reserve_cuimc_ids, match_r4_local_data
+
+def r4_data_df(record_ids : list) -> pd.DataFrame:
+    return pd.DataFrame({'record_id': record_ids, 'first_name': 'f', 'last_name': record_ids, 'date_of_birth': '1980-01-01', 'age': 40,
+                         'first_name_child': '', 'last_name_child': '', 'date_of_birth_child': '', 'participant_lab_id': '',
+                         'last_update_timestamp': '2024-01-01 00:00:00'})
+
+def local_data_df() -> pd.DataFrame:
+    return pd.DataFrame({'cuimc_id': [10, 11], 'first_local': '', 'last_local': '', 'dob': '', 'last_child': '', 'child_first': '', 'dob_child': '',
+                         'participant_lab_id': '', 'record_id': ['1', '2']})
+
+def test_reserve_cuimc_ids(tmp_path):
+    reservation_file = str(tmp_path / 'cuimc_id_reservation.txt')
+    assert reserve_cuimc_ids(3, 12, reservation_file) == 12
+    assert reserve_cuimc_ids(2, 12, reservation_file) == 15
+    assert reserve_cuimc_ids(1, 20, reservation_file) == 20
+    with open(reservation_file) as f:
+        assert f.read() == '20'
+
+def test_concurrent_syncs_get_distinct_cuimc_ids(tmp_path):
+    reservation_file = str(tmp_path / 'cuimc_id_reservation.txt')
+    # two syncs from the same local export, e.g. the DET receiver and the nightly sync
+    mapping_a = match_r4_local_data(r4_data_df(['1', '3', '4']), local_data_df(), reservation_file = reservation_file)
+    mapping_b = match_r4_local_data(r4_data_df(['2', '5']), local_data_df(), reservation_file = reservation_file)
+    assert dict(zip(mapping_a['record_id'], mapping_a['cuimc_id'])) == {'1': 10, '3': 12, '4': 13}
+    assert dict(zip(mapping_b['record_id'], mapping_b['cuimc_id'])) == {'2': 11, '5': 14}
+    # without a reservation file both would start at the local maximum
+    mapping_c = match_r4_local_data(r4_data_df(['5']), local_data_df())
+    assert mapping_c['cuimc_id'].tolist() == [12]
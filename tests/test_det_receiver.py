@@ -0,0 +1,97 @@
+import threading
+import pytest
+import det_receiver
+from det_receiver import open_backlog, enqueue_record, due_records, backlog_stats, backlog_records, mark_synced, mark_failed, process_backlog
+
+@pytest.fixture
+def backlog(tmp_path):
+    conn = open_backlog(str(tmp_path / 'det' / 'det_backlog.db'))
+    yield conn, threading.Lock()
+    conn.close()
+
+@pytest.fixture
+def alerts(monkeypatch):
+    sent = []
+    monkeypatch.setattr(det_receiver, 'send_alert', sent.append)
+    return sent
+
+def fake_sync(monkeypatch, bad_ids : set) -> list:
+    '''
+    sync_records stand-in, a batch fails if it holds one of bad_ids, None is a full sync
+    '''
+    calls = []
+    def sync_records(config, record_ids):
+        calls.append(record_ids)
+        ids = bad_ids if record_ids is None else set(record_ids)
+        failed = sorted(bad_ids & ids)
+        return {'participants': 0, 'batches': 1, 'failed_batches': 1 if failed else 0, 'failed_r4_ids': list(ids) if failed and record_ids is not None else failed}
+    monkeypatch.setattr(det_receiver, 'sync_records', sync_records)
+    return calls
+
+def test_enqueue_coalesces_and_debounces(backlog):
+    conn, lock = backlog
+    enqueue_record(conn, lock, '1', now=100)
+    enqueue_record(conn, lock, '1', now=125)
+    enqueue_record(conn, lock, '2', now=110)
+    assert conn.execute('SELECT record_id, first_seen, last_seen, events FROM det_backlog ORDER BY record_id').fetchall() == [('1', 100, 125, 2), ('2', 110, 110, 1)]
+    # still being edited
+    assert due_records(conn, lock, debounce=30, max_wait=300, max_batch=10, max_attempts=3, now=140) == ['2']
+    assert due_records(conn, lock, debounce=30, max_wait=300, max_batch=10, max_attempts=3, now=155) == ['1', '2']
+    assert due_records(conn, lock, debounce=30, max_wait=300, max_batch=1, max_attempts=3, now=155) == ['1']
+    # max_wait bounds the delay of a record that keeps being triggered
+    enqueue_record(conn, lock, '1', now=399)
+    assert due_records(conn, lock, debounce=30, max_wait=300, max_batch=10, max_attempts=3, now=401) == ['1', '2']
+
+def test_mark_synced_keeps_retriggered_records(backlog):
+    conn, lock = backlog
+    for record_id in ['1', '2']:
+        enqueue_record(conn, lock, record_id, now=100)
+    enqueue_record(conn, lock, '2', now=200)
+    mark_synced(conn, lock, ['1', '2'], started_at=150)
+    assert backlog_records(conn, lock) == ['2']
+
+def test_mark_failed_dead_letters_exhausted_records(backlog):
+    conn, lock = backlog
+    for record_id in ['1', '2']:
+        enqueue_record(conn, lock, record_id, now=0)
+    assert mark_failed(conn, lock, ['1', '2'], max_attempts=2) == []
+    # exhausted records are never due, even before they are moved
+    conn.execute("UPDATE det_backlog SET attempts = 2 WHERE record_id = '2'")
+    assert due_records(conn, lock, debounce=0, max_wait=0, max_batch=10, max_attempts=2, now=1) == ['1']
+    assert mark_failed(conn, lock, ['1'], max_attempts=2) == ['1', '2']
+    assert backlog_stats(conn, lock) == (0, 2)
+    assert conn.execute('SELECT record_id, attempts FROM det_dead_letter ORDER BY record_id').fetchall() == [('1', 2), ('2', 2)]
+
+def test_sync_batch_bisects_failed_batches(backlog, monkeypatch, alerts):
+    conn, lock = backlog
+    calls = fake_sync(monkeypatch, {'3', '7'})
+    for record_id in [str(i) for i in range(1, 9)]:
+        enqueue_record(conn, lock, record_id, now=0)
+    assert process_backlog(conn, lock, {}, debounce=0, max_attempts=2) == 6
+    assert calls[:4] == [[str(i) for i in range(1, 9)], ['1', '2', '3', '4'], ['1', '2'], ['3', '4']]
+    assert sorted(backlog_records(conn, lock)) == ['3', '7']
+    assert alerts == []
+    # the bad records fail alone until they are dead-lettered
+    assert process_backlog(conn, lock, {}, debounce=0, max_attempts=2) == 0
+    assert backlog_stats(conn, lock) == (0, 2)
+    assert len(alerts) == 2
+
+def test_sync_batch_keeps_records_on_export_errors(backlog, monkeypatch, alerts):
+    conn, lock = backlog
+    def sync_records(config, record_ids):
+        raise Exception('R4 is down')
+    monkeypatch.setattr(det_receiver, 'sync_records', sync_records)
+    enqueue_record(conn, lock, '1', now=0)
+    assert process_backlog(conn, lock, {}, debounce=0, max_attempts=1) == 0
+    assert conn.execute('SELECT record_id, attempts FROM det_backlog').fetchall() == [('1', 0)]
+
+def test_full_sync_fallback_marks_imported_records(backlog, monkeypatch, alerts):
+    conn, lock = backlog
+    calls = fake_sync(monkeypatch, {'2'})
+    for record_id in ['1', '2', '3']:
+        enqueue_record(conn, lock, record_id, now=0)
+    config = {}
+    assert process_backlog(conn, lock, config, debounce=0, max_backlog=2, max_attempts=3) == -1
+    assert calls == [None]
+    assert conn.execute('SELECT record_id, attempts FROM det_backlog').fetchall() == [('2', 1)]
+    assert config['next_full_sync'] > 0
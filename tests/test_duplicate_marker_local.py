@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from duplicate_marker_local import find_duplicates, de_duplicates, de_duplicates_grouped
+
+def make_local_data(n : int, seed : int) -> pd.DataFrame:
+    '''
+    Synthetic output of indexing_local_data with many (dob, first_local, last_local) clusters,
+    R4 ids, declined outcomes, repeated cuimc ids and exact duplicate rows
+    '''
+    rng = np.random.default_rng(seed)
+    key = rng.integers(0, max(n // 3, 1), n)
+    ids = rng.permutation(n * 2)[:n]
+    repeated = rng.random(n) < 0.05
+    ids[repeated] = ids[rng.integers(0, n, repeated.sum())]
+    df = pd.DataFrame({
+        'cuimc_id': ids,
+        'first_local': np.array(['a', 'b', 'c'])[key % 3],
+        'last_local': (key // 3).astype(str),
+        'dob': pd.to_datetime('1950-01-01') + pd.to_timedelta(key % 7, unit='D'),
+        'child_first': np.where(rng.random(n) < 0.1, 'kid', ''),
+        'last_child': '',
+        'dob_child': pd.NaT,
+        'mrn': '',
+        'cuimc_empi': '',
+        'record_id': np.where(rng.random(n) < 0.15, rng.integers(1, 99, n).astype(str), ''),
+        'participant_lab_id': '',
+        'age': '',
+        'rec_outcome': np.where(rng.random(n) < 0.1, '9', '1'),
+        'rec_outcome_2': np.where(rng.random(n) < 0.05, '9', ''),
+        'rec_outcome_3': np.where(rng.random(n) < 0.05, '9', ''),
+    })
+    return pd.concat([df, df.sample(frac=0.02, random_state=seed)]).reset_index(drop=True)
+
+@pytest.mark.parametrize('seed', range(50))
+def test_de_duplicates_grouped_matches_de_duplicates(seed):
+    duplicates_df = find_duplicates(make_local_data(2000, seed))
+    expected = de_duplicates(duplicates_df)
+    result = de_duplicates_grouped(duplicates_df)
+    # the CSV reports written by main must be byte-identical
+    for expected_df, result_df in zip(expected, result):
+        assert result_df.to_csv(index=False) == expected_df.to_csv(index=False)
+
+def test_de_duplicates_grouped_decisions():
+    rows = [
+        # R4 id in the cluster: keep all
+        (1, 'a', 'x', '1980-01-01', '10', '1', '', ''),
+        (2, 'a', 'x', '1980-01-01', '', '1', '', ''),
+        # declined: keep the largest declined id, delete the other records
+        (3, 'b', 'y', '1980-01-01', '', '9', '', ''),
+        (4, 'b', 'y', '1980-01-01', '', '', '9', ''),
+        (5, 'b', 'y', '1980-01-01', '', '1', '', ''),
+        # neither: keep the largest id
+        (6, 'c', 'z', '1980-01-01', '', '1', '', ''),
+        (7, 'c', 'z', '1980-01-01', '', '1', '', ''),
+    ]
+    df = pd.DataFrame(rows, columns=['cuimc_id', 'first_local', 'last_local', 'dob', 'record_id', 'rec_outcome', 'rec_outcome_2', 'rec_outcome_3'])
+    for column in ['child_first', 'last_child', 'dob_child']:
+        df[column] = ''
+    R4_id_available_df, declined_df, delete_df, not_to_delete_df = de_duplicates_grouped(find_duplicates(df))
+    assert sorted(R4_id_available_df['cuimc_id']) == [1, 2]
+    assert sorted(declined_df['cuimc_id']) == [3, 4]
+    assert sorted(delete_df['cuimc_id']) == [3, 5, 6]
+    assert sorted(not_to_delete_df['cuimc_id']) == [1, 2, 4, 7]
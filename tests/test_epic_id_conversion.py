@@ -0,0 +1,64 @@
+import sqlite3
+import pandas as pd
+import pytest
+from epic_id_conversion import resolve_empi, classify_empi, convert_to_empi
+
+MAPPING_TABLE = 'patient_mappings'
+
+@pytest.fixture
+def cnxn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE patient_mappings (EMPI TEXT, LOCAL_PT_ID TEXT, FACILITY_CODE TEXT)')
+    conn.executemany('INSERT INTO patient_mappings VALUES (?, ?, ?)', [
+        ('E1', '101', 'P'), ('E1', '101', 'UI'), # same EMPI through two facilities
+        ('E2', '102', 'P'),
+        ('E3', '103', 'P'), ('E4', '103', 'UI'), # ambiguous
+        ('E5', '105', 'X'), # other facility
+        ('E6', '106', 'P'),
+    ])
+    conn.commit()
+    yield conn
+    conn.close()
+
+def records(mrns : list) -> list:
+    return [{'cuimc_id': str(i + 1), 'mrn': mrn, 'cuimc_empi': ''} for i, mrn in enumerate(mrns)]
+
+def test_resolve_empi_chunks(cnxn):
+    mrn_list = ['101', '102', '103', '104', '105', '106', 'E2']
+    chunked_df = resolve_empi(mrn_list, cnxn, mapping_table=MAPPING_TABLE, chunk_size=2)
+    single_df = resolve_empi(mrn_list, cnxn, mapping_table=MAPPING_TABLE, chunk_size=1000)
+    expected = [('101', 'E1'), ('102', 'E2'), ('103', 'E3'), ('103', 'E4'), ('106', 'E6'), ('E2', 'E2')]
+    assert sorted(map(tuple, chunked_df.values.tolist())) == expected
+    assert sorted(map(tuple, single_df.values.tolist())) == expected
+    assert resolve_empi([], cnxn, mapping_table=MAPPING_TABLE).empty
+
+def test_classify_empi(cnxn):
+    mrn_df = pd.DataFrame({'cuimc_id': ['1', '2', '3', '4'], 'mrn': ['101', '103', '104', '101']})
+    mapping_df = resolve_empi(mrn_df['mrn'].tolist(), cnxn, mapping_table=MAPPING_TABLE)
+    classified = classify_empi(mrn_df, mapping_df)
+    assert classified['empi_status'].tolist() == ['unique', 'ambiguous', 'missing', 'unique']
+    assert classified['cuimc_empi'].tolist() == ['E1', '', '', 'E1']
+
+def test_convert_to_empi_duplicate_and_missing_mrns(cnxn):
+    local_records = records(['101', '101', '103', '104', '']) + [{'cuimc_id': '6', 'mrn': '102', 'cuimc_empi': 'E9'}]
+    changed = convert_to_empi(local_records, cnxn, mapping_table=MAPPING_TABLE, chunk_size=1)
+    # duplicate MRNs both get the EMPI, ambiguous, missing and empty MRNs and existing EMPIs are left alone
+    assert changed == [{'cuimc_id': '1', 'mrn': '101', 'cuimc_empi': 'E1'}, {'cuimc_id': '2', 'mrn': '101', 'cuimc_empi': 'E1'}]
+    assert [record['cuimc_empi'] for record in local_records] == ['E1', 'E1', '', '', '', 'E9']
+
+def test_convert_to_empi_cache_hits(cnxn, tmp_path):
+    cache_db = str(tmp_path / 'empi_cache.db')
+    queries = []
+    cnxn.set_trace_callback(lambda sql: queries.append(sql) if 'patient_mappings M' in sql else None)
+    changed = convert_to_empi(records(['101', '104']), cnxn, mapping_table=MAPPING_TABLE, cache_db=cache_db)
+    assert [record['cuimc_empi'] for record in changed] == ['E1']
+    assert len(queries) > 0
+    # unique and missing MRNs are both served by the cache
+    queries.clear()
+    cnxn.execute("DELETE FROM patient_mappings WHERE EMPI = 'E1'")
+    changed = convert_to_empi(records(['101', '104']), cnxn, mapping_table=MAPPING_TABLE, cache_db=cache_db)
+    assert [record['cuimc_empi'] for record in changed] == ['E1']
+    assert queries == []
+    # an expired entry goes back to the warehouse
+    changed = convert_to_empi(records(['101']), cnxn, mapping_table=MAPPING_TABLE, cache_db=cache_db, ttl=-1)
+    assert changed == [] and len(queries) > 0
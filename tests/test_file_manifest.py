@@ -0,0 +1,26 @@
+import os
+from file_manifest import open_manifest, blob_path, upsert_manifest, find_missing_files
+
+def stored_blob(file_repo : str, sha256 : str):
+    path = blob_path(file_repo, sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(sha256)
+
+def test_find_missing_files(tmp_path):
+    file_repo = str(tmp_path / 'file_repo')
+    conn = open_manifest(os.path.join(file_repo, 'manifest.db'))
+    for record_id, sha256 in [('1', 'aa11'), ('2', 'bb22'), ('3', 'cc33')]:
+        upsert_manifest(conn, record_id, 'gira_pdf', 'gira_' + record_id + '.pdf', 100, sha256)
+        stored_blob(file_repo, sha256)
+    file_list = [{'record_id': '1', 'field': 'gira_pdf', 'file_name': 'gira_1.pdf'},
+                 {'record_id': '2', 'field': 'gira_pdf', 'file_name': 'gira_2_v2.pdf'},
+                 {'record_id': '3', 'field': 'gira_pdf', 'file_name': 'gira_3.pdf', 'size': 120},
+                 {'record_id': '4', 'field': 'gira_pdf', 'file_name': 'gira_4.pdf'}]
+    # new record, renamed file and changed size
+    assert [f['record_id'] for f in find_missing_files(conn, file_list, file_repo=file_repo)] == ['2', '3', '4']
+    # a blob removed from the repo is downloaded again, without file_repo only the manifest is checked
+    os.remove(blob_path(file_repo, 'aa11'))
+    assert [f['record_id'] for f in find_missing_files(conn, file_list, file_repo=file_repo)] == ['1', '2', '3', '4']
+    assert [f['record_id'] for f in find_missing_files(conn, file_list)] == ['2', '3', '4']
+    conn.close()
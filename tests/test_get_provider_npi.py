@@ -0,0 +1,99 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+import get_provider_npi
+from get_provider_npi import parse_names, parse_names_vectorized, query_nppes
+
+PARSE_CASES = [
+    # titles
+    'Dr John Smith', 'dr. John Smith', 'DRA Maria Lopez', 'Dra. Maria Lopez', 'Doctor John Smith', 'Dr Smith', 'Dr.', 'Dr',
+    # suffixes
+    'John Smith MD', 'John Smith, MD', 'John Smith,MD', 'John Smith md.', 'Ann Li, NP', 'Smith MD', 'MD',
+    # title and suffix
+    'Dr John Smith MD', 'Dr. Smith, MD',
+    # middle names
+    'John Q Smith', 'John Q. Smith', 'Dr John Q Smith', 'John Q Smith MD', 'John Quincy Adams Smith',
+    # "Last, First" order
+    'Smith, John', 'Smith,John', 'Smith, John Q', "O'Brien, Mary-Ann",
+    # single names, punctuation and whitespace only
+    'Smith', ' Smith ', ',,', '.', '   ', '\tJohn\tSmith\t', 'John  Smith',
+    # non-ascii and digits
+    'Éva Núñez', 'X2 Smith',
+]
+
+def test_parse_names_vectorized_matches_parse_names():
+    names_df = parse_names_vectorized(pd.Series(PARSE_CASES, dtype=object))
+    assert list(zip(names_df['first_name'], names_df['last_name'])) == [parse_names(name) for name in PARSE_CASES]
+
+def test_parse_names_vectorized_empty_and_nan():
+    names = pd.Series(['', np.nan, None, 'John Smith'], dtype=object)
+    names_df = parse_names_vectorized(names)
+    # parse_names is only called on exported strings, missing values are parsed as ''
+    assert list(zip(names_df['first_name'], names_df['last_name'])) == [parse_names('')] * 3 + [parse_names('John Smith')]
+    assert list(names_df['confident']) == [False, False, False, True]
+    assert parse_names_vectorized(pd.Series([], dtype=object)).shape == (0, 3)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_parse_names_vectorized_matches_parse_names_random(seed):
+    rng = random.Random(seed)
+    words = ['Dr', 'dr.', 'DRA', 'Dra.', 'doctor', 'MD', 'md', ',MD', 'NP', 'np.', 'Ann', 'bob', 'Mary-Ann', "O'Brien", 'Li', 'j.', 'Smith', 'X2', 'Éva']
+    separators = [' ', '  ', ', ', ',', '.', '\t', '. ']
+    names = []
+    for _ in range(5000):
+        n_words = rng.randint(1, 6)
+        names.append(''.join([rng.choice(words) + (rng.choice(separators) if i < n_words - 1 else rng.choice(['', ' ', ',', '.'])) for i in range(n_words)]))
+    names_df = parse_names_vectorized(pd.Series(names, dtype=object))
+    assert list(zip(names_df['first_name'], names_df['last_name'])) == [parse_names(name) for name in names]
+
+def test_parse_names_vectorized_confident():
+    names = pd.Series(['Dr John Smith MD', 'John Smith', "Mary-Ann O'Brien", 'X2 Smith', 'Dr Smith', 'Smith, John'], dtype=object)
+    names_df = parse_names_vectorized(names)
+    assert list(names_df['confident']) == [False, True, True, False, False, True]
+
+def test_parse_names_vectorized_custom_vocabulary():
+    names_df = parse_names_vectorized(pd.Series(['Prof John Smith', 'John Smith PhD'], dtype=object), titles=['prof'], suffixes=['phd'])
+    assert list(zip(names_df['first_name'], names_df['last_name'])) == [('John', 'Smith'), ('John', 'Smith')]
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = {}
+        self.text = str(payload)
+
+    def json(self):
+        return self.payload
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, *args, **kwargs):
+        self.calls = self.calls + 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class NoLimit:
+    def acquire(self):
+        pass
+
+@pytest.mark.parametrize('payload', [{'Errors': [{'description': 'No valid search criteria'}]}, {}, {'result_count': 1}, []])
+def test_query_nppes_rejected_query_not_retried(payload, monkeypatch):
+    monkeypatch.setattr(get_provider_npi.time, 'sleep', lambda seconds: None)
+    session = FakeSession([FakeResponse(200, payload)])
+    assert query_nppes(session, 'John', 'Smith', NoLimit()) is None
+    assert session.calls == 1
+
+def test_query_nppes_retries_network_errors_and_5xx(monkeypatch):
+    monkeypatch.setattr(get_provider_npi.time, 'sleep', lambda seconds: None)
+    session = FakeSession([ConnectionError('reset'), FakeResponse(429, {}), FakeResponse(503, {}),
+                           FakeResponse(200, {'result_count': 1, 'results': [{'number': 1234567890}]})])
+    assert query_nppes(session, 'John', 'Smith', NoLimit()) == 1234567890
+    assert session.calls == 4
+    session = FakeSession([FakeResponse(404, {})])
+    assert query_nppes(session, 'John', 'Smith', NoLimit()) is None
+    assert session.calls == 1
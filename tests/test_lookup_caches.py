@@ -0,0 +1,23 @@
+import pandas as pd
+from empi_cache import open_empi_cache, read_empi_cache, write_empi_cache
+from npi_cache import open_npi_cache, read_npi_cache, write_npi_cache
+
+def test_empi_cache_ttl(tmp_path):
+    conn = open_empi_cache(str(tmp_path / 'cache' / 'empi_cache.db'))
+    mapping_df = pd.DataFrame({'MRN': ['1', '2', '2'], 'EMPI': ['E1', 'E2', 'E3']})
+    write_empi_cache(conn, ['1', '2', '3'], mapping_df, now=1000)
+    cached_df, cached_mrns = read_empi_cache(conn, ['1', '2', '3', '4'], ttl=100, negative_ttl=10, now=1005)
+    assert cached_mrns == {'1', '2', '3'}
+    assert sorted(map(tuple, cached_df.values.tolist())) == [('1', 'E1'), ('2', 'E2'), ('2', 'E3')]
+    # ambiguous and missing entries expire first
+    cached_df, cached_mrns = read_empi_cache(conn, ['1', '2', '3'], ttl=100, negative_ttl=10, now=1050)
+    assert cached_mrns == {'1'}
+    assert read_empi_cache(conn, ['1'], ttl=100, negative_ttl=10, now=1200)[1] == set()
+    conn.close()
+
+def test_npi_cache_ttl(tmp_path):
+    conn = open_npi_cache(str(tmp_path / 'npi_cache.db'))
+    write_npi_cache(conn, {('john', 'smith'): 1234567890, ('ann', 'li'): ''}, now=1000)
+    assert read_npi_cache(conn, [('john', 'smith'), ('ann', 'li'), ('bob', 'lee')], ttl=100, negative_ttl=10, now=1005) == {('john', 'smith'): '1234567890', ('ann', 'li'): ''}
+    assert read_npi_cache(conn, [('john', 'smith'), ('ann', 'li')], ttl=100, negative_ttl=10, now=1050) == {('john', 'smith'): '1234567890'}
+    conn.close()
@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+from payload_validation import validation_rule, validate_payload
+
+def text_field(field_name : str, validation : str) -> dict:
+    return {'field_name': field_name, 'form_name': 'visit', 'field_type': 'text', 'select_choices_or_calculations': '',
+            'text_validation_type_or_show_slider_number': validation}
+
+@pytest.mark.parametrize('validation, value, valid', [
+    ('time_mm_ss', '59:59', True),
+    ('time_mm_ss', '60:00', False),
+    ('time', '23:59', True),
+    ('time', '59:59', False),
+    ('time_hh_mm_ss', '23:59:59', True),
+    ('number_comma_decimal', '1,5', True),
+    ('number_comma_decimal', '1.5', False),
+    ('number_2dp_comma_decimal', '-1,25', True),
+    ('number', '1.5', True),
+    ('number', '1,5', False),
+    ('number_1dp', '1.5', True),
+    ('integer', '-3', True),
+    ('date_mdy', '2024-02-30', False),
+    ('date_mdy', '2024-02-29', True),
+    ('datetime_seconds_ymd', '2024-01-01 10:00:00', True),
+    ('datetime_ymd', '2024-01-01 10:00:00', False),
+])
+def test_validate_payload_text_validation(validation, value, valid):
+    meta = [text_field('record_id', ''), text_field('value', validation)]
+    payload_df = pd.DataFrame({'record_id': ['1'], 'value': [value]})
+    bad_cells, quarantine_df = validate_payload(payload_df, meta)
+    assert bad_cells.loc[0, 'value'] == (not valid)
+    assert len(quarantine_df) == (0 if valid else 1)
+
+@pytest.mark.parametrize('validation', ['', 'email', 'phone', 'timestamp', 'number_foo', 'date'])
+def test_validation_rule_unknown_types_not_checked(validation):
+    assert validation_rule(validation) == (None, None)
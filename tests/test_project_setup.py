@@ -0,0 +1,70 @@
+from project_setup_by_r4_and_local import merge_metadata, diff_metadata, has_changes, find_breaking_sync_fields, FORMS_FOR_UPDATE
+
+def field(field_name : str, form_name : str, field_type : str = 'text', choices : str = '') -> dict:
+    return {'field_name': field_name, 'form_name': form_name, 'field_type': field_type, 'select_choices_or_calculations': choices}
+
+def old_merge(meta_local_json : list, meta_r4_json : list) -> list:
+    '''
+    nested-loop merge of the original project setup script
+    '''
+    forms_for_update = ['postror_adult','postror_child']
+    meta_local_json_field_name_list = [i['field_name'] for i in meta_local_json if i['form_name'] not in forms_for_update]
+    meta_r4_json_deduplicated = [i for i in meta_r4_json if i['field_name'] not in meta_local_json_field_name_list]
+    meta_local_json = [i for i in meta_local_json if i['form_name'] not in forms_for_update]
+    meta_json = meta_local_json + meta_r4_json_deduplicated
+    ordered_form_names = []
+    for i in meta_json:
+        if i['form_name'] not in ordered_form_names:
+            ordered_form_names.append(i['form_name'])
+    new_json = []
+    for i in ordered_form_names:
+        for j in meta_json:
+            if j['form_name'] == i:
+                new_json.append(j)
+    return new_json
+
+META_LOCAL = [field('cuimc_id', 'local_ids'), field('mrn', 'local_ids'), field('first_name', 'baseline'), field('age', 'baseline'),
+              field('ror_q1', 'postror_adult', 'radio', '1, Yes | 0, No'), field('ror_old', 'postror_adult'), field('r4_survey_queue_link', 'local_ids')]
+META_R4 = [field('record_id', 'baseline'), field('first_name', 'baseline'), field('age', 'baseline', choices='calc'), field('sex', 'baseline', 'radio'),
+           field('ror_q1', 'postror_adult', 'radio', '1, Yes | 2, No'), field('ror_q2', 'postror_child'), field('gira', 'gira_report', 'file')]
+
+def test_merge_metadata_matches_old_algorithm():
+    new_json = merge_metadata(META_LOCAL, META_R4)
+    assert new_json == old_merge(META_LOCAL, META_R4)
+    # fields of a form are contiguous
+    assert [i['field_name'] for i in new_json] == ['cuimc_id', 'mrn', 'r4_survey_queue_link', 'first_name', 'age', 'record_id', 'sex', 'ror_q1', 'ror_q2', 'gira']
+    assert FORMS_FOR_UPDATE == ['postror_adult', 'postror_child']
+
+def test_merge_metadata_replaces_forms_for_update():
+    new_json = merge_metadata(META_LOCAL, META_R4)
+    postror = [i for i in new_json if i['form_name'] in FORMS_FOR_UPDATE]
+    # the R4 version of the form, local only fields of the form are dropped
+    assert postror == [i for i in META_R4 if i['form_name'] in FORMS_FOR_UPDATE]
+    # local fields of other forms are kept over R4
+    assert [i for i in new_json if i['field_name'] == 'age'] == [field('age', 'baseline')]
+
+def test_diff_metadata_and_has_changes():
+    new_json = merge_metadata(META_LOCAL, META_R4)
+    diff = diff_metadata(META_LOCAL, new_json)
+    assert diff['added_fields'] == ['record_id', 'sex', 'ror_q2', 'gira']
+    assert diff['removed_fields'] == ['ror_old']
+    assert diff['changed_fields'] == {'ror_q1': {'select_choices_or_calculations': ['1, Yes | 0, No', '1, Yes | 2, No']}}
+    assert diff['added_forms'] == ['postror_child', 'gira_report']
+    assert diff['changed_forms'] == ['baseline', 'postror_adult']
+    assert not diff['form_order_changed']
+    assert has_changes(diff)
+    assert not has_changes(diff_metadata(new_json, new_json))
+    # re-merging moves the forms_for_update after the local forms, as the old script did
+    diff = diff_metadata(new_json, merge_metadata(new_json, META_R4))
+    assert diff['form_order_changed'] and not any([len(diff[k]) > 0 for k in diff if k != 'form_order_changed'])
+    # moving a form is a change even with the same fields
+    moved = [i for i in new_json if i['form_name'] != 'local_ids'] + [i for i in new_json if i['form_name'] == 'local_ids']
+    diff = diff_metadata(new_json, moved)
+    assert diff['form_order_changed'] and has_changes(diff)
+
+def test_find_breaking_sync_fields():
+    new_json = [i for i in merge_metadata(META_LOCAL, META_R4) if i['field_name'] not in ['first_name', 'r4_survey_queue_link']]
+    diff = diff_metadata(META_LOCAL, new_json)
+    # removed and changed synced fields, ror_old is not synced
+    assert find_breaking_sync_fields(diff, META_LOCAL, META_R4) == {'first_name': 'removed', 'r4_survey_queue_link': 'removed', 'ror_q1': 'changed select_choices_or_calculations'}
+    assert find_breaking_sync_fields(diff, META_LOCAL, META_R4, ['first_name', 'ror_q1']) == {'r4_survey_queue_link': 'removed'}
@@ -0,0 +1,27 @@
+import schema_drift
+from schema_drift import load_metadata
+
+def field(field_name : str, field_type : str = 'text') -> dict:
+    return {'field_name': field_name, 'form_name': 'visit', 'field_type': field_type, 'select_choices_or_calculations': ''}
+
+def test_load_metadata_design_log(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'schema_cache.json')
+    exports = []
+    metadata = [field('record_id'), field('age')]
+    design_log = []
+    monkeypatch.setattr(schema_drift, 'export_metadata', lambda api_key, api_endpoint: exports.append(api_endpoint) or list(metadata))
+    monkeypatch.setattr(schema_drift, 'export_design_log', lambda api_key, api_endpoint, begin_time: design_log)
+
+    _, version = load_metadata('token', 'https://local/api/', cache_file)
+    assert version['changed'] and len(exports) == 1
+    # no design change logged, the cached dictionary is used without an export
+    loaded, version = load_metadata('token', 'https://local/api/', cache_file)
+    assert loaded == metadata and version['from_cache'] and len(exports) == 1
+    # a logged change, or no design log, exports the dictionary again
+    metadata.append(field('sex', 'radio'))
+    design_log = [{'action': 'Manage/Design'}]
+    loaded, version = load_metadata('token', 'https://local/api/', cache_file)
+    assert loaded == metadata and version['changed'] and len(exports) == 2
+    design_log = None
+    loaded, version = load_metadata('token', 'https://local/api/', cache_file)
+    assert not version['changed'] and not version['from_cache'] and len(exports) == 3